@@ -12,38 +12,170 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
 import os
 
 from absl import logging
 
-from typing import List, Dict, Optional
-from message import Message, parse_message_from_str
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+from email_store import EmailStore
+from message import Message, MessageHeaders, decode_content, parse_headers_from_bytes, parse_message_from_bytes
 from message_dao import MessageDao
 
+# Emails are sent to parse workers this many at a time; smaller batches are
+# parsed in this process.
+PARSE_CHUNK_SIZE = 64
+
 class ArchiveMessageIndex(object):
-    def __init__(self, message_dao: MessageDao) -> None:
+    def __init__(self, message_dao: MessageDao, email_store: Optional[EmailStore] = None,
+                 parse_workers: int = 0) -> None:
+        """ With more than one parse worker, the bodies of large batches of
+        emails are decoded in a pool of that many processes."""
         self._message_dao = message_dao
+        # Raw emails of new messages are kept here so they can be reloaded without git
+        self._email_store = email_store
+        self._executor = None
+        if parse_workers > 1:
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=parse_workers)
 
-    def update(self, data_dir: str) -> Dict[str, Message]:
-        """ Updates index with messages in the passed in directory.
-        Returns a dictionary mapping new messages' ids to their corresponding message."""
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
 
-        new_messages : Dict[str, Message] = {}
+    def update(self, raw_emails: Iterable[Tuple[str, bytes]],
+               commit_times: Optional[Dict[str, int]] = None) -> Dict[str, Message]:
+        """ Updates index with the passed in (archive hash, raw email) pairs.
+        Returns a dictionary mapping new messages' ids to their corresponding message.
+        commit_times, if given, maps archive hashes to the time they were committed.
 
-        for filename in os.listdir(data_dir):
-            if not filename.endswith(".txt"):
-                continue
-            email = generate_email_from_file(os.path.join(data_dir, filename))
-            if email and not self._message_dao.get(email.id):
+        Emails are first classified using only their headers; the full body is
+        only parsed for emails which can end up being stored or uploaded."""
+
+        candidates : Dict[str, Tuple[str, bytes, MessageHeaders]] = {}
+        for archive_hash, raw_email in raw_emails:
+            headers = generate_headers_from_bytes(archive_hash, raw_email)
+            if headers:
+                candidates[headers.id] = (archive_hash, raw_email, headers)
+        # Emails we have already stored are looked up all at once.
+        for message_id in self._message_dao.contains_many(candidates):
+            del candidates[message_id]
+        parents = {headers.in_reply_to for _, _, headers in candidates.values()
+                   if headers.in_reply_to and headers.in_reply_to not in candidates}
+        stored_parents = self._message_dao.contains_many(parents)
+
+        routable : Dict[str, bool] = {}
+        orphaned : Set[str] = set()
+        emails = [candidate for message_id, candidate in candidates.items()
+                  if self._is_routable(message_id, candidates, stored_parents, routable, orphaned)]
+
+        new_messages : Dict[str, Message] = {}
+        for (archive_hash, raw_email, _), email in zip(emails, self._parse(emails)):
+            if email:
+                if commit_times:
+                    email.commit_time = commit_times.get(archive_hash)
                 new_messages[email.id] = email
-        self._populate_children(new_messages)
+                if self._email_store is not None:
+                    self._email_store.put(archive_hash, raw_email)
+        self._hold_orphans([candidates[message_id] for message_id in orphaned])
+        self._adopt_orphans(new_messages)
+        self._populate_children(new_messages, stored_parents)
         return new_messages
 
-    def _populate_children(self, new_messages: Dict[str, Message]) -> None:
+    def _hold_orphans(self, orphans: List[Tuple[str, bytes, MessageHeaders]]) -> None:
+        """ Hands replies whose parent we have not seen to the DAO, which holds
+        them until the parent arrives or they expire."""
+        messages = []
+        for archive_hash, raw_email, headers in orphans:
+            if self._email_store is not None:
+                self._email_store.put(archive_hash, raw_email)
+            # Only the headers are needed until the parent arrives.
+            messages.append(Message(headers.id, headers.subject, headers.from_, headers.in_reply_to,
+                                    None, archive_hash, raw_email=raw_email))
+        self._message_dao.store_orphans(messages)
+        self._message_dao.expire_orphans()
+
+    def _adopt_orphans(self, new_messages: Dict[str, Message]) -> None:
+        """ Adds the held replies to new messages, and replies to those, to
+        'new_messages'."""
+        parent_ids = list(new_messages)
+        while parent_ids:
+            adopted = self._message_dao.take_orphans(parent_ids)
+            if adopted:
+                logging.info('Found the parents of %d held replies', len(adopted))
+            for orphan in adopted:
+                new_messages[orphan.id] = orphan
+            parent_ids = [orphan.id for orphan in adopted]
+
+    def _parse(self, emails: List[Tuple[str, bytes, MessageHeaders]]) -> List[Optional[Message]]:
+        """ Parses emails, in order. Large batches are decoded by the parse
+        workers; otherwise bodies are decoded lazily in this process. Either way
+        the messages keep their raw email, so their content can be released and
+        decoded again later."""
+        if self._executor is None or len(emails) < PARSE_CHUNK_SIZE:
+            return [generate_email_from_bytes(archive_hash, raw_email, headers)
+                    for archive_hash, raw_email, headers in emails]
+        chunks = [emails[start:start + PARSE_CHUNK_SIZE] for start in range(0, len(emails), PARSE_CHUNK_SIZE)]
+        # map returns results in the order of the chunks.
+        contents = [content for chunk in self._executor.map(_decode_chunk, chunks) for content in chunk]
+        messages : List[Optional[Message]] = []
+        for (archive_hash, raw_email, headers), content in zip(emails, contents):
+            if content is None:
+                messages.append(None)
+                continue
+            messages.append(Message(headers.id, headers.subject, headers.from_, headers.in_reply_to,
+                                    content, archive_hash, raw_email=raw_email))
+        return messages
+
+    def _is_routable(self, message_id: str,
+                     candidates: Dict[str, Tuple[str, bytes, MessageHeaders]],
+                     stored_parents: Set[str],
+                     routable: Dict[str, bool],
+                     orphaned: Set[str]) -> bool:
+        """ Returns whether a new email belongs to a thread we can upload: either
+        its thread starts with a patch or cover letter in this batch, or it replies
+        to an email we have already stored, i.e. one in 'stored_parents'. Results
+        are memoized in 'routable'. Emails which are not routable only because
+        their thread is missing an email are added to 'orphaned'."""
+        # Walk up the thread within this batch until we reach its first email
+        # or an email which is not part of the batch.
+        chain : List[str] = []
+        current = message_id
+        is_orphan = False
+        while current in candidates and current not in routable:
+            if current in chain:
+                logging.info('Found a reply loop, dropping %s', message_id)
+                result = False
+                break
+            chain.append(current)
+            headers = candidates[current][2]
+            if headers.in_reply_to is None:
+                result = headers.is_patch_or_coverletter()
+                if not result:
+                    logging.info('Not a patch, dropping %s', current)
+                break
+            current = headers.in_reply_to
+        else:
+            if current in routable:
+                result = routable[current]
+                is_orphan = current in orphaned
+            else:
+                result = current in stored_parents
+                is_orphan = not result
+                if is_orphan:
+                    logging.info('Could not find parent email %s, holding %s', current, message_id)
+        for visited in chain:
+            routable[visited] = result
+        if not result and is_orphan:
+            orphaned.update(chain)
+        return result
+
+    def _populate_children(self, new_messages: Dict[str, Message], stored_parents: Set[str]) -> None:
         """ Iterates through all new emails and links together emails that form
         a thread by populating message.children. Parents from the database
         that have a new reply are added to 'new_messages' in order to be stored
-        in the database once re-uploaded."""
+        in the database once re-uploaded. Only the parents in 'stored_parents'
+        are loaded from the database, along with their thread."""
 
         # Iterate through a copy of the values to avoid altering the size of the iterator
         for message in list(new_messages.values()):
@@ -56,18 +188,50 @@ class ArchiveMessageIndex(object):
                 parent = new_messages.get(message.in_reply_to)
                 parent.children.append(message)
             else:
-                parent = self._message_dao.get(message.in_reply_to)
+                parent = None
+                if message.in_reply_to in stored_parents:
+                    parent = self._message_dao.get(message.in_reply_to)
                 if not parent:
                     logging.info('Could not find parent email, dropping %s', message.debug_info())
                     continue
+                # Other readers of the DAO's cache must not see the new reply.
+                self._message_dao.invalidate(parent.id)
                 parent.children.append(message)
                 new_messages[parent.id] = parent
 
-def generate_email_from_file(file: str) -> Optional[Message]:
-    archive_hash = file[12:-4]
-    with open(file, "r") as raw_email:
+def _decode_chunk(emails: List[Tuple[str, bytes, MessageHeaders]]) -> List[Optional[Union[str, List[str]]]]:
+    """ Runs in a parse worker. Decodes each email's body; only the decoded
+    text is sent back, or None for emails that could not be decoded."""
+    contents : List[Optional[Union[str, List[str]]]] = []
+    for archive_hash, raw_email, _ in emails:
         try:
-          return parse_message_from_str(raw_email.read(), archive_hash=archive_hash)
+            contents.append(decode_content(raw_email))
         except Exception as e:
             logging.error('Failed to generate %s from archive. Error: %s', archive_hash, e)
-            return None
+            contents.append(None)
+    return contents
+
+def generate_headers_from_bytes(archive_hash: str, raw_email: bytes) -> Optional[MessageHeaders]:
+    try:
+        headers = parse_headers_from_bytes(raw_email)
+    except Exception as e:
+        logging.error('Failed to read headers of %s from archive. Error: %s', archive_hash, e)
+        return None
+    if not headers.id:
+        logging.error('Missing Message-Id in %s from archive', archive_hash)
+        return None
+    return headers
+
+def generate_email_from_bytes(archive_hash: str, raw_email: bytes,
+                              headers: Optional[MessageHeaders] = None) -> Optional[Message]:
+    try:
+        return parse_message_from_bytes(raw_email, archive_hash=archive_hash, headers=headers)
+    except Exception as e:
+        logging.error('Failed to generate %s from archive. Error: %s', archive_hash, e)
+        return None
+
+def generate_email_from_file(file: str) -> Optional[Message]:
+    """Parses an email stored in a file named after its archive hash, e.g. <hash>.txt."""
+    archive_hash = os.path.splitext(os.path.basename(file))[0]
+    with open(file, "rb") as raw_email:
+        return generate_email_from_bytes(archive_hash, raw_email.read())
@@ -1,10 +1,14 @@
+import tempfile
 import unittest
-from archive_converter import generate_email_from_file, ArchiveMessageIndex
+import archive_converter
+from unittest import mock
+from archive_converter import generate_email_from_bytes, generate_email_from_file, ArchiveMessageIndex
+from email_store import EmailStore
 from message_dao import FakeMessageDao
 from typing import List
-from message import Message
+from message import Message, parse_headers_from_bytes
 
-from test_helpers import compare_message_subjects, test_data_path
+from test_helpers import compare_message_subjects, read_test_emails, test_data_path
 
 class ArchiveConverterTest(unittest.TestCase):
 
@@ -18,21 +22,66 @@ class ArchiveConverterTest(unittest.TestCase):
         self.assertEqual(email.from_, "Raul E Rangel <rrangel@chromium.org>")
         self.assertTrue(len(email.content) > 0)
 
+    def test_generate_email_keeps_archive_hash(self):
+        with open(test_data_path('patch6.txt'), 'rb') as f:
+            email = generate_email_from_bytes('fake_hash', f.read())
+        self.assertEqual(email.archive_hash, 'fake_hash')
+        self.assertEqual(generate_email_from_file(test_data_path('patch6.txt')).archive_hash, 'patch6')
+
     def test_update_with_no_changes_to_data(self):
         archive_index = ArchiveMessageIndex(self.message_dao)
-        archive_index.update(test_data_path())
+        archive_index.update(read_test_emails())
         old_size = self.message_dao.size()
-        archive_index.update(test_data_path())
+        archive_index.update(read_test_emails())
         self.assertEqual(old_size, self.message_dao.size())
 
+    def test_update_fills_email_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, EmailStore(tmp_dir) as email_store:
+            archive_index = ArchiveMessageIndex(self.message_dao, email_store)
+            new_messages = archive_index.update(read_test_emails()).values()
+            for message in new_messages:
+                self.assertIn(message.archive_hash, email_store)
+            with open(test_data_path('patch6.txt'), 'rb') as f:
+                self.assertEqual(f.read(), email_store.get('patch6'))
+
+    def test_update_sets_commit_times(self):
+        emails = list(read_test_emails())
+        commit_times = {archive_hash: i for i, (archive_hash, _) in enumerate(emails)}
+        new_messages = ArchiveMessageIndex(self.message_dao).update(emails, commit_times)
+        self.assertTrue(new_messages)
+        for message in new_messages.values():
+            self.assertEqual(commit_times[message.archive_hash], message.commit_time)
+
+    def test_update_with_parse_workers(self):
+        expected = ArchiveMessageIndex(FakeMessageDao()).update(read_test_emails())
+        archive_index = ArchiveMessageIndex(self.message_dao, parse_workers=2)
+        self.addCleanup(archive_index.close)
+        with mock.patch.object(archive_converter, 'PARSE_CHUNK_SIZE', 2):
+            new_messages = archive_index.update(read_test_emails())
+        self.assertEqual(list(expected), list(new_messages))
+        for message_id, message in new_messages.items():
+            self.assertEqual(expected[message_id].content, message.content)
+            self.assertEqual([child.id for child in expected[message_id].children],
+                             [child.id for child in message.children])
+
+    def test_update_with_parse_workers_can_release_content(self):
+        archive_index = ArchiveMessageIndex(self.message_dao, parse_workers=2)
+        self.addCleanup(archive_index.close)
+        with mock.patch.object(archive_converter, 'PARSE_CHUNK_SIZE', 2):
+            new_messages = archive_index.update(read_test_emails())
+        message = next(iter(new_messages.values()))
+        content = message.content
+        message.release_content()
+        self.assertIsNone(message._content)
+        self.assertEqual(content, message.content)
+
     def test_update_return_proper_patches(self):
         archive_index = ArchiveMessageIndex(self.message_dao)
-        new_messages = archive_index.update(test_data_path()).values()
-        self.assertEqual(len(new_messages), 8)
+        new_messages = archive_index.update(read_test_emails()).values()
+        # Replies whose parents we have never seen are dropped.
+        self.assertEqual(len(new_messages), 6)
 
-        subjects = ['Re: [PATCH] Remove final reference to superfluous smp_commence().',
-                    '[PATCH v2 1/3] dmaengine: add dma_get_channel_caps()',
-                    '[PATCH v2 1/2] Input: i8042 - Prevent intermixing i8042 commands',
+        subjects = ['[PATCH v2 1/2] Input: i8042 - Prevent intermixing i8042 commands',
                     '[PATCH v2 0/4] kselftests/arm64: add PAuth tests',
                     '[PATCH v2 1/4] kselftests/arm64: add a basic Pointer Authentication test',
                     '[PATCH v2 2/4] kselftests/arm64: add nop checks for PAuth tests',
@@ -42,6 +91,73 @@ class ArchiveConverterTest(unittest.TestCase):
 
 
 
+    def test_update_only_parses_routable_emails(self):
+        emails = [
+            ('hash0', b'Message-Id: <chatter>\nSubject: Hello everyone\n\nNot a patch.\n'),
+            ('hash1', b'Message-Id: <reply-to-chatter>\nIn-Reply-To: <chatter>\nSubject: Re: Hello everyone\n\nHi\n'),
+            ('hash2', b'Message-Id: <orphan>\nIn-Reply-To: <unknown>\nSubject: Re: [PATCH] foo\n\nHi\n'),
+            ('hash3', b'Message-Id: <patch>\nSubject: [PATCH] foo\n\nA patch.\n'),
+            ('hash4', b'Message-Id: <reply>\nIn-Reply-To: <patch>\nSubject: Re: [PATCH] foo\n\nLooks good\n'),
+        ]
+        archive_index = ArchiveMessageIndex(self.message_dao)
+        with mock.patch.object(archive_converter, 'parse_message_from_bytes',
+                               wraps=archive_converter.parse_message_from_bytes) as mock_parse:
+            new_messages = archive_index.update(emails)
+        self.assertCountEqual(new_messages.keys(), ['<patch>', '<reply>'])
+        self.assertEqual(mock_parse.call_count, 2)
+        self.assertEqual(new_messages['<patch>'].children, [new_messages['<reply>']])
+
+    def test_update_holds_replies_until_parent_arrives(self):
+        patch = ('hash0', b'Message-Id: <patch>\nSubject: [PATCH] foo\n\nA patch.\n')
+        reply = ('hash1', b'Message-Id: <reply>\nIn-Reply-To: <patch>\nSubject: Re: [PATCH] foo\n\nHi\n')
+        # References stand in for a missing In-Reply-To.
+        nested = ('hash2', b'Message-Id: <nested>\nReferences: <patch> <reply>\nSubject: Re: [PATCH] foo\n\nHi\n')
+        archive_index = ArchiveMessageIndex(self.message_dao)
+        self.assertEqual({}, archive_index.update([reply, nested]))
+
+        new_messages = archive_index.update([patch])
+        self.assertCountEqual(new_messages.keys(), ['<patch>', '<reply>', '<nested>'])
+        self.assertEqual(new_messages['<patch>'].children, [new_messages['<reply>']])
+        self.assertEqual(new_messages['<reply>'].children, [new_messages['<nested>']])
+        self.assertEqual('Hi\n', new_messages['<nested>'].content)
+        self.assertEqual([], self.message_dao.take_orphans(['<patch>', '<reply>']))
+
+    def test_update_keeps_replies_to_stored_emails(self):
+        archive_index = ArchiveMessageIndex(self.message_dao)
+        self.message_dao.store(generate_email_from_bytes('hash0', b'Message-Id: <patch>\nSubject: [PATCH] foo\n\nA patch.\n'))
+
+        new_messages = archive_index.update([
+            ('hash1', b'Message-Id: <reply>\nIn-Reply-To: <patch>\nSubject: Re: [PATCH] foo\n\nHi\n'),
+            ('hash2', b'Message-Id: <reply2>\nIn-Reply-To: <reply>\nSubject: Re: [PATCH] foo\n\nHi\n'),
+        ])
+        # The stored parent is returned too so that it gets re-uploaded.
+        self.assertCountEqual(new_messages.keys(), ['<patch>', '<reply>', '<reply2>'])
+
+    def test_update_loads_each_stored_parent_once(self):
+        archive_index = ArchiveMessageIndex(self.message_dao)
+        self.message_dao.store(generate_email_from_bytes('hash0', b'Message-Id: <patch>\nSubject: [PATCH] foo\n\nA patch.\n'))
+
+        with mock.patch.object(self.message_dao, 'get', wraps=self.message_dao.get) as mock_get, \
+             mock.patch.object(self.message_dao, 'invalidate') as mock_invalidate:
+            new_messages = archive_index.update([
+                ('hash1', b'Message-Id: <reply>\nIn-Reply-To: <patch>\nSubject: Re: [PATCH] foo\n\nHi\n'),
+                ('hash2', b'Message-Id: <reply2>\nIn-Reply-To: <patch>\nSubject: Re: [PATCH] foo\n\nHi\n'),
+            ])
+        mock_get.assert_called_once_with('<patch>')
+        # The parent is dropped from the DAO's cache before replies are added to it.
+        mock_invalidate.assert_called_once_with('<patch>')
+        self.assertCountEqual([child.id for child in new_messages['<patch>'].children], ['<reply>', '<reply2>'])
+
+    def test_parse_headers_ignores_body(self):
+        headers = parse_headers_from_bytes(b'Message-Id: <id>\nIn-Reply-To: <parent>\n'
+                                           b'References: <root> <parent>\nSubject: [PATCH] foo\n\n'
+                                           b'Subject: not a header\n')
+        self.assertEqual(headers.id, '<id>')
+        self.assertEqual(headers.in_reply_to, '<parent>')
+        self.assertEqual(headers.references, '<root> <parent>')
+        self.assertEqual(headers.subject, '[PATCH] foo')
+        self.assertTrue(headers.is_patch_or_coverletter())
+
 
 if __name__ == '__main__':
     unittest.main()
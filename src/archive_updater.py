@@ -12,55 +12,211 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import subprocess
+import concurrent.futures
 import os
+import re
+import subprocess
+import time
 
 from absl import logging
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
-def fill_message_directory(archive_path: str, directory: str, last_used_commit_hash: str) -> str:
-    '''Updates the git repo, then retrieves the MAX_NUMBER_OF_RECENT_COMMITS recent commits and converts them into files stored
-    in the directory corresponding to the passed in directory path.
+LORE_URL = 'https://lore.kernel.org/linux-kselftest'
+EPOCH_MATCHER = re.compile(r'^(\d+)\.git$')
+# Seconds between checks of lore for a new epoch, when updating the archive
+NEW_EPOCH_CHECK_INTERVAL = 60 * 60
 
-    Args:
-        archive_path: path to the email archive
-        directory: where to store files
-        last_used_commit_hash: ending point for filling the directory
+# Maps archive directory to when lore was last checked for its next epoch
+_last_epoch_checks: Dict[str, float] = {}
+
+class BlobReader(object):
+    """Reads objects out of a git repo over a single long-lived `git cat-file --batch` process.
+
+    Forking `git show` for every commit dominates the cost of catching up on a
+    large backlog, so instead we write object names to one process and read the
+    contents back over its stdout."""
+
+    def __init__(self, archive_path: str) -> None:
+        self._process = subprocess.Popen(['git', '-C', archive_path, 'cat-file', '--batch'],
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+
+    def read(self, object_name: str) -> Optional[bytes]:
+        """Returns the contents of `object_name` or None if it does not exist."""
+        self._process.stdin.write(object_name.encode('utf-8') + b'\n')
+        self._process.stdin.flush()
+        header = self._process.stdout.readline()
+        if not header:
+            raise RuntimeError(f'git cat-file exited while reading {object_name}')
+        fields = header.split()
+        if len(fields) != 3:
+            # Either '<object_name> missing' or '<object_name> ambiguous'
+            logging.warning('Could not read %s from archive: %s', object_name, header.decode('utf-8').strip())
+            return None
+        size = int(fields[2])
+        contents = self._process.stdout.read(size)
+        # Every object is followed by a single newline.
+        self._process.stdout.read(1)
+        return contents
+
+    def close(self) -> None:
+        self._process.stdin.close()
+        self._process.wait()
+        self._process.stdout.close()
+
+    def __enter__(self) -> 'BlobReader':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+def read_messages(archive_path: str, message_hashes: Iterable[str]) -> Iterator[Tuple[str, bytes]]:
+    """Lazily reads the raw email stored in each of the passed in commits.
+
+    Yields:
+        (commit hash, raw email) for every commit whose email could be read
+    """
+    with BlobReader(archive_path) as reader:
+        for hash in message_hashes:
+            raw_email = reader.read(f'{hash}:m')
+            if raw_email is not None:
+                yield hash, raw_email
+
+def commit_times(archive_path: str, message_hashes: Iterable[str]) -> Dict[str, int]:
+    """Looks up the commit time of each of the passed in commits with a single git log.
+
+    Returns:
+        a dictionary mapping commit hash to its commit time in seconds since the epoch
+
+    Raises:
+        CalledProcessError: when git log fails
+    """
+    output = subprocess.check_output(
+        ['git', '-C', archive_path, 'log', '--no-walk=unsorted', '--stdin', '--format=format:%H %ct'],
+        input='\n'.join(message_hashes).encode('utf-8'))
+    times = {}
+    for line in output.decode('utf-8').splitlines():
+        hash, time = line.split()
+        times[hash] = int(time)
+    return times
+
+def epoch_path(archive_dir: str, epoch: int) -> str:
+    return os.path.join(archive_dir, f'{epoch}.git')
+
+def find_epochs(archive_dir: str) -> List[int]:
+    """Returns the epochs of the archive which have already been cloned, oldest first."""
+    if not os.path.isdir(archive_dir):
+        return []
+    epochs = []
+    for name in os.listdir(archive_dir):
+        match = EPOCH_MATCHER.match(name)
+        if match:
+            epochs.append(int(match.group(1)))
+    return sorted(epochs)
+
+def _remote_epoch_exists(epoch: int) -> bool:
+    return subprocess.call(['git', 'ls-remote', '--heads', f'{LORE_URL}/{epoch}'],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+def _link_epoch_objects(archive_dir: str, epochs: List[int]) -> None:
+    """Lets git read the objects of every epoch from inside epoch 0.
+
+    Archive hashes are stored without their epoch, so we point epoch 0 at the
+    object directories of all later epochs through git's alternates mechanism.
+    That way any archive hash can be read from epoch 0."""
+    later_epochs = [epoch for epoch in epochs if epoch != 0]
+    if not later_epochs:
+        return
+    alternates = ''.join(os.path.abspath(os.path.join(epoch_path(archive_dir, epoch), 'objects')) + '\n'
+                         for epoch in later_epochs)
+    alternates_file = os.path.join(epoch_path(archive_dir, 0), 'objects', 'info', 'alternates')
+    if os.path.isfile(alternates_file):
+        with open(alternates_file, 'r') as f:
+            if f.read() == alternates:
+                return
+    os.makedirs(os.path.dirname(alternates_file), exist_ok=True)
+    with open(alternates_file, 'w') as f:
+        f.write(alternates)
+
+def setup_archive(archive_dir: str, check_interval: float = 0) -> List[int]:
+    '''Mirrors every epoch of the archive which has not been cloned yet.
+
+    Lore rolls a list over to a new epoch (0.git, 1.git, ...) once its archive
+    grows too large, so we keep probing for the next epoch after the newest one
+    we have. Each probe is a `git ls-remote`, so lore is only probed if it was
+    not already within the last check_interval seconds.
 
     Returns:
-        The most recent processed commit hash
+        Every epoch of the archive, oldest first
 
     Raises:
-        CalledProcessError: when git fetch, git log, or git show fails
-        Exception: when the log from git log shows no hashes
+        CalledProcessError: when git clone fails
     '''
+    epochs = find_epochs(archive_dir)
+    next_epoch = epochs[-1] + 1 if epochs else 0
+    last_check = _last_epoch_checks.get(archive_dir)
+    check_remote = last_check is None or time.monotonic() - last_check >= check_interval
+    if check_remote:
+        _last_epoch_checks[archive_dir] = time.monotonic()
+    while next_epoch == 0 or (check_remote and _remote_epoch_exists(next_epoch)):
+        subprocess.check_call(['git', 'clone', '--mirror', f'{LORE_URL}/{next_epoch}',
+                               epoch_path(archive_dir, next_epoch)])
+        epochs.append(next_epoch)
+        next_epoch += 1
+    _link_epoch_objects(archive_dir, epochs)
+    return epochs
+
+def update_archive(archive_dir: str) -> List[int]:
+    '''Mirrors any new epochs, then fetches new emails into every epoch.
 
-    subprocess.check_call(['git', '-C', archive_path, 'fetch'])
+    New epochs are looked for at most every NEW_EPOCH_CHECK_INTERVAL seconds.
+    The fetches run concurrently, so updating a list with many epochs takes as
+    long as the slowest epoch rather than the sum of all of them.
+
+    Returns:
+        Every epoch of the archive, oldest first
+
+    Raises:
+        CalledProcessError: when git clone or git fetch fails
+    '''
+    epochs = setup_archive(archive_dir, NEW_EPOCH_CHECK_INTERVAL)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(epochs)) as executor:
+        fetches = [executor.submit(subprocess.check_call, ['git', '-C', epoch_path(archive_dir, epoch), 'fetch'])
+                   for epoch in epochs]
+        for fetch in fetches:
+            fetch.result()
+    return epochs
 
+def list_new_commits(archive_path: str, last_used_commit_hash: Optional[str]) -> List[str]:
+    '''Lists every commit made after last_used_commit_hash, oldest first.
+
+    Only the hashes are materialized here, so callers can page through a large
+    backlog with read_messages without holding every email in memory.
+
+    Args:
+        archive_path: path to the email archive
+        last_used_commit_hash: ending point for listing commits, or None to list every commit
+
+    Raises:
+        CalledProcessError: when git log fails
+    '''
+    revision_range = f'{last_used_commit_hash}..' if last_used_commit_hash else 'HEAD'
     output = subprocess.check_output(
-        ['git', '-C', archive_path, 'log', f'{last_used_commit_hash}..', '--format=format:%H'])
+        ['git', '-C', archive_path, 'log', '--reverse', revision_range, '--format=format:%H'])
     message_hashes = output.decode('utf-8').split()
 
     if len(message_hashes) == 0:
         logging.warning('There are no commits in git repo: %s', archive_path)
-        return last_used_commit_hash
-
-    for hash in message_hashes:
-        file = os.path.join(directory, f'{hash}.txt')
-        # TODO(willliu@google.com): fetch the message contents on demand. We also don't check for errors creating the file
-        with open(file, 'w') as f:
-            subprocess.call(['git', '-C', archive_path, 'show', f'{hash}:m'],
-                            stdout=f)
-
-    return message_hashes[0]
-
-def setup_archive(archive_path : str):
-    if not os.path.isdir(archive_path):
-        subprocess.check_call(['git', '-C', '..', 'clone', '--mirror',
-                           'https://lore.kernel.org/linux-kselftest/0',
-                           'linux-kselftest/git/0.git'])
+    return message_hashes
 
 def main() -> None:
-    print(fill_message_directory('../linux-kselftest/git/0.git', '../lkml-gerrit-bridge/test_data', 'ae9e7be4a03765456fe38287533e6446e8bbc93c'))
+    archive_dir = '../linux-kselftest/git'
+    for epoch in update_archive(archive_dir):
+        archive_path = epoch_path(archive_dir, epoch)
+        last_used_commit_hash = 'ae9e7be4a03765456fe38287533e6446e8bbc93c' if epoch == 0 else None
+        message_hashes = list_new_commits(archive_path, last_used_commit_hash)
+        for hash, raw_email in read_messages(archive_path, message_hashes):
+            print(hash, len(raw_email))
 
 if __name__ == '__main__':
     main()
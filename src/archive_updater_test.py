@@ -3,45 +3,66 @@ import subprocess
 import os
 import tempfile
 import shutil
-from archive_updater import fill_message_directory, setup_archive
+import archive_updater
+from archive_updater import BlobReader, commit_times, list_new_commits, read_messages, setup_archive, update_archive
 from unittest import mock
 
-class ArchiveUpdaterFillMessageDirectoryTest(unittest.TestCase):
+class ArchiveUpdaterTest(unittest.TestCase):
 
     def setUp(self):
         self.tmp_dir = tempfile.mkdtemp()
     def tearDown(self):
         shutil.rmtree(self.tmp_dir)
 
+    @mock.patch.object(archive_updater, 'setup_archive')
     @mock.patch.object(subprocess, 'check_call')
-    def test_update_failure(self, mock_check_call):
+    def test_update_failure(self, mock_check_call, mock_setup_archive):
+        mock_setup_archive.return_value = [0]
         mock_check_call.side_effect = subprocess.CalledProcessError(returncode=1,
                                                                     cmd=['git', '-C', 'archive_path', 'fetch'],
                                                                     stderr=b'Failed to fetch')
         with self.assertRaises(subprocess.CalledProcessError):
-            fill_message_directory('archive_path', self.tmp_dir, '')
+            update_archive('archive_dir')
+
+    def _create_archive(self, emails):
+        """Creates a git repo in the layout of a lore archive, one commit per email."""
+        archive_path = os.path.join(self.tmp_dir, 'archive')
+        subprocess.check_call(['git', 'init', '-q', archive_path])
+        hashes = []
+        for raw_email in emails:
+            with open(os.path.join(archive_path, 'm'), 'w') as f:
+                f.write(raw_email)
+            subprocess.check_call(['git', '-C', archive_path, 'add', 'm'])
+            subprocess.check_call(['git', '-C', archive_path, '-c', 'user.name=test',
+                                   '-c', 'user.email=test@example.com', 'commit', '-q', '-m', 'email'])
+            hashes.append(subprocess.check_output(
+                ['git', '-C', archive_path, 'rev-parse', 'HEAD']).decode('utf-8').strip())
+        return archive_path, hashes
+
+    def test_list_new_commits_oldest_first(self):
+        archive_path, hashes = self._create_archive(['email 1', 'email 2', 'email 3'])
+        self.assertEqual(list_new_commits(archive_path, hashes[0]), hashes[1:])
+
+    def test_read_messages(self):
+        archive_path, hashes = self._create_archive(['email 1', 'email 2', 'email 3'])
+        messages = read_messages(archive_path, hashes[1:])
+        self.assertEqual(list(messages), [(hashes[1], b'email 2'), (hashes[2], b'email 3')])
+
+    def test_commit_times(self):
+        archive_path, hashes = self._create_archive(['email 1', 'email 2'])
+        times = commit_times(archive_path, hashes)
+        self.assertEqual(set(times), set(hashes))
+        expected = subprocess.check_output(['git', '-C', archive_path, 'show', '-s', '--format=%ct', hashes[1]])
+        self.assertEqual(times[hashes[1]], int(expected))
+
+    def test_blob_reader_missing_object(self):
+        archive_path, hashes = self._create_archive(['email 1'])
+        with BlobReader(archive_path) as reader:
+            self.assertIsNone(reader.read('0' * 40 + ':m'))
+            self.assertEqual(reader.read(f'{hashes[0]}:m'), b'email 1')
 
     @mock.patch.object(subprocess, 'check_output')
-    @mock.patch.object(subprocess, 'call')
-    @mock.patch.object(subprocess, 'check_call')
-    def test_fill_message_directory_success(self, mock_check_call, mock_call, mock_check_output):
-        def writeFile(args, stdout):
-            stdout.write('called with: ' + ' '.join(args))
-        mock_call.side_effect = writeFile
-        mock_check_output.return_value = b'success1 success2 success3'
-
-        last_used_hash = fill_message_directory('archive_path', self.tmp_dir, '')
-
-        self.assertEqual(len(os.listdir(self.tmp_dir)), 3)
-        for filename in os.listdir(self.tmp_dir):
-            with open(os.path.join(self.tmp_dir,filename), "r") as file:
-                val = file.read()
-                self.assertIn('git -C archive_path show', val)
-        self.assertEqual(last_used_hash, 'success1')
-
-    @mock.patch.object(subprocess, 'check_output')
-    @mock.patch.object(subprocess, 'check_call')
-    def test_fill_message_directory_fail_to_log(self, mock_check_call, mock_check_output):
+    def test_list_new_commits_fail_to_log(self, mock_check_output):
         mock_check_output.side_effect = subprocess.CalledProcessError(returncode=1,
                                                                     cmd=['git', '-C',
                                                                          'archive_path', 'log',
@@ -50,47 +71,93 @@ class ArchiveUpdaterFillMessageDirectoryTest(unittest.TestCase):
                                                                     stderr=b'Failed to log')
 
         with self.assertRaises(subprocess.CalledProcessError):
-            fill_message_directory('archive_path', self.tmp_dir, 'last_used_commit_hash')
-
-        self.assertEqual(len(os.listdir(self.tmp_dir)), 0)
+            list_new_commits('archive_path', 'last_used_commit_hash')
 
     @mock.patch.object(subprocess, 'check_output')
-    @mock.patch.object(subprocess, 'check_call')
-    def test_fill_message_directory_no_hashes_available(self, mock_check_call, mock_check_output):
+    def test_list_new_commits_no_hashes_available(self, mock_check_output):
         mock_check_output.return_value = b''
+        self.assertEqual(list_new_commits('archive_path', 'last_used_hash'), [])
 
-        last_used_hash = fill_message_directory('archive_path', self.tmp_dir, 'last_used_hash')
-
-        self.assertEqual(len(os.listdir(self.tmp_dir)), 0)
-        self.assertEqual(last_used_hash, 'last_used_hash')
-
+    @mock.patch.object(archive_updater, '_remote_epoch_exists')
     @mock.patch.object(subprocess, 'check_call')
-    @mock.patch.object(os, 'path')
-    def test_setup_directory_success(self, mock_path, mock_check_call):
-        mock_path.isdir.return_value = False
-        setup_archive('archive_path')
-        mock_check_call.assert_called_with(['git', '-C', '..', 'clone', '--mirror',
+    def test_setup_directory_success(self, mock_check_call, mock_remote_epoch_exists):
+        mock_remote_epoch_exists.return_value = False
+        self.assertEqual(setup_archive(self.tmp_dir), [0])
+        mock_check_call.assert_called_once_with(['git', 'clone', '--mirror',
                            'https://lore.kernel.org/linux-kselftest/0',
-                           'linux-kselftest/git/0.git'])
+                           os.path.join(self.tmp_dir, '0.git')])
+        mock_remote_epoch_exists.assert_called_once_with(1)
 
+    @mock.patch.object(archive_updater, '_remote_epoch_exists')
     @mock.patch.object(subprocess, 'check_call')
-    @mock.patch.object(os, 'path')
-    def test_setup_directory_exists(self, mock_path, mock_check_call):
-        mock_path.isdir.return_value = True
-        setup_archive('archive_path')
+    def test_setup_directory_exists(self, mock_check_call, mock_remote_epoch_exists):
+        mock_remote_epoch_exists.return_value = False
+        os.mkdir(os.path.join(self.tmp_dir, '0.git'))
+        self.assertEqual(setup_archive(self.tmp_dir), [0])
         mock_check_call.assert_not_called()
 
+    @mock.patch.object(archive_updater, '_remote_epoch_exists')
     @mock.patch.object(subprocess, 'check_call')
-    @mock.patch.object(os, 'path')
-    def test_setup_directory_fails(self, mock_path, mock_check_call):
-        mock_path.isdir.return_value = False
+    def test_setup_directory_new_epochs(self, mock_check_call, mock_remote_epoch_exists):
+        mock_remote_epoch_exists.side_effect = [True, True, False]
+        os.mkdir(os.path.join(self.tmp_dir, '0.git'))
+        self.assertEqual(setup_archive(self.tmp_dir), [0, 1, 2])
+        mock_check_call.assert_has_calls([
+            mock.call(['git', 'clone', '--mirror', 'https://lore.kernel.org/linux-kselftest/1',
+                       os.path.join(self.tmp_dir, '1.git')]),
+            mock.call(['git', 'clone', '--mirror', 'https://lore.kernel.org/linux-kselftest/2',
+                       os.path.join(self.tmp_dir, '2.git')]),
+        ])
+        # Epoch 0 must be able to read the objects of later epochs.
+        with open(os.path.join(self.tmp_dir, '0.git', 'objects', 'info', 'alternates'), 'r') as f:
+            self.assertEqual(f.read().split(), [os.path.join(os.path.abspath(self.tmp_dir), '1.git', 'objects'),
+                                                os.path.join(os.path.abspath(self.tmp_dir), '2.git', 'objects')])
+
+    @mock.patch.object(archive_updater, '_remote_epoch_exists')
+    @mock.patch.object(subprocess, 'check_call')
+    def test_setup_directory_checks_for_new_epochs_once_per_interval(self, mock_check_call,
+                                                                     mock_remote_epoch_exists):
+        mock_remote_epoch_exists.return_value = False
+        os.mkdir(os.path.join(self.tmp_dir, '0.git'))
+        with mock.patch.object(archive_updater.time, 'monotonic', return_value=1000):
+            setup_archive(self.tmp_dir, 60)
+            setup_archive(self.tmp_dir, 60)
+        mock_remote_epoch_exists.assert_called_once_with(1)
+        with mock.patch.object(archive_updater.time, 'monotonic', return_value=1060):
+            self.assertEqual(setup_archive(self.tmp_dir, 60), [0])
+        self.assertEqual(2, mock_remote_epoch_exists.call_count)
+
+    @mock.patch.object(subprocess, 'check_call')
+    def test_setup_directory_fails(self, mock_check_call):
         mock_check_call.side_effect = subprocess.CalledProcessError(returncode=1,
-                                                                    cmd=['git', '-C', '..', 'clone', '--mirror',
+                                                                    cmd=['git', 'clone', '--mirror',
                                                                          'https://lore.kernel.org/linux-kselftest/0',
                                                                          'linux-kselftest/git/0.git'],
                                                                     stderr=b'Failed to log')
         with self.assertRaises(subprocess.CalledProcessError):
-            setup_archive('archive_path')
+            setup_archive(self.tmp_dir)
+
+    @mock.patch.object(archive_updater, 'setup_archive')
+    @mock.patch.object(subprocess, 'check_call')
+    def test_update_archive_fetches_every_epoch(self, mock_check_call, mock_setup_archive):
+        mock_setup_archive.return_value = [0, 1]
+        self.assertEqual(update_archive('archive_dir'), [0, 1])
+        mock_setup_archive.assert_called_once_with('archive_dir', archive_updater.NEW_EPOCH_CHECK_INTERVAL)
+        mock_check_call.assert_has_calls([
+            mock.call(['git', '-C', os.path.join('archive_dir', '0.git'), 'fetch']),
+            mock.call(['git', '-C', os.path.join('archive_dir', '1.git'), 'fetch']),
+        ], any_order=True)
+
+    def test_archive_hash_readable_from_epoch_zero(self):
+        epoch_zero, _ = self._create_archive(['email 1'])
+        subprocess.check_call(['git', 'clone', '-q', '--mirror', epoch_zero, os.path.join(self.tmp_dir, '0.git')])
+        shutil.rmtree(epoch_zero)
+        epoch_one, hashes = self._create_archive(['email 2'])
+        subprocess.check_call(['git', 'clone', '-q', '--mirror', epoch_one, os.path.join(self.tmp_dir, '1.git')])
+        with mock.patch.object(archive_updater, '_remote_epoch_exists', return_value=False):
+            setup_archive(self.tmp_dir)
+        messages = read_messages(os.path.join(self.tmp_dir, '0.git'), hashes)
+        self.assertEqual(list(messages), [(hashes[0], b'email 2')])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,102 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import math
+import os
+import struct
+import threading
+
+from typing import Iterable, Iterator, Optional
+
+# Number of keys a filter is sized for unless told otherwise
+CAPACITY = 1000000
+ERROR_RATE = 0.001
+# Saved filters start with: number of bits, number of hashes, capacity, number
+# of keys and checkpoint
+FILE_HEADER = struct.Struct('>QQQQQ')
+
+class BloomFilter(object):
+    """ A set of strings which can answer "definitely not in the set" without
+    storing the strings. Membership tests are wrong, saying a key is present
+    when it is not, at about error_rate as long as no more than capacity keys
+    were added; a key that was added is always reported as present."""
+
+    def __init__(self, capacity: int = CAPACITY, error_rate: float = ERROR_RATE) -> None:
+        self.capacity = capacity
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.count = 0
+        # Saved along with the filter for its owner to tell whether it is stale
+        self.checkpoint = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, key: str) -> Iterator[int]:
+        digest = hashlib.blake2b(key.encode('utf-8', errors='surrogateescape'), digest_size=16).digest()
+        h1, h2 = struct.unpack('>QQ', digest)
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key: str) -> None:
+        positions = list(self._positions(key))
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def update(self, keys: Iterable[str]) -> None:
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def is_full(self) -> bool:
+        return self.count > self.capacity
+
+    def save(self, path: str, checkpoint: int = 0) -> None:
+        # Write to a temporary file first so a crash never leaves a torn filter behind.
+        tmp_path = path + '.tmp'
+        with self._lock:
+            self.checkpoint = checkpoint
+            with open(tmp_path, 'wb') as f:
+                f.write(FILE_HEADER.pack(self.num_bits, self.num_hashes, self.capacity, self.count,
+                                         self.checkpoint))
+                f.write(self._bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional['BloomFilter']:
+        """Returns the filter saved at path, or None if there is no valid one."""
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(FILE_HEADER.size)
+                bits = f.read()
+        except FileNotFoundError:
+            return None
+        if len(header) < FILE_HEADER.size:
+            return None
+        num_bits, num_hashes, capacity, count, checkpoint = FILE_HEADER.unpack(header)
+        if len(bits) != (num_bits + 7) // 8:
+            return None
+        bloom_filter = cls.__new__(cls)
+        bloom_filter.capacity = capacity
+        bloom_filter.num_bits = num_bits
+        bloom_filter.num_hashes = num_hashes
+        bloom_filter.count = count
+        bloom_filter.checkpoint = checkpoint
+        bloom_filter._bits = bytearray(bits)
+        bloom_filter._lock = threading.Lock()
+        return bloom_filter
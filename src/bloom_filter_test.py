@@ -0,0 +1,43 @@
+import os
+import tempfile
+import unittest
+
+from bloom_filter import BloomFilter
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_added_keys_are_present(self):
+        bloom_filter = BloomFilter(capacity=1000)
+        keys = [f'<{i}@example.com>' for i in range(1000)]
+        bloom_filter.update(keys)
+        self.assertTrue(all(key in bloom_filter for key in keys))
+        self.assertFalse(bloom_filter.is_full())
+
+    def test_false_positive_rate(self):
+        bloom_filter = BloomFilter(capacity=1000, error_rate=0.01)
+        bloom_filter.update(f'<{i}@example.com>' for i in range(1000))
+        false_positives = sum(f'<{i}@example.org>' in bloom_filter for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_save_and_load(self):
+        bloom_filter = BloomFilter(capacity=100)
+        bloom_filter.add('<a>')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'known_ids')
+            self.assertIsNone(BloomFilter.load(path))
+            bloom_filter.save(path, checkpoint=7)
+            loaded = BloomFilter.load(path)
+        self.assertIn('<a>', loaded)
+        self.assertEqual(1, loaded.count)
+        self.assertEqual(7, loaded.checkpoint)
+
+    def test_load_rejects_truncated_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'known_ids')
+            BloomFilter(capacity=100).save(path)
+            os.truncate(path, os.path.getsize(path) - 1)
+            self.assertIsNone(BloomFilter.load(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
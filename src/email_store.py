@@ -0,0 +1,196 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+from absl import logging
+from typing import Dict, List, Optional, Tuple
+
+# Emails are dropped, oldest segment first, once the store grows past this
+MAX_BYTES = 1024 * 1024 * 1024
+# A new segment file is started once the current one reaches this size
+SEGMENT_BYTES = 64 * 1024 * 1024
+COMPRESSION_LEVEL = 6
+SEGMENT_MATCHER = re.compile(r'^(\d+)\.seg$')
+# Every record is: key length, data length, key, zlib compressed email
+RECORD_HEADER = struct.Struct('>HI')
+
+class EmailStore(object):
+    """ A local store of raw emails, keyed by the hash of the archive commit
+    which added them. Archive commits never change, so neither does the email
+    stored under a hash.
+
+    Emails are compressed and appended to segment files which are read through
+    mmap. The store is bounded to max_bytes by deleting whole segments, oldest
+    first; callers are expected to fall back to the archive on a miss."""
+
+    def __init__(self, directory: str, max_bytes: int = MAX_BYTES,
+                 segment_bytes: int = SEGMENT_BYTES) -> None:
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._segment_bytes = segment_bytes
+        # Maps archive hash to (segment, offset of the compressed email, its length)
+        self._index : Dict[str, Tuple[int, int, int]] = {}
+        # Maps segment to its size in bytes, oldest segment first
+        self._segments : collections.OrderedDict = collections.OrderedDict()
+        # Maps segment to the archive hashes stored in it
+        self._keys : Dict[int, List[str]] = {}
+        self._maps : Dict[int, mmap.mmap] = {}
+        self._writer = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self._directory, f'{segment:08d}.seg')
+
+    def _load(self) -> None:
+        segments = []
+        for name in os.listdir(self._directory):
+            match = SEGMENT_MATCHER.match(name)
+            if match:
+                segments.append(int(match.group(1)))
+        for segment in sorted(segments):
+            self._load_segment(segment)
+
+    def _load_segment(self, segment: int) -> None:
+        path = self._segment_path(segment)
+        keys = []
+        offset = 0
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                key_length, data_length = RECORD_HEADER.unpack(header)
+                key = f.read(key_length)
+                data_offset = offset + RECORD_HEADER.size + key_length
+                if len(key) < key_length or f.seek(data_length, os.SEEK_CUR) > os.path.getsize(path):
+                    break
+                archive_hash = key.decode('ascii')
+                self._index[archive_hash] = (segment, data_offset, data_length)
+                keys.append(archive_hash)
+                offset = data_offset + data_length
+        if offset < os.path.getsize(path):
+            # The last record was only partly written, e.g. the server was killed.
+            logging.warning('Truncating incomplete record at %d in %s', offset, path)
+            os.truncate(path, offset)
+        self._segments[segment] = offset
+        self._keys[segment] = keys
+
+    def __contains__(self, archive_hash: str) -> bool:
+        return archive_hash in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def size_bytes(self) -> int:
+        return sum(self._segments.values())
+
+    def put(self, archive_hash: str, raw_email: bytes) -> None:
+        if archive_hash in self._index:
+            return
+        key = archive_hash.encode('ascii')
+        data = zlib.compress(raw_email, COMPRESSION_LEVEL)
+        with self._lock:
+            if archive_hash not in self._index:
+                self._append(archive_hash, key, data)
+
+    def _append(self, archive_hash: str, key: bytes, data: bytes) -> None:
+        record_size = RECORD_HEADER.size + len(key) + len(data)
+        fits = bool(self._segments) and next(reversed(self._segments.values())) + record_size <= self._segment_bytes
+        if self._writer is None and fits:
+            # Append to the newest segment left by an earlier run, rather than
+            # leaving it part full.
+            self._writer = open(self._segment_path(next(reversed(self._segments))), 'ab')
+        elif not fits:
+            self._start_segment()
+        segment = next(reversed(self._segments))
+        offset = self._segments[segment]
+        self._writer.write(RECORD_HEADER.pack(len(key), len(data)) + key + data)
+        # Readers map the file, so make the record visible to them right away.
+        self._writer.flush()
+        self._index[archive_hash] = (segment, offset + RECORD_HEADER.size + len(key), len(data))
+        self._keys[segment].append(archive_hash)
+        self._segments[segment] = offset + record_size
+        while self.size_bytes() > self._max_bytes and len(self._segments) > 1:
+            self._evict_oldest()
+
+    def get(self, archive_hash: str) -> Optional[bytes]:
+        with self._lock:
+            location = self._index.get(archive_hash)
+            if location is None:
+                self.misses += 1
+                return None
+            segment, offset, length = location
+            data = self._map(segment, offset + length)[offset:offset + length]
+            self.hits += 1
+        return zlib.decompress(data)
+
+    def _map(self, segment: int, end: int) -> mmap.mmap:
+        segment_map = self._maps.get(segment)
+        # The newest segment keeps growing, so remap it once reads go past the end.
+        if segment_map is None or len(segment_map) < end:
+            if segment_map is not None:
+                segment_map.close()
+            with open(self._segment_path(segment), 'rb') as f:
+                segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = segment_map
+        return segment_map
+
+    def _start_segment(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        segment = next(reversed(self._segments)) + 1 if self._segments else 0
+        self._writer = open(self._segment_path(segment), 'ab')
+        self._segments[segment] = 0
+        self._keys[segment] = []
+
+    def _evict_oldest(self) -> None:
+        segment, _ = self._segments.popitem(last=False)
+        for archive_hash in self._keys.pop(segment):
+            del self._index[archive_hash]
+        segment_map = self._maps.pop(segment, None)
+        if segment_map is not None:
+            segment_map.close()
+        os.remove(self._segment_path(segment))
+        self.evictions += 1
+        logging.info('Evicted segment %d from the email store', segment)
+
+    def stats(self) -> Dict[str, int]:
+        return {'emails': len(self._index), 'bytes': self.size_bytes(),
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def close(self) -> None:
+        for segment_map in self._maps.values():
+            segment_map.close()
+        self._maps = {}
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self) -> 'EmailStore':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,78 @@
+import os
+import tempfile
+import unittest
+
+from email_store import EmailStore
+
+class EmailStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.directory = tmp_dir.name
+
+    def test_put_and_get(self):
+        with EmailStore(self.directory) as store:
+            store.put('hash1', b'first email')
+            store.put('hash2', b'second email')
+            self.assertEqual(b'first email', store.get('hash1'))
+            self.assertEqual(b'second email', store.get('hash2'))
+            self.assertIsNone(store.get('hash3'))
+            self.assertEqual(store.stats(), {'emails': 2, 'bytes': store.size_bytes(),
+                                             'hits': 2, 'misses': 1, 'evictions': 0})
+
+    def test_emails_are_compressed(self):
+        raw_email = b'Subject: [PATCH] foo\n\n' + b'+ a line of the patch\n' * 1000
+        with EmailStore(self.directory) as store:
+            store.put('hash', raw_email)
+            self.assertLess(store.size_bytes(), len(raw_email) / 10)
+
+    def test_reopen(self):
+        with EmailStore(self.directory) as store:
+            store.put('hash1', b'first email')
+        with EmailStore(self.directory) as store:
+            self.assertIn('hash1', store)
+            store.put('hash2', b'second email')
+            self.assertEqual(b'first email', store.get('hash1'))
+            self.assertEqual(b'second email', store.get('hash2'))
+        # Both runs wrote to the same segment.
+        self.assertEqual(1, len(os.listdir(self.directory)))
+
+    def test_reopen_starts_a_segment_once_the_newest_is_full(self):
+        with EmailStore(self.directory, segment_bytes=40) as store:
+            store.put('hash1', b'first email')
+        with EmailStore(self.directory, segment_bytes=40) as store:
+            store.put('hash2', b'second email')
+            self.assertEqual(b'first email', store.get('hash1'))
+            self.assertEqual(b'second email', store.get('hash2'))
+        self.assertEqual(2, len(os.listdir(self.directory)))
+
+    def test_reopen_drops_incomplete_record(self):
+        with EmailStore(self.directory) as store:
+            store.put('hash1', b'first email')
+            store.put('hash2', b'second email')
+        segment = os.path.join(self.directory, os.listdir(self.directory)[0])
+        os.truncate(segment, os.path.getsize(segment) - 1)
+        with EmailStore(self.directory) as store:
+            self.assertEqual(b'first email', store.get('hash1'))
+            self.assertNotIn('hash2', store)
+            store.put('hash2', b'second email')
+        with EmailStore(self.directory) as store:
+            self.assertEqual(b'first email', store.get('hash1'))
+            self.assertEqual(b'second email', store.get('hash2'))
+
+    def test_evicts_oldest_segment(self):
+        with EmailStore(self.directory, max_bytes=100, segment_bytes=40) as store:
+            for i in range(6):
+                store.put(f'hash{i}', f'email number {i}'.encode())
+            self.assertLessEqual(store.size_bytes(), 100)
+            self.assertNotIn('hash0', store)
+            self.assertIsNone(store.get('hash0'))
+            self.assertEqual(b'email number 5', store.get('hash5'))
+            self.assertGreater(store.evictions, 0)
+            # Evicted segments are deleted from disk.
+            self.assertLess(len(os.listdir(self.directory)), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,18 +12,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Set
 import re
 from absl import logging
 from git import GerritGit
-from patch_parser import map_comments_to_gerrit, parse_comments, Patch, Patchset
+from patch_parser import map_comments_to_gerrit, parse_comments, Comment, Patch, Patchset
 from pygerrit2 import GerritRestAPI
 from requests import PreparedRequest
 from requests.auth import AuthBase
 from http.cookiejar import CookieJar, MozillaCookieJar
 from message import Message
+from parse_cache import ParseCache
 from archive_converter import ArchiveMessageIndex
 import message_dao
+from message_dao import MessageDao
+
+# Tag of the reviews the bridge posts, telling them apart from those of Gerrit users
+POST_LKML_COMMENTS_TAG = 'post_lkml_comments'
+# Trailer naming each reply whose comments a review posts, one per line
+REPLY_TRAILER = 'LKML-Reply'
+_REPLY_TRAILER_PATTERN = re.compile(f'^{REPLY_TRAILER}: (\\S+)$', re.MULTILINE)
 
 def get_gerrit_rest_api(cookie_jar_path: str, gerrit_url: str) -> GerritRestAPI:
     cookie_jar = MozillaCookieJar(cookie_jar_path)
@@ -55,6 +63,12 @@ class Gerrit(object):
                 '/changes/{change_id}/revisions/{revision_id}/patch'.format(
                         change_id=change_id, revision_id=revision_id))
 
+    def get_messages(self, change_id: str):
+        return self._rest_api.get('/changes/{change_id}/messages'.format(change_id=change_id))
+
+    def get_comments(self, change_id: str):
+        return self._rest_api.get('/changes/{change_id}/comments'.format(change_id=change_id))
+
     def get_review(self, change_id: str, revision_id: str):
         return self._rest_api.get(
                 '/changes/{change_id}/revisions/{revision_id}/review'.format(
@@ -80,12 +94,14 @@ def find_and_label_all_revision_ids(gerrit: Gerrit, patchset: Patchset):
     for patch in patchset.patches:
         _find_and_label_revision_id(gerrit, patch)
 
-def upload_comments_for_patch(gerrit: Gerrit, patch: Patch):
+def upload_comments_for_patch(gerrit: Gerrit, patch: Patch, comments: Optional[List[Comment]] = None):
     Comments = List[Dict[str,str]]
 
     patch_comments : List[str] = []
     file_comments : Dict[str,Comments] = {}
-    for comment in patch.comments:
+    if comments is None:
+        comments = patch.comments
+    for comment in comments:
         if not comment.file:
             patch_comments.append(comment.message)
         else:
@@ -96,8 +112,11 @@ def upload_comments_for_patch(gerrit: Gerrit, patch: Patch):
             if comment.line:
                 comment_as_dict['line'] = comment.line
             file_comments[file_name].append(comment_as_dict)
+    trailers = '\n'.join(f'{REPLY_TRAILER}: {reply_id}' for reply_id in sorted(_reply_ids(comments)))
+    if trailers:
+        patch_comments.append(trailers)
     review = {
-            'tag': 'post_lkml_comments',
+            'tag': POST_LKML_COMMENTS_TAG,
             'notify': 'NONE',  # NOTE: if we mirror from gerrit to lkml, we might want to notify eventually
             'ignore_automatic_attention_set_rules': 'true',  # ditto above.
             'message': '\n\n'.join(patch_comments),
@@ -107,10 +126,72 @@ def upload_comments_for_patch(gerrit: Gerrit, patch: Patch):
     logging.info('review = %s', review)
     logging.info('set_review response = %s', gerrit.set_review(change_id=patch.change_id, revision_id=patch.revision_id, review=review))
 
-def upload_all_comments(gerrit: Gerrit, patchset: Patchset):
-    map_comments_to_gerrit(patchset)
+def _reply_ids(comments: List[Comment]) -> Set[str]:
+    return {comment.reply_id for comment in comments if comment.reply_id is not None}
+
+def upload_all_comments(gerrit: Gerrit, patchset: Patchset, parse_cache: Optional[ParseCache] = None,
+                        message_dao: Optional[MessageDao] = None):
+    map_comments_to_gerrit(patchset, parse_cache)
     for patch in patchset.patches:
         upload_comments_for_patch(gerrit, patch)
+        if message_dao is not None:
+            message_dao.mark_replies_posted(patch.change_id, patch.revision_id, _reply_ids(patch.comments))
+
+def _find_posted_replies(gerrit: Gerrit, patch: Patch, comments: List[Comment]) -> Set[str]:
+    """Returns the replies whose comments are already on the change, as posted
+    by upload_comments_for_patch. Reviews name the replies they post in their
+    trailers; a reply in a review from before those were added counts as
+    posted only if every one of its comments is found there verbatim."""
+    messages = [message.get('message', '') for message in gerrit.get_messages(patch.change_id)
+                if message.get('tag') == POST_LKML_COMMENTS_TAG]
+    named = {reply_id for message in messages for reply_id in _REPLY_TRAILER_PATTERN.findall(message)}
+    # Patch level comments were joined by blank lines, so each one must be a
+    # whole run of paragraphs of the message.
+    unnamed = [f"\n\n{message.strip()}\n\n" for message in messages if not _REPLY_TRAILER_PATTERN.search(message)]
+    inline_messages = {comment.get('message', '').strip()
+                       for file_comments in gerrit.get_comments(patch.change_id).values()
+                       for comment in file_comments if comment.get('tag') == POST_LKML_COMMENTS_TAG}
+
+    def is_posted(comment: Comment) -> bool:
+        if comment.reply_id in named:
+            return True
+        if comment.file:
+            return comment.message.strip() in inline_messages
+        return any(f"\n\n{comment.message.strip()}\n\n" in message for message in unnamed)
+
+    unposted = {comment.reply_id for comment in comments if not is_posted(comment)}
+    return _reply_ids(comments) - unposted
+
+def upload_new_comments(gerrit: Gerrit, patchset: Patchset, message_dao: MessageDao,
+                        parse_cache: Optional[ParseCache] = None, reconcile: bool = False) -> int:
+    """ Uploads the comments of the replies which were not posted to their
+    change yet and records them as posted, so a thread getting a new reply
+    doesn't get its earlier replies posted again. Returns the number of
+    replies posted.
+
+    The current revision of a change is only looked up when there is
+    something to post to it. With reconcile, replies whose comments are
+    already on Gerrit are first recorded as posted instead, e.g. those posted
+    before they were recorded."""
+    map_comments_to_gerrit(patchset, parse_cache)
+    posted_count = 0
+    for patch in patchset.patches:
+        posted = message_dao.get_posted_replies(patch.change_id)
+        new_comments = [comment for comment in patch.comments if comment.reply_id not in posted]
+        if new_comments and reconcile:
+            found = _find_posted_replies(gerrit, patch, new_comments)
+            if found:
+                logging.info('Found %d replies already posted to %s', len(found), patch.change_id)
+                message_dao.mark_replies_posted(patch.change_id, patch.revision_id, found)
+                new_comments = [comment for comment in new_comments if comment.reply_id not in found]
+        if not new_comments:
+            continue
+        _find_and_label_revision_id(gerrit, patch)
+        upload_comments_for_patch(gerrit, patch, new_comments)
+        reply_ids = _reply_ids(new_comments)
+        message_dao.mark_replies_posted(patch.change_id, patch.revision_id, reply_ids)
+        posted_count += len(reply_ids)
+    return posted_count
 
 def main() -> None:
     gerrit_url = 'https://linux-review.googlesource.com'
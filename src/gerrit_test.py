@@ -0,0 +1,108 @@
+import unittest
+from unittest import mock
+
+import gerrit
+from message_dao import FakeMessageDao
+from patch_parser import Comment, Patch, Patchset
+
+class UploadNewCommentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gerrit = mock.create_autospec(gerrit.Gerrit, instance=True)
+        self.message_dao = FakeMessageDao()
+        mock.patch.object(gerrit, 'map_comments_to_gerrit').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def patchset(self, comments):
+        patch = Patch(message_id='<patch>', text='', text_with_headers='', set_index=0,
+                      comments=comments, change_id='change1')
+        patch.revision_id = 'revision1'
+        return Patchset(cover_letter=None, patches=[patch])
+
+    def posted_messages(self):
+        messages = []
+        for call in self.gerrit.set_review.call_args_list:
+            review = call.kwargs['review']
+            messages.append(sorted([review['message']] + [comment['message']
+                                   for comments in review['comments'].values() for comment in comments]))
+        return messages
+
+    def test_posts_only_new_replies(self):
+        first = [Comment(raw_line=-1, message='Thanks!', reply_id='<reply1>'),
+                 Comment(raw_line=3, message='Typo', file='file', line=2, reply_id='<reply1>')]
+        second = [Comment(raw_line=5, message='Why?', file='file', line=4, reply_id='<reply2>')]
+
+        self.assertEqual(1, gerrit.upload_new_comments(self.gerrit, self.patchset(first), self.message_dao))
+        self.assertEqual(1, gerrit.upload_new_comments(self.gerrit, self.patchset(first + second),
+                                                       self.message_dao))
+        self.assertEqual(0, gerrit.upload_new_comments(self.gerrit, self.patchset(first + second),
+                                                       self.message_dao))
+
+        self.assertEqual([['Thanks!\n\nLKML-Reply: <reply1>', 'Typo'], ['LKML-Reply: <reply2>', 'Why?']],
+                         self.posted_messages())
+        self.assertEqual({'<reply1>', '<reply2>'}, self.message_dao.get_posted_replies('change1'))
+        # The revision is only looked up for the calls which posted something.
+        self.assertEqual(2, self.gerrit.get_change.call_count)
+
+    def test_posts_to_current_revision(self):
+        self.gerrit.get_change.return_value = {'current_revision': 'revision2'}
+        comments = [Comment(raw_line=-1, message='Thanks!', reply_id='<reply1>')]
+        gerrit.upload_new_comments(self.gerrit, self.patchset(comments), self.message_dao)
+        self.assertEqual('revision2', self.gerrit.set_review.call_args.kwargs['revision_id'])
+
+    def test_upload_all_comments_records_replies(self):
+        comments = [Comment(raw_line=-1, message='Thanks!', reply_id='<reply1>')]
+        gerrit.upload_all_comments(self.gerrit, self.patchset(comments), message_dao=self.message_dao)
+        self.assertEqual(0, gerrit.upload_new_comments(self.gerrit, self.patchset(comments), self.message_dao))
+        self.assertEqual(1, self.gerrit.set_review.call_count)
+
+    def test_reconcile_records_replies_already_on_gerrit(self):
+        self.gerrit.get_messages.return_value = [
+            {'tag': gerrit.POST_LKML_COMMENTS_TAG, 'message': 'Patch Set 1:\n\nThanks!'},
+            {'message': 'Patch Set 1:\n\nNot from the bridge'},
+        ]
+        self.gerrit.get_comments.return_value = {
+            'file': [{'tag': gerrit.POST_LKML_COMMENTS_TAG, 'line': 2, 'message': 'Typo'},
+                     {'line': 4, 'message': 'Why?'}],
+        }
+        comments = [Comment(raw_line=-1, message='Thanks!', reply_id='<reply1>'),
+                    Comment(raw_line=3, message='Typo', file='file', line=2, reply_id='<reply1>'),
+                    Comment(raw_line=5, message='Why?', file='file', line=4, reply_id='<reply2>'),
+                    Comment(raw_line=-1, message='Not from the bridge', reply_id='<reply3>')]
+
+        self.assertEqual(2, gerrit.upload_new_comments(self.gerrit, self.patchset(comments), self.message_dao,
+                                                       reconcile=True))
+
+        self.assertEqual([['Not from the bridge\n\nLKML-Reply: <reply2>\nLKML-Reply: <reply3>', 'Why?']],
+                         self.posted_messages())
+        self.assertEqual({'<reply1>', '<reply2>', '<reply3>'}, self.message_dao.get_posted_replies('change1'))
+
+    def test_reconcile_matches_whole_comments(self):
+        self.gerrit.get_messages.return_value = [
+            {'tag': gerrit.POST_LKML_COMMENTS_TAG, 'message': 'Patch Set 1:\n\nThanks for the fix!\n\nAcked-by: Someone'},
+        ]
+        self.gerrit.get_comments.return_value = {}
+        comments = [Comment(raw_line=-1, message='Thanks', reply_id='<reply1>'),
+                    Comment(raw_line=-1, message='Acked-by: Some', reply_id='<reply2>'),
+                    Comment(raw_line=-1, message='Thanks for the fix!', reply_id='<reply3>')]
+
+        self.assertEqual(2, gerrit.upload_new_comments(self.gerrit, self.patchset(comments), self.message_dao,
+                                                       reconcile=True))
+        self.assertEqual({'<reply1>', '<reply2>', '<reply3>'}, self.message_dao.get_posted_replies('change1'))
+        self.assertEqual(1, self.gerrit.set_review.call_count)
+
+    def test_reconcile_uses_reply_trailers(self):
+        self.gerrit.get_messages.return_value = [
+            {'tag': gerrit.POST_LKML_COMMENTS_TAG, 'message': 'Patch Set 1:\n\nThanks\n\nLKML-Reply: <reply1>'},
+        ]
+        self.gerrit.get_comments.return_value = {}
+        comments = [Comment(raw_line=-1, message='Thanks', reply_id='<reply1>'),
+                    Comment(raw_line=3, message='Typo', file='file', line=2, reply_id='<reply1>'),
+                    Comment(raw_line=-1, message='Thanks', reply_id='<reply2>')]
+
+        self.assertEqual(1, gerrit.upload_new_comments(self.gerrit, self.patchset(comments), self.message_dao,
+                                                       reconcile=True))
+        self.assertEqual([['Thanks\n\nLKML-Reply: <reply2>']], self.posted_messages())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,10 +13,10 @@
 # limitations under the License.
 
 import os
-import glob
 import time
 
 from absl import app
+from absl import flags
 from absl import logging
 
 import archive_updater
@@ -25,23 +25,43 @@ import git
 import patch_parser
 
 from archive_converter import ArchiveMessageIndex
+from email_store import EmailStore
 from message import Message
 from message_dao import MessageDao
+from parse_cache import ParseCache
 from patch_associator import PatchAssociator, SimplePatchAssociator
-from typing import Collection, Dict, List, Set, Tuple
+from storage_backend import backend_from_environment
+from typing import Collection, Dict, List, Optional, Set, Tuple
 
-GIT_PATH = '../linux-kselftest/git/0.git'
-FILE_DIR = 'index_files'
+ARCHIVE_DIR = '../linux-kselftest/git'
+# Epoch 0 can read the objects of every epoch, see archive_updater.setup_archive
+GIT_PATH = archive_updater.epoch_path(ARCHIVE_DIR, 0)
 GERRIT_URL = 'https://linux-review.googlesource.com'
 GOB_URL = 'http://linux.googlesource.com'
 COOKIE_JAR_PATH = 'gerritcookies'
 LOG_PATH = 'logs'
+EMAIL_STORE_DIR = 'email_store'
+KNOWN_IDS_PATH = 'known_ids'
+PARSE_CACHE_DIR = 'parse_cache'
 WAIT_TIME = 10
+# Maximum number of archive commits processed before the last hash is stored
+MAX_BATCH_SIZE = 1000
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('parse_workers', 0,
+                     'Number of processes decoding emails during ingest. With 0 or 1, emails are '
+                     'decoded in the server process, when their body is first needed.')
+flags.DEFINE_boolean('reconcile_posted_replies', False,
+                     'Before posting a reply\'s comments to Gerrit, check whether they are already '
+                     'there and if so record the reply as posted instead.')
 
 #TODO(@willliu): consider adding more specific errors to raise, instead of a catch-all
 
 class Server(object):
-    def __init__(self, message_dao : MessageDao, patch_associator: PatchAssociator) -> None:
+    def __init__(self, message_dao : MessageDao, patch_associator: PatchAssociator,
+                 email_store: Optional[EmailStore] = None,
+                 parse_cache: Optional[ParseCache] = None, parse_workers: int = 0,
+                 reconcile: bool = False) -> None:
         rest = gerrit.get_gerrit_rest_api(COOKIE_JAR_PATH, GERRIT_URL)
         self.gerrit = gerrit.Gerrit(rest)
         self.gerrit_git = git.GerritGit(git_dir='gerrit_git_dir',
@@ -51,19 +71,15 @@ class Server(object):
                                         branch='master')
         self.message_dao = message_dao
         self.patch_associator = patch_associator
-        self.archive_index = ArchiveMessageIndex(self.message_dao)
-        self.last_hash = self.message_dao.get_last_hash()
-        archive_updater.setup_archive(GIT_PATH)
-        os.makedirs(FILE_DIR, exist_ok=True)
+        self.parse_cache = parse_cache
+        self.reconcile = reconcile
+        self.archive_index = ArchiveMessageIndex(self.message_dao, email_store, parse_workers)
+        # Maps archive epoch to the last processed commit hash in that epoch
+        self.last_hashes : Dict[int, Optional[str]] = {}
+        archive_updater.setup_archive(ARCHIVE_DIR)
         os.makedirs(LOG_PATH, exist_ok=True)
         logging.get_absl_handler().use_absl_log_file('server_logs', LOG_PATH)
 
-    @staticmethod
-    def remove_files(file_dir : str):
-        files = glob.glob(f'{file_dir}/*')
-        for f in files:
-            os.remove(f)
-
     @staticmethod
     def split_parent_and_reply_messages(messages : List[Message]) -> Tuple[List[Message], List[Message]]:
         ''' Splits a list of messages into parent (first email in a thread) and replies. '''
@@ -77,13 +93,42 @@ class Server(object):
         return (parents, replies)
 
     def run(self) -> None:
-        while True:
-            self.update_convert_upload()
-            time.sleep(WAIT_TIME)
+        try:
+            while True:
+                self.update_convert_upload()
+                time.sleep(WAIT_TIME)
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Stops the parse workers, if any, and saves the DAO's state."""
+        self.archive_index.close()
+        self.message_dao.close()
 
     def update_convert_upload(self) -> None:
-        new_messages = self.update_message_dir()
-
+        epochs = archive_updater.update_archive(ARCHIVE_DIR)
+        for epoch in epochs:
+            self.update_convert_upload_epoch(epoch)
+
+    def update_convert_upload_epoch(self, epoch: int) -> None:
+        """Processes every new email in an epoch of the archive, oldest first, in
+        batches of at most MAX_BATCH_SIZE. The last hash is stored after each
+        batch so that memory use stays flat and a crash only repeats the current
+        batch."""
+        archive_path = archive_updater.epoch_path(ARCHIVE_DIR, epoch)
+        if epoch not in self.last_hashes:
+            self.last_hashes[epoch] = self.message_dao.get_last_hash(epoch)
+        new_hashes = archive_updater.list_new_commits(archive_path, self.last_hashes[epoch])
+        for start in range(0, len(new_hashes), MAX_BATCH_SIZE):
+            batch = new_hashes[start:start + MAX_BATCH_SIZE]
+            new_messages = self.archive_index.update(archive_updater.read_messages(archive_path, batch),
+                                                     archive_updater.commit_times(archive_path, batch))
+            self.convert_upload(new_messages)
+            self.last_hashes[epoch] = batch[-1]
+            self.message_dao.store_last_hash(batch[-1], epoch)
+            logging.info('Processed %d/%d new emails in epoch %d', start + len(batch), len(new_hashes), epoch)
+
+    def convert_upload(self, new_messages: Dict[str, Message]) -> None:
         # Differentiate between messages to upload and comments
         messages_to_upload : List[Message] = []
         messages_with_new_comments : Dict[str, Message] = {}
@@ -96,12 +141,16 @@ class Server(object):
             parent_patches.add(message.id)
             messages_to_upload.append(message)
 
+        # Parents outside of this batch only have to exist, so they are looked up all at once.
+        stored_parents = self.message_dao.contains_many(
+            {message.in_reply_to for message in replies if message.in_reply_to not in new_messages})
+
         # Determine which of the replies should be uploaded
         for message in replies:
             if message.in_reply_to in parent_patches:
                 replies_to_store.append(message)
                 continue
-            if not new_messages.get(message.in_reply_to) and not self.message_dao.get(message.in_reply_to):
+            if message.in_reply_to not in new_messages and message.in_reply_to not in stored_parents:
                 continue
             replies_to_store.append(message)
             # Reply is a patch to be uploaded (as the parent of patchset is not in new_messages)
@@ -125,28 +174,21 @@ class Server(object):
 
         self.store_replies(replies_to_store)
 
-        self.message_dao.store_last_hash(self.last_hash)
-
-        self.remove_files(FILE_DIR)
-
-    def update_message_dir(self) -> Dict[str, Message]:
-        self.last_hash = archive_updater.fill_message_directory(GIT_PATH, FILE_DIR, self.last_hash)
-        messages = self.archive_index.update(FILE_DIR)
-        return messages
-
     def upload_messages(self, messages_to_upload : List[Message]):
         failed = 0
         for email_thread in messages_to_upload:
             try:
-                patchset = patch_parser.parse_comments(email_thread)
+                patchset = patch_parser.parse_comments(email_thread, self.parse_cache)
                 self.gerrit_git.apply_patchset_and_cleanup(patchset, email_thread, self.message_dao, self.patch_associator)
                 gerrit.find_and_label_all_revision_ids(self.gerrit, patchset)
-                gerrit.upload_all_comments(self.gerrit, patchset)
+                gerrit.upload_all_comments(self.gerrit, patchset, self.parse_cache, self.message_dao)
             except Exception as e:
                 failed += 1
                 failed_message = email_thread.debug_info()
                 logging.exception('Failed to upload %s.', failed_message)
                 continue
+            finally:
+                email_thread.release_content()
         if failed > 0:
             logging.warning('Failed to upload %d/%d messages', failed, len(messages_to_upload))
 
@@ -154,34 +196,33 @@ class Server(object):
         failed = 0
         for email_thread in messages_with_new_comments.values():
             try:
-                patchset = patch_parser.parse_comments(email_thread)
-                gerrit.upload_all_comments(self.gerrit, patchset)
+                patchset = patch_parser.parse_comments(email_thread, self.parse_cache)
+                gerrit.upload_new_comments(self.gerrit, patchset, self.message_dao, self.parse_cache,
+                                           self.reconcile)
                 self.message_dao.store(email_thread)
             except Exception as e:
                 failed += 1
                 failed_message = email_thread.debug_info()
                 logging.exception('Failed to upload comments for %s.', failed_message)
                 continue
+            finally:
+                email_thread.release_content()
         if failed > 0:
             logging.warning('Failed to upload %d/%d comments', failed, len(messages_with_new_comments))
 
     def store_replies(self, replies : Collection[Message]):
-        failed = 0
-        for reply in replies:
-            try:
-                self.message_dao.store(reply)
-            except Exception as e:
-                failed += 1
-                failed_reply = reply.debug_info()
-                logging.exception('Failed to upload %s.', failed_reply)
-                continue
-        if failed > 0:
-            logging.warning('Failed to upload %d/%d replies', failed, len(replies))
+        # Replies are buffered by the DAO and committed together with the last hash.
+        try:
+            self.message_dao.store_many(replies)
+        except Exception as e:
+            logging.exception('Failed to store %d replies.', len(replies))
 
 def main(argv) -> None:
-    message_dao = MessageDao(GIT_PATH)
+    email_store = EmailStore(EMAIL_STORE_DIR)
+    message_dao = MessageDao(GIT_PATH, email_store, backend_from_environment(), KNOWN_IDS_PATH)
     patch_associator = SimplePatchAssociator(GIT_PATH)
-    server = Server(message_dao, patch_associator)
+    server = Server(message_dao, patch_associator, email_store, ParseCache(PARSE_CACHE_DIR),
+                    FLAGS.parse_workers, FLAGS.reconcile_posted_replies)
     server.run()
 
 
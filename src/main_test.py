@@ -7,16 +7,18 @@ from typing import List
 import archive_updater
 import gerrit
 import git
+import main
+import message_dao
 
 from archive_converter import ArchiveMessageIndex
-from main import Server, GIT_PATH
+from main import Server, ARCHIVE_DIR, GIT_PATH
 from message_dao import FakeMessageDao
 from patch_parser import parse_comments
 from patch_associator import SimplePatchAssociator
 from message import Message
 from google.cloud.sql.connector import Connector
 
-from test_helpers import compare_message_subjects, test_data_path
+from test_helpers import compare_message_subjects, read_test_emails
 
 class MainTest(unittest.TestCase):
 
@@ -24,32 +26,20 @@ class MainTest(unittest.TestCase):
         self.addCleanup(mock.patch.stopall)
         mock.patch.object(gerrit, 'get_gerrit_rest_api').start()
         mock.patch.object(archive_updater, 'setup_archive').start()
+        mock.patch.object(archive_updater, 'commit_times', return_value={}).start()
         self.message_dao = FakeMessageDao()
         self.patch_associator = SimplePatchAssociator(GIT_PATH)
 
-    def test_remove_files(self):
-        self.tmp_dir = tempfile.mkdtemp()
-        self.assertEqual(len(os.listdir(self.tmp_dir)), 0)
-        file = os.path.join(self.tmp_dir, 'file_to_be_removed.txt')
-        with open(file, 'w') as f:
-            f.write('this file will be removed')
-        self.assertEqual(len(os.listdir(self.tmp_dir)), 1)
-        Server.remove_files(self.tmp_dir)
-        self.assertEqual(len(os.listdir(self.tmp_dir)), 0)
-        shutil.rmtree(self.tmp_dir)
-
     def test_split_parent_and_reply_messages(self):
         archive_index = ArchiveMessageIndex(self.message_dao)
-        messages = archive_index.update(test_data_path()).values()
+        messages = archive_index.update(read_test_emails()).values()
         parents, replies = Server.split_parent_and_reply_messages(messages)
         self.assertEqual(len(parents), 2)
-        self.assertEqual(len(replies), 6)
+        self.assertEqual(len(replies), 4)
 
         expected_parents = ['[PATCH v2 1/2] Input: i8042 - Prevent intermixing i8042 commands',
                     '[PATCH v2 0/4] kselftests/arm64: add PAuth tests']
-        expected_replies = ['Re: [PATCH] Remove final reference to superfluous smp_commence().',
-                    '[PATCH v2 1/3] dmaengine: add dma_get_channel_caps()',
-                    '[PATCH v2 1/4] kselftests/arm64: add a basic Pointer Authentication test',
+        expected_replies = ['[PATCH v2 1/4] kselftests/arm64: add a basic Pointer Authentication test',
                     '[PATCH v2 2/4] kselftests/arm64: add nop checks for PAuth tests',
                     '[PATCH v2 3/4] kselftests/arm64: add PAuth test for whether exec() changes keys',
                     '[PATCH v2 4/4] kselftests/arm64: add PAuth tests for single threaded consistency and key uniqueness']
@@ -57,34 +47,100 @@ class MainTest(unittest.TestCase):
         compare_message_subjects(self, parents, expected_parents)
         compare_message_subjects(self, replies, expected_replies)
 
-    @mock.patch.object(archive_updater, 'fill_message_directory')
+    @mock.patch.object(archive_updater, 'read_messages')
+    @mock.patch.object(archive_updater, 'list_new_commits')
+    @mock.patch.object(archive_updater, 'update_archive')
     @mock.patch.object(Server, 'upload_messages')
     @mock.patch.object(Server, 'upload_comments')
     def test_server_upload_across_batches(self, mock_upload_comments, mock_upload_messages,
-                                          mock_fill_message_directory):
+                                          mock_update_archive, mock_list_new_commits, mock_read_messages):
         archive_index = ArchiveMessageIndex(self.message_dao)
-        messages_mapping = archive_index.update(test_data_path())
+        messages_mapping = archive_index.update(read_test_emails())
         messages = list(messages_mapping.values())
 
         # Make sure the ordering is deterministic.
         messages.sort(key=lambda m: m.id)
-        first_batch = {message.id : message for message in messages[0:6]}
-        second_batch = {message.id : message for message in messages[6:]}
-        mock_fill_message_directory.return_value = ''
+        first_batch = {message.id : message for message in messages[0:4]}
+        second_batch = {message.id : message for message in messages[4:]}
+        mock_update_archive.return_value = [0]
+        mock_list_new_commits.return_value = ['fake_hash']
 
         # declaring mock objects here because I want to use the ArchiveMessageIndex functionality to build the test data
-        with mock.patch.object(ArchiveMessageIndex, 'update') as mock_update, mock.patch.object(FakeMessageDao, 'get') as mock_get:
+        with mock.patch.object(ArchiveMessageIndex, 'update') as mock_update, \
+             mock.patch.object(FakeMessageDao, 'contains_many') as mock_contains_many:
             mock_update.side_effect = [first_batch, second_batch]
-            mock_get.side_effect = [None, None, messages[6], messages[7]]
+            # The parent of the second batch was stored with the first one.
+            mock_contains_many.side_effect = lambda message_ids: set(message_ids) & {messages[1].id}
             server = Server(self.message_dao, self.patch_associator)
+            self.addCleanup(server.close)
             server.update_convert_upload()
-            mock_upload_messages.assert_called_with([messages[2],messages[3]])
+            mock_upload_messages.assert_called_with([messages[0],messages[1]])
             mock_upload_comments.assert_called_with({})
 
             server.update_convert_upload()
-            mock_upload_messages.assert_called_with([messages[6],messages[7]])
+            mock_upload_messages.assert_called_with([messages[4],messages[5]])
             mock_upload_comments.assert_called_with({})
 
+    @mock.patch.object(archive_updater, 'read_messages')
+    @mock.patch.object(archive_updater, 'list_new_commits')
+    @mock.patch.object(archive_updater, 'update_archive')
+    @mock.patch.object(Server, 'convert_upload')
+    def test_server_stores_last_hash_after_each_batch(self, mock_convert_upload, mock_update_archive,
+                                                      mock_list_new_commits, mock_read_messages):
+        mock_update_archive.return_value = [0]
+        mock_list_new_commits.return_value = ['hash1', 'hash2', 'hash3', 'hash4', 'hash5']
+        mock_read_messages.return_value = iter([])
+        server = Server(self.message_dao, self.patch_associator)
+        self.addCleanup(server.close)
+
+        with mock.patch.object(main, 'MAX_BATCH_SIZE', 2), \
+             mock.patch.object(FakeMessageDao, 'store_last_hash') as mock_store_last_hash:
+            server.update_convert_upload()
+
+        mock_update_archive.assert_called_once()
+        mock_read_messages.assert_has_calls([
+            mock.call(GIT_PATH, ['hash1', 'hash2']),
+            mock.call(GIT_PATH, ['hash3', 'hash4']),
+            mock.call(GIT_PATH, ['hash5']),
+        ])
+        self.assertEqual(3, mock_convert_upload.call_count)
+        mock_store_last_hash.assert_has_calls([mock.call('hash2', 0), mock.call('hash4', 0), mock.call('hash5', 0)])
+        self.assertEqual('hash5', server.last_hashes[0])
+
+    @mock.patch.object(archive_updater, 'read_messages')
+    @mock.patch.object(archive_updater, 'list_new_commits')
+    @mock.patch.object(archive_updater, 'update_archive')
+    @mock.patch.object(Server, 'convert_upload')
+    def test_server_tracks_last_hash_per_epoch(self, mock_convert_upload, mock_update_archive,
+                                               mock_list_new_commits, mock_read_messages):
+        mock_update_archive.return_value = [0, 1]
+        mock_list_new_commits.side_effect = [['hash1'], ['hash2']]
+        mock_read_messages.return_value = iter([])
+        server = Server(self.message_dao, self.patch_associator)
+        self.addCleanup(server.close)
+
+        server.update_convert_upload()
+
+        epoch_one_path = archive_updater.epoch_path(ARCHIVE_DIR, 1)
+        mock_list_new_commits.assert_has_calls([
+            mock.call(GIT_PATH, message_dao.EPOCH_HASH),
+            mock.call(epoch_one_path, None),
+        ])
+        mock_read_messages.assert_has_calls([
+            mock.call(GIT_PATH, ['hash1']),
+            mock.call(epoch_one_path, ['hash2']),
+        ])
+        self.assertEqual('hash1', self.message_dao.get_last_hash(0))
+        self.assertEqual('hash2', self.message_dao.get_last_hash(1))
+
+    @mock.patch.object(Server, 'update_convert_upload')
+    def test_server_closes_parse_workers_when_stopped(self, mock_update_convert_upload):
+        mock_update_convert_upload.side_effect = KeyboardInterrupt
+        server = Server(self.message_dao, self.patch_associator, parse_workers=2)
+        with mock.patch.object(server.archive_index, 'close', wraps=server.archive_index.close) as mock_close:
+            with self.assertRaises(KeyboardInterrupt):
+                server.run()
+        mock_close.assert_called_once()
 
     '''
     def test_upload_failed_apply(self):
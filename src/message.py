@@ -13,33 +13,124 @@
 # limitations under the License.
 
 import email
+import email.message
+import email.parser
 import re
-from typing import List, Optional, Tuple
+from typing import Callable, List, NamedTuple, Optional, Tuple, Union
+
+PATCH_OR_COVERLETTER_MATCHER = re.compile(r'\[.+\] .+')
+VERSION_MATCHER = re.compile(r'\[.+ v(\d+).*\]')
+PATCH_INDEX_MATCHER = re.compile(r'\[.+ (\d+)/(\d+)\] .+')
+SUBJECT_TAGS_MATCHER = re.compile(r'\[([^\]]*)\]')
+END_OF_HEADERS_MATCHER = re.compile(rb'\r?\n\r?\n')
+MESSAGE_ID_MATCHER = re.compile(r'<[^<>]+>')
 
 def lore_link(message_id: str) -> str:
     # We store message ids enclosed in <>, so trim those off.
     return 'https://lore.kernel.org/linux-kselftest/' + message_id[1:-1]
 
+class SubjectInfo(NamedTuple):
+    """Everything we derive from a subject line like '[PATCH RFC v2 1/4] foo: bar'."""
+    tags: Tuple[str, ...]
+    version: int
+    index: int
+    total: int
+    is_patch_or_coverletter: bool
+    is_rfc: bool
+    is_resend: bool
+    normalized_subject: str
+
+def parse_subject(subject: Optional[str]) -> SubjectInfo:
+    subject = subject or ''
+    tags_match = SUBJECT_TAGS_MATCHER.match(subject)
+    tags = tuple(tags_match.group(1).split()) if tags_match else ()
+    upper_tags = {tag.upper() for tag in tags}
+
+    version_match = VERSION_MATCHER.match(subject)
+    version = int(version_match.group(1)) if version_match else 1
+
+    index_match = PATCH_INDEX_MATCHER.match(subject)
+    index, total = (int(index_match.group(1)), int(index_match.group(2))) if index_match else (1, 1)
+
+    return SubjectInfo(tags=tags,
+                       version=version,
+                       index=index,
+                       total=total,
+                       is_patch_or_coverletter=bool(PATCH_OR_COVERLETTER_MATCHER.match(subject)),
+                       is_rfc='RFC' in upper_tags,
+                       is_resend='RESEND' in upper_tags,
+                       normalized_subject=subject.partition('] ')[2].lower())
+
 class Message(object):
-    def __init__(self, id, subject, from_, in_reply_to, content, archive_hash) -> None:
+    """An email from the archive.
+
+    The body is decoded from the raw email on first access to `content`. A
+    message which knows how to reload its raw email from the archive (via
+    `load_raw_email`) drops the raw bytes along with the decoded body in
+    release_content, and only reloads them if its content is needed again."""
+
+    # Slots keep large batches of messages small in memory.
+    __slots__ = ('id', 'subject', 'from_', 'in_reply_to', 'change_id', 'archive_hash',
+                 'commit_time', 'children', '_subject_info', '_content', '_raw_email', '_load_raw_email')
+
+    def __init__(self, id, subject, from_, in_reply_to, content, archive_hash,
+                 raw_email: Optional[bytes] = None,
+                 load_raw_email: Optional[Callable[[str], bytes]] = None) -> None:
         self.id = id
         self.subject = subject
-        self.normalized_subject = self._normalize_subject()
         self.from_ = from_
         self.in_reply_to = in_reply_to
-        self.content = content
         self.change_id = None
         self.archive_hash = archive_hash
+        # Commit time of the email in the archive, in seconds since the epoch
+        self.commit_time = None  # type: Optional[int]
         self.children = []  # type: List[Message]
+        self._subject_info = None  # type: Optional[SubjectInfo]
+        self._content = content
+        self._raw_email = raw_email
+        self._load_raw_email = load_raw_email
+
+    @property
+    def content(self) -> Union[str, List[str]]:
+        if self._content is None:
+            raw_email = self._raw_email
+            if raw_email is None and self._load_raw_email:
+                raw_email = self._load_raw_email(self.archive_hash)
+            if raw_email is not None:
+                self._content = decode_content(raw_email)
+        return self._content
+
+    @content.setter
+    def content(self, content: Union[str, List[str]]) -> None:
+        self._content = content
+
+    def release_content(self) -> None:
+        """Drops the decoded body of this message and its children; it is decoded
+        again if it is needed later."""
+        if self._raw_email is not None or self._load_raw_email:
+            self._content = None
+        if self._load_raw_email:
+            self._raw_email = None
+        for child in self.children:
+            child.release_content()
+
+    @property
+    def subject_info(self) -> SubjectInfo:
+        """The parsed subject, computed on first use."""
+        if self._subject_info is None:
+            self._subject_info = parse_subject(self.subject)
+        return self._subject_info
+
+    @property
+    def normalized_subject(self) -> str:
+        return self.subject_info.normalized_subject
 
     def _is_patch_or_coverletter(self) -> bool:
-        if re.match(r'\[.+\] .+', self.subject):
-            return True
-        return False
+        return self.subject_info.is_patch_or_coverletter
 
     def is_patch(self) -> bool:
         if self._is_patch_or_coverletter():
-            return self._patch_index()[0] > 0
+            return self.subject_info.index > 0
         return False
 
     def is_coverletter(self) -> bool:
@@ -48,22 +139,10 @@ class Message(object):
     def patch_index(self) -> Tuple[int, int]:
          if not self._is_patch_or_coverletter():
              raise ValueError(f'Missing patch index in subject: {self.subject}')
-         return self._patch_index()
+         return self.subject_info.index, self.subject_info.total
 
     def version(self) -> int:
-        match = re.match(r'\[.+ v(\d+).*\]', self.subject)
-        if match:
-            return int(match.group(1))
-        return 1
-
-    def _patch_index(self) -> Tuple[int, int]:
-        match = re.match(r'\[.+ (\d+)/(\d+)\] .+', self.subject)
-        if match:
-            return int(match.group(1)), int(match.group(2))
-        return (1, 1)
-
-    def _normalize_subject(self) -> str:
-        return self.subject.partition("] ")[2].lower()
+        return self.subject_info.version
 
     def __str__(self) -> str:
         in_reply_to = self.in_reply_to or ''
@@ -90,19 +169,77 @@ class Message(object):
                 f'Lore Link: {lore_link(self.id)}\n'
                 f'Commit Hash: {self.archive_hash}')
 
-def parse_message_from_str(raw_email: str, archive_hash: str) -> Message:
-    """Parses a Message from a raw email."""
-    compiled_email = email.message_from_string(raw_email)
+class MessageHeaders(object):
+    """The headers needed to decide what to do with an email, read without
+    parsing or decoding its body."""
 
-    content = []
+    def __init__(self, id, subject, from_, in_reply_to, references) -> None:
+        self.id = id
+        self.subject = subject
+        self.from_ = from_
+        self.in_reply_to = in_reply_to
+        self.references = references
+
+    def is_patch_or_coverletter(self) -> bool:
+        return bool(self.subject and PATCH_OR_COVERLETTER_MATCHER.match(self.subject))
+
+
+def _parent_id(in_reply_to: Optional[str], references: Optional[str]) -> Optional[str]:
+    # Some mailers only set References, whose last entry is the parent.
+    if in_reply_to:
+        return in_reply_to
+    if references:
+        reference_ids = MESSAGE_ID_MATCHER.findall(references)
+        if reference_ids:
+            return reference_ids[-1]
+    return None
+
+def parse_headers_from_bytes(raw_email: bytes) -> MessageHeaders:
+    """Parses only the routing headers of a raw email; the body is never looked at."""
+    end_of_headers = END_OF_HEADERS_MATCHER.search(raw_email)
+    if end_of_headers:
+        raw_email = raw_email[:end_of_headers.start()]
+    headers = email.parser.HeaderParser().parsestr(raw_email.decode('utf-8', errors='replace'))
+    return MessageHeaders(headers['Message-Id'],
+                          headers['subject'],
+                          headers['from'],
+                          _parent_id(headers['In-Reply-To'], headers['References']),
+                          headers['References'])
+
+def _decode_payload(part: email.message.Message) -> str:
+    """Decodes the body of a MIME part, undoing quoted-printable and base64."""
+    if part.is_multipart():
+        return '\n'.join(_decode_payload(subpart) for subpart in part.get_payload())
+    payload = part.get_payload(decode=True) or b''
+    charset = part.get_content_charset() or 'utf-8'
+    try:
+        return payload.decode(charset, errors='replace')
+    except LookupError:
+        return payload.decode('utf-8', errors='replace')
+
+def decode_content(raw_email: bytes) -> Union[str, List[str]]:
+    """Decodes the body of a raw email; multipart emails yield one string per part."""
+    compiled_email = email.message_from_bytes(raw_email)
     if compiled_email.is_multipart():
-        for payload in compiled_email.get_payload():
-            content.append(payload.get_payload())
-    else:
-        content = compiled_email.get_payload()
-    return Message(compiled_email['Message-Id'],
-                   compiled_email['subject'],
-                   compiled_email['from'],
-                   compiled_email['In-Reply-To'],
-                   content,
-                   archive_hash)
+        return [_decode_payload(part) for part in compiled_email.get_payload()]
+    return _decode_payload(compiled_email)
+
+def parse_message_from_bytes(raw_email: bytes, archive_hash: str,
+                             load_raw_email: Optional[Callable[[str], bytes]] = None,
+                             headers: Optional[MessageHeaders] = None) -> Message:
+    """Parses a Message from a raw email. Only the headers are parsed here (unless
+    they are passed in); the body is decoded when the message's content is first used."""
+    if headers is None:
+        headers = parse_headers_from_bytes(raw_email)
+    return Message(headers.id,
+                   headers.subject,
+                   headers.from_,
+                   headers.in_reply_to,
+                   None,
+                   archive_hash,
+                   raw_email=raw_email,
+                   load_raw_email=load_raw_email)
+
+def parse_message_from_str(raw_email: str, archive_hash: str) -> Message:
+    """Parses a Message from a raw email."""
+    return parse_message_from_bytes(raw_email.encode('utf-8', errors='surrogateescape'), archive_hash)
@@ -12,46 +12,361 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import contextlib
+import functools
 import json
-import os
 import subprocess
+import threading
+import time
 
-from functools import lru_cache
-from typing import Dict, List, Optional
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
 
-from dotenv import load_dotenv
-from google.cloud.sql.connector import Connector
-from message import lore_link, Message, parse_message_from_str
+import archive_updater
+
+import bloom_filter
+
+from bloom_filter import BloomFilter
+from email_store import EmailStore
+from absl import logging
+from message import lore_link, Message, parse_message_from_bytes
+from storage_backend import CloudSqlBackend, StorageBackend
 
-load_dotenv()
 EPOCH_HASH = 'ae9e7be4a03765456fe38287533e6446e8bbc93c'
+# Buffered messages are committed once this many are waiting
+COMMIT_EVERY = 500
+# Maximum number of threads kept in the MessageDao cache
+CACHE_SIZE = 1024
+# Number of seconds a thread stays in the MessageDao cache
+CACHE_TTL = 60 * 60
+# Maximum number of ids looked up by a single query in contains_many
+CONTAINS_CHUNK_SIZE = 500
+# Minimum number of seconds between saves of the filter of known message ids
+KNOWN_IDS_SAVE_INTERVAL = 10 * 60
+# Number of seconds a reply is held waiting for its parent
+ORPHAN_TTL = 14 * 24 * 60 * 60
+# Maximum number of replies held waiting for their parent
+MAX_ORPHANS = 10000
+
+MESSAGE_COLUMNS = ('message_id', 'normalized_subject', 'from_', 'in_reply_to', 'archive_hash',
+                   'change_id', 'lore_link', 'commit_time', 'thread_root')
+
+# Schema migrations, applied in order. Each one takes the storage backend and
+# a cursor on it and brings the schema forward by one version; the number of
+# migrations applied so far is kept in States as 'schema_version'.
+#
+# Migrations run against the live, populated tables while the bridge keeps
+# running, so DDL has to be done in place without locking out writes and data
+# changes have to be done in statements small enough to not hold long locks.
+
+# Number of rows updated at a time by data migrations
+MIGRATION_BATCH_SIZE = 1000
+
+def _add_message_indexes(backend: StorageBackend, cursor) -> None:
+    # The recursive thread query joins on in_reply_to and find_matching filters
+    # on normalized_subject, from_ and change_id.
+    backend.add_indexes(cursor, 'Messages', [
+        ('in_reply_to_index', ['in_reply_to']),
+        ('matching_index', ['normalized_subject', 'from_', 'change_id']),
+    ])
+
+def _add_thread_columns(backend: StorageBackend, cursor) -> None:
+    # Both columns are nullable so that existing rows need no rewrite.
+    backend.add_columns(cursor, 'Messages', [('commit_time', 'BIGINT'), ('thread_root', 'VARCHAR(255)')])
+    backend.add_indexes(cursor, 'Messages', [('thread_root_index', ['thread_root'])])
+
+def _backfill_thread_roots(backend: StorageBackend, cursor) -> None:
+    # Every batch is committed on its own so that no transaction holds locks
+    # on the whole table. Only rows still without a root are touched, so an
+    # interrupted backfill picks up where it stopped.
+    while True:
+        cursor.execute("SELECT message_id FROM Messages "
+                       "WHERE thread_root IS NULL AND in_reply_to IS NULL "
+                       f"LIMIT {MIGRATION_BATCH_SIZE}")
+        rows = list(cursor.fetchall())
+        if not rows:
+            break
+        cursor.executemany("UPDATE Messages SET thread_root=%s WHERE message_id=%s",
+                           [(message_id, message_id) for message_id, in rows])
+        backend.commit()
+    # Each round pushes roots further down the threads; we are done once
+    # there is nothing left to update.
+    while True:
+        cursor.execute("SELECT c.message_id, p.thread_root FROM Messages c "
+                       "JOIN Messages p ON c.in_reply_to = p.message_id "
+                       "WHERE c.thread_root IS NULL AND p.thread_root IS NOT NULL "
+                       f"LIMIT {MIGRATION_BATCH_SIZE}")
+        rows = list(cursor.fetchall())
+        if not rows:
+            break
+        cursor.executemany("UPDATE Messages SET thread_root=%s WHERE message_id=%s",
+                           [(thread_root, message_id) for message_id, thread_root in rows])
+        backend.commit()
+
+def _add_orphans_table(backend: StorageBackend, cursor) -> None:
+    # Replies held until their parent is stored, see MessageDao.store_orphans
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS Orphans"
+        "(message_id VARCHAR(255) NOT NULL,"
+        "parent_id VARCHAR(255) NOT NULL,"
+        "archive_hash VARCHAR(255) NOT NULL,"
+        "received_at BIGINT NOT NULL,"
+        "PRIMARY KEY (message_id))"
+    )
+    backend.add_indexes(cursor, 'Orphans', [
+        ('parent_id_index', ['parent_id']),
+        ('received_at_index', ['received_at']),
+    ])
+
+def _add_posted_replies_table(backend: StorageBackend, cursor) -> None:
+    # Replies whose comments were posted to a Gerrit change, see MessageDao.mark_replies_posted
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS PostedReplies"
+        "(message_id VARCHAR(255) NOT NULL,"
+        "change_id VARCHAR(255) NOT NULL,"
+        "revision_id VARCHAR(255),"
+        "posted_at BIGINT NOT NULL,"
+        "PRIMARY KEY (change_id, message_id))"
+    )
+
+MIGRATIONS = [
+    _add_message_indexes,
+    _add_thread_columns,
+    _backfill_thread_roots,
+    _add_orphans_table,
+    _add_posted_replies_table,
+]
+
+def _last_hash_state(epoch: int) -> str:
+    # Epoch 0 keeps the state name used before we tracked multiple epochs.
+    return 'last_hash' if epoch == 0 else f'last_hash_{epoch}'
+
+def _default_last_hash(epoch: int) -> Optional[str]:
+    # Later epochs are processed from their very first commit.
+    return EPOCH_HASH if epoch == 0 else None
+
+def _retry_on_disconnect(method):
+    """ Retries a MessageDao method once on a new connection if the database
+    connection was lost. The transaction is lost with the connection, so the
+    rows it had written are buffered again first."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except Exception as e:
+            if not self.backend.is_disconnect(e):
+                raise
+            logging.warning('Lost the database connection during %s, retrying: %s', method.__name__, e)
+            self._reconnect()
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def _thread_ids(message: Message) -> FrozenSet[str]:
+    ids = set()
+    pending = [message]
+    while pending:
+        current = pending.pop()
+        if current.id in ids:
+            continue
+        ids.add(current.id)
+        pending.extend(current.children)
+    return frozenset(ids)
+
+class ThreadCache(object):
+    """ A size and TTL bounded cache of the threads returned by MessageDao.get,
+    keyed by the id of the thread's root message.
+
+    A cached thread goes stale when any message inside it changes, so we also
+    track which cached threads contain each message id. Invalidating a message
+    drops exactly those threads and leaves the rest of the cache alone."""
+
+    def __init__(self, max_size: int = CACHE_SIZE, ttl: float = CACHE_TTL,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self._max_size = max_size
+        self._ttl = ttl
+        self._clock = clock
+        # Maps root message id to (expiry time, thread, ids of every message in the thread)
+        self._entries : collections.OrderedDict = collections.OrderedDict()
+        # Maps message id to the root ids of the cached threads containing it
+        self._containing : Dict[str, Set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # The cache is shared by every thread using the MessageDao
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, message_id: str) -> Optional[Message]:
+        with self._lock:
+            entry = self._entries.get(message_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            expiry, message, _ = entry
+            if self._clock() >= expiry:
+                self._remove(message_id)
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(message_id)
+            self.hits += 1
+            return message
+
+    def put(self, message: Message) -> None:
+        # Remember the ids at insertion time: callers may append children later.
+        member_ids = _thread_ids(message)
+        with self._lock:
+            if message.id in self._entries:
+                self._remove(message.id)
+            self._entries[message.id] = (self._clock() + self._ttl, message, member_ids)
+            for member_id in member_ids:
+                self._containing.setdefault(member_id, set()).add(message.id)
+            while len(self._entries) > self._max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, message_id: str) -> None:
+        """Drops every cached thread which contains message_id."""
+        with self._lock:
+            for root_id in list(self._containing.get(message_id, ())):
+                self._remove(root_id)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def _remove(self, root_id: str) -> None:
+        _, _, member_ids = self._entries.pop(root_id)
+        for member_id in member_ids:
+            containing = self._containing[member_id]
+            containing.discard(root_id)
+            if not containing:
+                del self._containing[member_id]
 
 class MessageDao(object):
-    def __init__(self, archive_path: str) -> None:
+    def __init__(self, archive_path: str, email_store: Optional[EmailStore] = None,
+                 backend: Optional[StorageBackend] = None,
+                 known_ids_path: Optional[str] = None) -> None:
         """ Creates a connection as well as two tables: Messages and States.
         Message stores the messages we've uploaded and States is a key-value
         store which tracks things like 'last_hash', the last Lore git commit
-        we've processed."""
-        self._initialize_connection()
+        we've processed. Tables are kept in Cloud SQL unless another backend
+        is given. Raw emails are read from email_store when it has them and
+        from the archive otherwise. If known_ids_path is given, a filter of
+        every stored message id is kept there to answer contains_many."""
+        self.backend = backend or CloudSqlBackend()
+        self.backend.initialize()
         self._initialize_tables()
         self.archive_path = archive_path
+        self.email_store = email_store
+        # Every thread has its own connection, and so its own write buffers
+        self._local = threading.local()
+        self.cache = ThreadCache()
+        self.known_ids_path = known_ids_path
+        self.known_ids : Optional[BloomFilter] = None
+        # Number of committed messages, kept up to date while known_ids is used
+        self._stored_count = 0
+        self._stored_count_lock = threading.Lock()
+        self._known_ids_saved_at = time.monotonic()
+        if known_ids_path:
+            self.known_ids = self._load_known_ids()
+
+    def _load_known_ids(self) -> BloomFilter:
+        """ Loads the saved filter of known message ids. The filter is saved
+        with the number of stored messages; messages are never deleted, so if
+        that number changed, messages were stored without being added to the
+        saved filter and it is rebuilt."""
+        self._stored_count = self.size()
+        known_ids = BloomFilter.load(self.known_ids_path)
+        if known_ids is None or known_ids.checkpoint != self._stored_count or known_ids.is_full():
+            known_ids = self._build_known_ids(self._stored_count)
+        return known_ids
+
+    def _build_known_ids(self, size: int) -> BloomFilter:
+        logging.info('Building the filter of known message ids from %d messages', size)
+        known_ids = BloomFilter(capacity=max(bloom_filter.CAPACITY, 2 * size))
+        with self.backend.cursor() as cursor:
+            cursor.execute("SELECT message_id FROM Messages")
+            known_ids.update(message_id for message_id, in cursor.fetchall())
+        return known_ids
+
+    def _save_known_ids(self) -> None:
+        """ Saves the filter along with the number of committed messages, which
+        is counted as they are written rather than queried."""
+        with self._stored_count_lock:
+            size = self._stored_count
+        if self.known_ids.is_full():
+            self.known_ids = self._build_known_ids(size)
+        self.known_ids.save(self.known_ids_path, checkpoint=size)
+        self._known_ids_saved_at = time.monotonic()
+
+    def _buffer(self, name: str) -> Dict[str, Tuple]:
+        buffer = getattr(self._local, name, None)
+        if buffer is None:
+            buffer = {}
+            setattr(self._local, name, buffer)
+        return buffer
 
-    def _initialize_connection(self) -> None:
-        connector = Connector()
-        self.connection = connector.connect(
-            os.environ.get("HOST"),
-            "pymysql",
-            user = os.environ.get("USER"),
-            password = os.environ.get("PASSWORD")
-        )
+    @property
+    def _pending(self) -> Dict[str, Tuple]:
+        """Messages waiting to be written by this thread, keyed by message id."""
+        return self._buffer('pending')
+
+    @property
+    def _uncommitted(self) -> Dict[str, Tuple]:
+        """Messages written by this thread but not yet committed, keyed by message id."""
+        return self._buffer('uncommitted')
+
+    @property
+    def _pending_orphans(self) -> Dict[str, Tuple]:
+        """Orphans waiting to be written by this thread, keyed by message id."""
+        return self._buffer('pending_orphans')
+
+    @property
+    def _uncommitted_orphans(self) -> Dict[str, Tuple]:
+        """Orphans written by this thread but not yet committed, keyed by message id."""
+        return self._buffer('uncommitted_orphans')
+
+    def _has_uncommitted_changes(self) -> bool:
+        return bool(self._uncommitted or self._uncommitted_orphans
+                    or getattr(self._local, 'uncommitted_deletes', False))
+
+    @contextlib.contextmanager
+    def _read_cursor(self):
+        """ Yields a cursor for reads. Afterwards the connection goes back to
+        the pool, unless this thread still has changes to commit on it, so
+        threads which only read never hold on to a connection."""
+        with self.backend.cursor() as cursor:
+            yield cursor
+        if not self._has_uncommitted_changes():
+            self.backend.release()
+
+    def _reconnect(self) -> None:
+        self.backend.reconnect()
+        self._local.uncommitted_deletes = False
+        self._local.uncommitted_new_messages = 0
+        # The rows written in the lost transaction have to be written again.
+        for pending, uncommitted in [(self._pending, self._uncommitted),
+                                     (self._pending_orphans, self._uncommitted_orphans)]:
+            rows = dict(uncommitted)
+            rows.update(pending)
+            pending.clear()
+            pending.update(rows)
+            uncommitted.clear()
+
+    def _committed(self) -> None:
+        self._uncommitted.clear()
+        self._uncommitted_orphans.clear()
+        self._local.uncommitted_deletes = False
+        with self._stored_count_lock:
+            self._stored_count += getattr(self._local, 'uncommitted_new_messages', 0)
+        self._local.uncommitted_new_messages = 0
 
     def _initialize_tables(self) -> None:
-        db_name = os.environ.get("DB")
-        if not db_name:
-            raise Exception("Missing environment variable for name of database.")
-        with self.connection.cursor() as cursor:
-            cursor.execute("CREATE DATABASE IF NOT EXISTS " + db_name)
-            self.connection.select_db(db_name)
+        with self.backend.cursor() as cursor:
             # Mapping from message id to message
             cursor.execute(
                 "CREATE TABLE IF NOT EXISTS Messages"
@@ -71,42 +386,201 @@ class MessageDao(object):
                 "value VARCHAR(255) NOT NULL,"
                 "PRIMARY KEY (state_name))"
             )
-        self.connection.commit()
+        self.backend.commit()
+        self._migrate()
+
+    def _get_schema_version(self) -> int:
+        with self.backend.cursor() as cursor:
+            cursor.execute("SELECT value FROM States WHERE state_name=%s", ('schema_version',))
+            res = cursor.fetchone()
+        return int(res[0]) if res else 0
+
+    def _migrate(self) -> None:
+        """ Applies the migrations the database has not seen yet. The version is
+        recorded after every migration, so an interrupted upgrade resumes where
+        it stopped. The migration that was interrupted is run again, so every
+        migration has to be safe to rerun."""
+        version = self._get_schema_version()
+        for migration in MIGRATIONS[version:]:
+            version += 1
+            logging.info('Migrating database to schema version %d with %s', version, migration.__name__)
+            with self.backend.cursor() as cursor:
+                migration(self.backend, cursor)
+                cursor.execute("REPLACE INTO States VALUES (%s, %s)", ('schema_version', str(version)))
+            self.backend.commit()
 
     def store(self, message: Message) -> None:
-        link = lore_link(message.id)
-        query = "REPLACE INTO Messages VALUES (%s, %s, %s, %s, %s, %s, %s)"
-        with self.connection.cursor() as cursor:
-            cursor.execute(query, (message.id, message.normalized_subject, message.from_,
-            message.in_reply_to, message.archive_hash, message.change_id, link))
-        if message.in_reply_to:
-            # Clear cache because the parent's cache is no longer valid: list of children changed
-            self.get.cache_clear()
-        self.connection.commit()
-
-    def _get_children(self, message_id: str) -> List[Optional[Message]]:
-        query = "SELECT * FROM Messages WHERE in_reply_to=%s"
-        with self.connection.cursor() as cursor:
-            cursor.execute(query, (message_id,))
-            res = cursor.fetchall()
-        return [self.get(tup[0]) for tup in res]
+        self.store_many([message])
+
+    def store_many(self, messages: Iterable[Message]) -> None:
+        """ Buffers messages to be written to the database. Buffered rows are
+        written with a single executemany before the next read and are committed
+        by commit() or store_last_hash(), or once COMMIT_EVERY rows are waiting."""
+        for message in messages:
+            self._pending[message.id] = (message.id, message.normalized_subject, message.from_,
+                                         message.in_reply_to, message.archive_hash, message.change_id,
+                                         lore_link(message.id), message.commit_time)
+            # Cached threads containing the message or its parent are no longer valid.
+            self.cache.invalidate(message.id)
+            if message.in_reply_to:
+                self.cache.invalidate(message.in_reply_to)
+        if len(self._pending) + len(self._uncommitted) >= COMMIT_EVERY:
+            self.commit()
+
+    def _flush(self) -> None:
+        """ Writes buffered messages and orphans without committing them, so
+        that reads on this connection see them."""
+        if self._pending_orphans:
+            with self.backend.cursor() as cursor:
+                cursor.executemany("REPLACE INTO Orphans VALUES (%s, %s, %s, %s)",
+                                   list(self._pending_orphans.values()))
+            self._uncommitted_orphans.update(self._pending_orphans)
+            self._pending_orphans.clear()
+        if not self._pending:
+            return
+        thread_roots = self._thread_roots()
+        query = (f"REPLACE INTO Messages ({', '.join(MESSAGE_COLUMNS)}) "
+                 f"VALUES ({', '.join(['%s'] * len(MESSAGE_COLUMNS))})")
+        rows = [row + (thread_roots.get(message_id),) for message_id, row in self._pending.items()]
+        with self.backend.cursor() as cursor:
+            if self.known_ids is not None:
+                # Ids missing from the filter are new for certain, only the rest are looked up.
+                stored = self._select_stored(cursor, [message_id for message_id in self._pending
+                                                      if message_id in self.known_ids])
+                self._local.uncommitted_new_messages = (getattr(self._local, 'uncommitted_new_messages', 0)
+                                                        + len(self._pending) - len(stored))
+            cursor.executemany(query, rows)
+        if self.known_ids is not None:
+            self.known_ids.update(self._pending)
+        self._uncommitted.update(self._pending)
+        self._pending.clear()
+
+    def _thread_roots(self) -> Dict[str, Optional[str]]:
+        """ Works out the thread root of every buffered message, following
+        parents through the buffer first and looking the rest up in one query.
+        Roots which cannot be resolved yet are left NULL."""
+        in_reply_to = {message_id: row[3] for message_id, row in self._pending.items()}
+        outside = {parent for parent in in_reply_to.values()
+                   if parent is not None and parent not in in_reply_to}
+        roots : Dict[str, Optional[str]] = {}
+        if outside:
+            placeholders = ', '.join(['%s'] * len(outside))
+            with self.backend.cursor() as cursor:
+                cursor.execute(f"SELECT message_id, thread_root FROM Messages "
+                               f"WHERE message_id IN ({placeholders})", tuple(outside))
+                roots.update(cursor.fetchall())
+
+        def resolve(message_id: str) -> Optional[str]:
+            chain = []
+            while message_id in in_reply_to and message_id not in roots:
+                chain.append(message_id)
+                parent = in_reply_to[message_id]
+                if parent is None:
+                    roots[message_id] = message_id
+                    break
+                if parent in chain:
+                    # A reply loop has no root.
+                    roots[message_id] = None
+                    break
+                message_id = parent
+            root = roots.get(message_id)
+            for member in chain:
+                roots.setdefault(member, root)
+            return root
+
+        for message_id in in_reply_to:
+            resolve(message_id)
+        return roots
+
+    @_retry_on_disconnect
+    def commit(self) -> None:
+        self._flush()
+        self.backend.commit()
+        self._committed()
+        self.backend.release()
 
-    @lru_cache
     def get(self, message_id: str) -> Optional[Message]:
-        query = "SELECT archive_hash, change_id FROM Messages WHERE message_id=%s"
-        with self.connection.cursor() as cursor:
-            cursor.execute(query, (message_id,))
-            res = cursor.fetchone()
-        if res is None:
+        message = self.cache.get(message_id)
+        if message is None:
+            message = self.get_thread(message_id)
+            if message is not None:
+                self.cache.put(message)
+        return message
+
+    def invalidate(self, message_id: str) -> None:
+        """ Drops the cached threads containing message_id. Threads returned by
+        get are shared through the cache, so this must be called before
+        changing one of their messages."""
+        self.cache.invalidate(message_id)
+
+    @_retry_on_disconnect
+    def get_thread(self, root_id: str) -> Optional[Message]:
+        """ Loads a message along with all of its descendants, linked through
+        message.children. The whole thread is fetched with a single query and
+        the emails missing from the email store are read from the archive over
+        a single git process."""
+        self._flush()
+        # UNION rather than UNION ALL so that a reply loop cannot recurse forever.
+        query = ("WITH RECURSIVE Thread (message_id, in_reply_to, archive_hash, change_id, commit_time) AS ("
+                 "SELECT message_id, in_reply_to, archive_hash, change_id, commit_time FROM Messages WHERE message_id=%s "
+                 "UNION "
+                 "SELECT m.message_id, m.in_reply_to, m.archive_hash, m.change_id, m.commit_time "
+                 "FROM Messages m JOIN Thread t ON m.in_reply_to = t.message_id) "
+                 "SELECT message_id, in_reply_to, archive_hash, change_id, commit_time FROM Thread")
+        with self._read_cursor() as cursor:
+            cursor.execute(query, (root_id,))
+            rows = cursor.fetchall()
+        if not rows:
             return None
-        archive_hash, change_id = res[0], res[1]
-        # Recreate the message object using the archive hash
-        raw_email = subprocess.check_output(['git', '-C', self.archive_path, 'show', f'{archive_hash}:m'])
-        msg = parse_message_from_str(raw_email.decode(), archive_hash=archive_hash)
-        msg.change_id = change_id
-        msg.children = self._get_children(message_id)
-        return msg
 
+        raw_emails = self._read_raw_emails([archive_hash for _, _, archive_hash, _, _ in rows])
+        messages : Dict[str, Message] = {}
+        for message_id, _, archive_hash, change_id, commit_time in rows:
+            raw_email = raw_emails.get(archive_hash)
+            if raw_email is None:
+                if message_id == root_id:
+                    raise ValueError(f'Could not read {archive_hash} from the archive for {message_id}')
+                continue
+            # The body is read again if it is ever needed.
+            msg = parse_message_from_bytes(raw_email, archive_hash=archive_hash,
+                                           load_raw_email=self._read_raw_email)
+            msg.change_id = change_id
+            msg.commit_time = commit_time
+            messages[message_id] = msg
+
+        for message_id, in_reply_to, *_ in rows:
+            if message_id != root_id and message_id in messages and in_reply_to in messages:
+                messages[in_reply_to].children.append(messages[message_id])
+        return messages[root_id]
+
+    def _read_raw_emails(self, archive_hashes: List[str]) -> Dict[str, Optional[bytes]]:
+        """ Reads raw emails from the email store, and any it is missing from
+        the archive over a single git process."""
+        raw_emails : Dict[str, Optional[bytes]] = {}
+        missing = []
+        for archive_hash in archive_hashes:
+            raw_email = self.email_store.get(archive_hash) if self.email_store is not None else None
+            if raw_email is None:
+                missing.append(archive_hash)
+            raw_emails[archive_hash] = raw_email
+        if missing:
+            with archive_updater.BlobReader(self.archive_path) as reader:
+                for archive_hash in missing:
+                    raw_email = reader.read(f'{archive_hash}:m')
+                    if raw_email is not None and self.email_store is not None:
+                        self.email_store.put(archive_hash, raw_email)
+                    raw_emails[archive_hash] = raw_email
+        return raw_emails
+
+    def _read_raw_email(self, archive_hash: str) -> bytes:
+        raw_email = self.email_store.get(archive_hash) if self.email_store is not None else None
+        if raw_email is None:
+            raw_email = subprocess.check_output(['git', '-C', self.archive_path, 'show', f'{archive_hash}:m'])
+            if self.email_store is not None:
+                self.email_store.put(archive_hash, raw_email)
+        return raw_email
+
+    @_retry_on_disconnect
     def find_matching(self, normalized_subject: str = "", from_: str = "") -> List[Message]:
         criteria = {
             "normalized_subject": normalized_subject,
@@ -119,53 +593,229 @@ class MessageDao(object):
         clauses = [f' {attr}=%s' for attr, _ in non_empty]
         values = [value for _, value in non_empty]
 
+        self._flush()
         query = "SELECT message_id FROM Messages WHERE change_id IS NOT NULL AND" + " AND".join(clauses)
-        with self.connection.cursor() as cursor:
+        with self._read_cursor() as cursor:
             cursor.execute(query, tuple(values))
             res = cursor.fetchall()
         return [self.get(tup[0]) for tup in res]
 
+    @_retry_on_disconnect
+    def contains_many(self, message_ids: Iterable[str]) -> Set[str]:
+        """ Returns which of message_ids are stored. Ids missing from the filter
+        of known ids are certainly new and are not looked up; the rest are
+        looked up CONTAINS_CHUNK_SIZE at a time."""
+        candidates = [message_id for message_id in set(message_ids)
+                      if self.known_ids is None or message_id in self.known_ids
+                      or message_id in self._pending]
+        if not candidates:
+            return set()
+        self._flush()
+        with self._read_cursor() as cursor:
+            return self._select_stored(cursor, candidates)
+
+    @staticmethod
+    def _select_stored(cursor, message_ids: List[str]) -> Set[str]:
+        found : Set[str] = set()
+        for start in range(0, len(message_ids), CONTAINS_CHUNK_SIZE):
+            chunk = message_ids[start:start + CONTAINS_CHUNK_SIZE]
+            placeholders = ', '.join(['%s'] * len(chunk))
+            cursor.execute(f"SELECT message_id FROM Messages WHERE message_id IN ({placeholders})",
+                           tuple(chunk))
+            found.update(message_id for message_id, in cursor.fetchall())
+        return found
+
+    def store_orphans(self, orphans: Iterable[Message]) -> None:
+        """ Holds replies whose parent has not been stored yet, keyed by the
+        parent's id, until take_orphans is called with it. Orphans are buffered
+        and committed like messages."""
+        received_at = int(time.time())
+        for orphan in orphans:
+            self._pending_orphans[orphan.id] = (orphan.id, orphan.in_reply_to, orphan.archive_hash, received_at)
+
+    @_retry_on_disconnect
+    def take_orphans(self, parent_ids: Iterable[str]) -> List[Message]:
+        """ Removes and returns the orphans waiting for any of parent_ids. The
+        removal is committed along with whatever is stored next."""
+        parent_ids = list(set(parent_ids))
+        if not parent_ids:
+            return []
+        self._flush()
+        rows = []
+        with self.backend.cursor() as cursor:
+            for start in range(0, len(parent_ids), CONTAINS_CHUNK_SIZE):
+                chunk = parent_ids[start:start + CONTAINS_CHUNK_SIZE]
+                placeholders = ', '.join(['%s'] * len(chunk))
+                cursor.execute(f"SELECT message_id, archive_hash FROM Orphans WHERE parent_id IN ({placeholders})",
+                               tuple(chunk))
+                rows.extend(cursor.fetchall())
+            if rows:
+                cursor.executemany("DELETE FROM Orphans WHERE message_id=%s", [(message_id,) for message_id, _ in rows])
+                self._local.uncommitted_deletes = True
+        # An orphan can only have been stored already if its removal was lost.
+        stored = self.contains_many(message_id for message_id, _ in rows)
+        raw_emails = self._read_raw_emails([archive_hash for message_id, archive_hash in rows
+                                            if message_id not in stored])
+        orphans = []
+        for message_id, archive_hash in rows:
+            raw_email = raw_emails.get(archive_hash)
+            if message_id in stored:
+                continue
+            if raw_email is None:
+                logging.warning('Could not read %s from the archive, dropping orphan %s', archive_hash, message_id)
+                continue
+            orphans.append(parse_message_from_bytes(raw_email, archive_hash=archive_hash,
+                                                    load_raw_email=self._read_raw_email))
+        return orphans
+
+    @_retry_on_disconnect
+    def expire_orphans(self, ttl: int = ORPHAN_TTL, max_orphans: int = MAX_ORPHANS) -> int:
+        """ Gives up on orphans held for longer than ttl seconds, and on the
+        oldest ones beyond max_orphans. Returns the number dropped."""
+        self._flush()
+        with self.backend.cursor() as cursor:
+            expired = cursor.execute("DELETE FROM Orphans WHERE received_at < %s", (int(time.time()) - ttl,))
+            cursor.execute("SELECT COUNT(*) FROM Orphans")
+            excess = cursor.fetchone()[0] - max_orphans
+            if excess > 0:
+                cursor.execute(f"SELECT message_id FROM Orphans ORDER BY received_at LIMIT {excess}")
+                cursor.executemany("DELETE FROM Orphans WHERE message_id=%s", list(cursor.fetchall()))
+                expired += excess
+        if expired:
+            self._local.uncommitted_deletes = True
+            logging.info('Gave up on %d replies whose parent never arrived', expired)
+        return expired
+
+    @_retry_on_disconnect
+    def get_posted_replies(self, change_id: str) -> Set[str]:
+        """Returns the ids of the replies whose comments were posted to change_id."""
+        with self._read_cursor() as cursor:
+            cursor.execute("SELECT message_id FROM PostedReplies WHERE change_id=%s", (change_id,))
+            return {message_id for message_id, in cursor.fetchall()}
+
+    @_retry_on_disconnect
+    def mark_replies_posted(self, change_id: str, revision_id: Optional[str], reply_ids: Iterable[str]) -> None:
+        """ Records that the comments of reply_ids were posted to a revision of
+        change_id. A post to Gerrit can't be taken back, so this is committed
+        right away instead of waiting for the next last hash. Messages which
+        are still buffered stay buffered."""
+        posted_at = int(time.time())
+        rows = [(message_id, change_id, revision_id, posted_at) for message_id in set(reply_ids)]
+        with self.backend.cursor() as cursor:
+            cursor.executemany("REPLACE INTO PostedReplies VALUES (%s,%s,%s,%s)", rows)
+        self.backend.commit()
+        self._committed()
+        self.backend.release()
+
+    @_retry_on_disconnect
     def size(self) -> int:
+        self._flush()
         query = "SELECT COUNT(*) FROM Messages"
-        with self.connection.cursor() as cursor:
+        with self._read_cursor() as cursor:
             cursor.execute(query)
             res = cursor.fetchone()
         return res[0]
 
-    def store_last_hash(self, last_hash: str) -> None:
+    @_retry_on_disconnect
+    def store_last_hash(self, last_hash: str, epoch: int = 0) -> None:
+        """ Stores the last processed commit hash in the same transaction as any
+        buffered messages, so progress is never recorded past unsaved messages."""
+        self._flush()
         query = "REPLACE INTO States VALUES (%s, %s)"
-        with self.connection.cursor() as cursor:
-            cursor.execute(query, ("last_hash", last_hash))
-        self.connection.commit()
+        with self.backend.cursor() as cursor:
+            cursor.execute(query, (_last_hash_state(epoch), last_hash))
+        self.backend.commit()
+        self._committed()
+        if self.known_ids is not None and time.monotonic() - self._known_ids_saved_at >= KNOWN_IDS_SAVE_INTERVAL:
+            self._save_known_ids()
+        self.backend.release()
 
-    def get_last_hash(self) -> str:
+    @_retry_on_disconnect
+    def get_last_hash(self, epoch: int = 0) -> Optional[str]:
+        """Returns the last processed commit in the given epoch of the archive.
+        None means that nothing in the epoch has been processed yet."""
         query = "SELECT value FROM States WHERE state_name=%s"
-        with self.connection.cursor() as cursor:
-            cursor.execute(query, ("last_hash"))
+        with self._read_cursor() as cursor:
+            cursor.execute(query, (_last_hash_state(epoch),))
             res = cursor.fetchone()
-        return EPOCH_HASH if res is None else res[0]
+        if res is None:
+            return _default_last_hash(epoch)
+        return res[0]
+
+    def close(self) -> None:
+        """ Saves the filter of known message ids, so that the next run can
+        reuse it instead of rebuilding it. Called when the server stops."""
+        if self.known_ids is not None:
+            self._save_known_ids()
 
 
 class FakeMessageDao(MessageDao):
     def __init__(self) -> None:
         # Maps message.id to message
         self._messages_seen = {}
-        self.last_hash = EPOCH_HASH
+        # Maps epoch to the last processed commit hash
+        self.last_hashes = {}
+        # Maps message.id to replies held until their parent is stored
+        self._orphans = {}
+        # Maps Gerrit change id to the ids of the replies posted to it
+        self._posted_replies = {}
 
     def store(self, message: Message) -> None:
         self._messages_seen[message.id] = message
 
+    def store_many(self, messages: Iterable[Message]) -> None:
+        for message in messages:
+            self.store(message)
+
+    def commit(self) -> None:
+        pass
+
     def get(self, message_id: str) -> Optional[Message]:
         return self._messages_seen.get(message_id)
 
+    def invalidate(self, message_id: str) -> None:
+        pass
+
+    def contains_many(self, message_ids: Iterable[str]) -> Set[str]:
+        return {message_id for message_id in message_ids if message_id in self._messages_seen}
+
+    def store_orphans(self, orphans: Iterable[Message]) -> None:
+        for orphan in orphans:
+            self._orphans[orphan.id] = orphan
+
+    def take_orphans(self, parent_ids: Iterable[str]) -> List[Message]:
+        parent_ids = set(parent_ids)
+        taken = [orphan for orphan in self._orphans.values() if orphan.in_reply_to in parent_ids]
+        for orphan in taken:
+            del self._orphans[orphan.id]
+        return taken
+
+    def expire_orphans(self, ttl: int = ORPHAN_TTL, max_orphans: int = MAX_ORPHANS) -> int:
+        excess = max(0, len(self._orphans) - max_orphans)
+        for message_id in list(self._orphans)[:excess]:
+            del self._orphans[message_id]
+        return excess
+
+    def get_posted_replies(self, change_id: str) -> Set[str]:
+        return set(self._posted_replies.get(change_id, ()))
+
+    def mark_replies_posted(self, change_id: str, revision_id: Optional[str], reply_ids: Iterable[str]) -> None:
+        self._posted_replies.setdefault(change_id, set()).update(reply_ids)
+
+    def get_thread(self, root_id: str) -> Optional[Message]:
+        return self.get(root_id)
+
     def size(self) -> int:
         return len(self._messages_seen)
 
-    def store_last_hash(self, last_hash: str) -> None:
-        self.last_hash = last_hash
+    def store_last_hash(self, last_hash: str, epoch: int = 0) -> None:
+        self.last_hashes[epoch] = last_hash
+
+    def get_last_hash(self, epoch: int = 0) -> Optional[str]:
+        return self.last_hashes.get(epoch, _default_last_hash(epoch))
 
-    def get_last_hash(self) -> int:
-        return self.last_hash
+    def close(self) -> None:
+        pass
 
     def find_matching(self, normalized_subject: str = "", from_: str = "") -> List[Message]:
         criteria = {
@@ -1,3 +1,6 @@
+import itertools
+import tempfile
+import threading
 import unittest
 import subprocess
 import zlib
@@ -5,10 +8,15 @@ import zlib
 from unittest import mock
 from google.cloud.sql.connector import Connector
 
+import pymysql
+
+import archive_updater
+import email_store
 import message
 import message_dao
 import archive_converter
-from test_helpers import test_data_path
+import storage_backend
+from test_helpers import read_test_emails, test_data_path
 
 class StrContains(str):
    def __eq__(self, other):
@@ -23,42 +31,217 @@ class MessageDaoTest(unittest.TestCase):
         self.mock_commit = mock_connection.commit
         self.mock_cursor = mock_connection.cursor.return_value.__enter__.return_value
         self.mock_execute = self.mock_cursor.execute
-        # Check initialization of DAO
+        # Check initialization of DAO against an up to date schema
+        self.mock_cursor.fetchone.return_value = (str(len(message_dao.MIGRATIONS)),)
         self.dao = message_dao.MessageDao('FAKE_GIT_PATH')
         self.mock_connect.assert_called_once()
         self.mock_commit.assert_called_once()
-        self.assertEqual(3, self.mock_execute.call_count)
+        self.assertEqual(4, self.mock_execute.call_count)
         self.mock_execute.reset_mock()
         self.mock_commit.reset_mock()
+        self.mock_cursor.fetchone.reset_mock(return_value=True)
         self.mock_connect.side_effect = RuntimeError("Shouldn't be called after init")
 
+    def test_migrate_from_scratch(self):
+        self.mock_connect.side_effect = None
+        self.mock_cursor.fetchone.return_value = None
+        message_dao.MessageDao('FAKE_GIT_PATH')
+        self.mock_execute.assert_any_call(StrContains("ADD INDEX in_reply_to_index"))
+        self.mock_execute.assert_any_call(StrContains("ADD COLUMN thread_root"))
+        self.mock_execute.assert_any_call("REPLACE INTO States VALUES (%s, %s)",
+                                          ('schema_version', str(len(message_dao.MIGRATIONS))))
+        # One commit for the base tables and one per migration
+        self.assertEqual(1 + len(message_dao.MIGRATIONS), self.mock_commit.call_count)
+
+    def test_migrate_resumes_from_stored_version(self):
+        self.mock_connect.side_effect = None
+        self.mock_cursor.fetchone.return_value = ('1',)
+        message_dao.MessageDao('FAKE_GIT_PATH')
+        self.assertNotIn(mock.call(StrContains("ADD INDEX in_reply_to_index")), self.mock_execute.call_args_list)
+        self.mock_execute.assert_any_call(StrContains("ADD COLUMN thread_root"))
+
+    def test_migrate_skips_existing_schema_changes(self):
+        # The DDL of migration 2 was committed, but not its version.
+        self.mock_connect.side_effect = None
+        self.mock_cursor.fetchone.return_value = ('1',)
+        self.mock_cursor.fetchall.side_effect = itertools.chain(
+            [[('commit_time',), ('thread_root',)], [('PRIMARY',), ('thread_root_index',)]], itertools.repeat([]))
+        message_dao.MessageDao('FAKE_GIT_PATH')
+        self.assertNotIn(mock.call(StrContains("ALTER TABLE Messages")), self.mock_execute.call_args_list)
+        self.mock_execute.assert_any_call("REPLACE INTO States VALUES (%s, %s)",
+                                          ('schema_version', str(len(message_dao.MIGRATIONS))))
+
     def test_store(self):
         email = archive_converter.generate_email_from_file(test_data_path('patch6.txt'))
-        sql_text = "REPLACE INTO Messages VALUES (%s, %s, %s, %s, %s, %s, %s)"
+        sql_text = ("REPLACE INTO Messages (message_id, normalized_subject, from_, in_reply_to, archive_hash, "
+                    "change_id, lore_link, commit_time, thread_root) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)")
         self.dao.store(email)
-        self.mock_execute.assert_called_once_with(sql_text, mock.ANY)
+        # Writes are buffered until the next read or commit.
+        self.mock_cursor.executemany.assert_not_called()
+        self.mock_commit.assert_not_called()
+        self.dao.commit()
+        self.mock_cursor.executemany.assert_called_once_with(sql_text, [mock.ANY])
         self.mock_commit.assert_called_once()
 
-    @mock.patch.object(subprocess, 'check_output')
-    @mock.patch.object(message_dao, 'parse_message_from_str')
-    def test_get(self, mock_parse_msg, mock_check_output):
+    def test_store_many_commits_with_last_hash(self):
+        emails = [archive_converter.generate_email_from_file(test_data_path(f'thread_patch{i}.txt')) for i in range(3)]
+        self.dao.store_many(emails)
+        self.dao.store_last_hash("some_hash")
+        self.mock_cursor.executemany.assert_called_once_with(mock.ANY, [mock.ANY] * 3)
+        self.mock_execute.assert_called_once_with("REPLACE INTO States VALUES (%s, %s)", ("last_hash", "some_hash"))
+        self.mock_commit.assert_called_once()
+
+    def test_store_resolves_thread_roots(self):
+        emails = [archive_converter.generate_email_from_file(test_data_path(f'thread_patch{i}.txt')) for i in range(3)]
+        root_id = emails[0].id
+        # The root is already in the database; its replies are looked up there.
+        self.dao.store_many(emails[1:])
+        self.mock_cursor.fetchall.return_value = [(root_id, root_id)]
+        self.dao.commit()
+        self.mock_execute.assert_called_once_with(StrContains("SELECT message_id, thread_root"), (root_id,))
+        rows = self.mock_cursor.executemany.call_args[0][1]
+        self.assertEqual([row[-1] for row in rows], [root_id, root_id])
+
+        self.mock_execute.reset_mock()
+        self.dao.store_many(emails)
+        self.dao.commit()
+        # The whole thread is buffered, so no lookup is needed.
+        self.mock_execute.assert_not_called()
+        rows = self.mock_cursor.executemany.call_args[0][1]
+        self.assertEqual([row[-1] for row in rows], [root_id] * 3)
+
+    def test_store_commits_every_n_rows(self):
+        emails = [archive_converter.generate_email_from_file(test_data_path(f'thread_patch{i}.txt')) for i in range(3)]
+        with mock.patch.object(message_dao, 'COMMIT_EVERY', 2):
+            self.dao.store_many(emails[:1])
+            self.mock_commit.assert_not_called()
+            self.dao.store_many(emails[1:])
+        self.mock_cursor.executemany.assert_called_once_with(mock.ANY, [mock.ANY] * 3)
+        self.mock_commit.assert_called_once()
+
+    def test_commit_replays_rows_after_lost_connection(self):
+        emails = [archive_converter.generate_email_from_file(test_data_path(f'thread_patch{i}.txt')) for i in range(3)]
+        self.mock_connect.side_effect = None
+        self.dao.store_many(emails[:2])
+        self.dao.size()
+        self.dao.store_many(emails[2:])
+        self.mock_cursor.executemany.reset_mock()
+        # The commit fails and the two rows written before it are lost with the connection.
+        self.mock_commit.side_effect = [pymysql.err.OperationalError(2013, 'Lost connection'), None]
+        self.dao.commit()
+        self.assertEqual(2, self.mock_connect.call_count)
+        self.assertEqual(2, self.mock_commit.call_count)
+        self.mock_cursor.executemany.assert_has_calls([mock.call(mock.ANY, [mock.ANY]),
+                                                       mock.call(mock.ANY, [mock.ANY] * 3)])
+
+    def test_other_errors_are_not_retried(self):
+        self.mock_execute.side_effect = pymysql.err.ProgrammingError(1064, 'Syntax error')
+        with self.assertRaises(pymysql.err.ProgrammingError):
+            self.dao.get_last_hash()
+        self.mock_execute.assert_called_once()
+
+    def test_get_sees_buffered_messages(self):
         self.mock_commit.side_effect = RuntimeError("Shouldn't be called during get")
+        self.mock_cursor.fetchall.return_value = []
         email = archive_converter.generate_email_from_file(test_data_path('patch6.txt'))
-        mock_parse_msg.return_value = email
-        self.mock_cursor.fetchone.return_value = (email.archive_hash, email.change_id)
-        self.assertEqual(email, self.dao.get('fake_message_id'))
-        self.assertEqual(2, self.mock_execute.call_count)
-        self.mock_execute.assert_has_calls([
-            mock.call(StrContains("WHERE message_id=%s"), mock.ANY),  # get this msg
-            mock.call(StrContains("WHERE in_reply_to=%s"), mock.ANY),  # get children
-        ])
+        self.dao.store(email)
+        self.dao.get(email.id)
+        self.mock_cursor.executemany.assert_called_once()
+
+    @mock.patch.object(subprocess, 'check_output')
+    @mock.patch.object(archive_updater, 'BlobReader')
+    def test_get(self, mock_blob_reader, mock_check_output):
+        self.mock_commit.side_effect = RuntimeError("Shouldn't be called during get")
+        with open(test_data_path('patch6.txt'), 'rb') as f:
+            raw_email = f.read()
+        email = archive_converter.generate_email_from_bytes('patch6', raw_email)
+        mock_blob_reader.return_value.__enter__.return_value.read.return_value = raw_email
+        # The body is only read again once the content is compared.
+        mock_check_output.return_value = raw_email
+        self.mock_cursor.fetchall.return_value = [(email.id, None, 'patch6', None, None)]
+        self.assertEqual(email, self.dao.get(email.id))
+        # The whole thread is loaded with a single query.
+        self.mock_execute.assert_called_once_with(StrContains("WITH RECURSIVE"), (email.id,))
+
+    @mock.patch.object(archive_updater, 'BlobReader')
+    def test_get_thread(self, mock_blob_reader):
+        raw_emails = {}
+        for i in range(3):
+            with open(test_data_path(f'thread_patch{i}.txt'), 'rb') as f:
+                raw_emails[f'thread_patch{i}:m'] = f.read()
+        reader = mock_blob_reader.return_value.__enter__.return_value
+        reader.read.side_effect = lambda object_name: raw_emails[object_name]
+        root_id = '<20200831110450.30188-1-boyan.karatotev@arm.com>'
+        self.mock_cursor.fetchall.return_value = [
+            (root_id, None, 'thread_patch0', None, 1598872000),
+            ('<20200831110450.30188-2-boyan.karatotev@arm.com>', root_id, 'thread_patch1', '1', None),
+            ('<20200831110450.30188-3-boyan.karatotev@arm.com>', root_id, 'thread_patch2', '2', None),
+        ]
+
+        thread = self.dao.get_thread(root_id)
+
+        self.assertEqual(thread.id, root_id)
+        self.assertEqual(thread.commit_time, 1598872000)
+        self.assertEqual([child.change_id for child in thread.children], ['1', '2'])
+        self.mock_execute.assert_called_once()
+        mock_blob_reader.assert_called_once_with('FAKE_GIT_PATH')
+        self.assertEqual(reader.read.call_count, 3)
+
+    @mock.patch.object(subprocess, 'check_output')
+    @mock.patch.object(archive_updater, 'BlobReader')
+    def test_get_thread_reads_email_store(self, mock_blob_reader, mock_check_output):
+        with open(test_data_path('patch6.txt'), 'rb') as f:
+            raw_email = f.read()
+        mock_blob_reader.return_value.__enter__.return_value.read.return_value = raw_email
+        self.mock_cursor.fetchall.return_value = [('<id>', None, 'patch6', None, None)]
+        with tempfile.TemporaryDirectory() as tmp_dir, email_store.EmailStore(tmp_dir) as store:
+            self.dao.email_store = store
+            # The first read falls back to git and fills the store.
+            self.dao.get_thread('<id>')
+            mock_blob_reader.assert_called_once()
+            self.assertIn('patch6', store)
+
+            thread = self.dao.get_thread('<id>')
+            thread.release_content()
+            self.assertTrue(len(thread.content) > 0)
+            mock_blob_reader.assert_called_once()
+            mock_check_output.assert_not_called()
 
     def test_get_missing(self):
         self.mock_commit.side_effect = RuntimeError("Shouldn't be called during get")
-        self.mock_cursor.fetchone.return_value = None
+        self.mock_cursor.fetchall.return_value = []
         self.assertIsNone(self.dao.get('not_in_dao'))
         self.mock_execute.assert_called_once()
 
+    @mock.patch.object(message_dao.MessageDao, 'get_thread')
+    def test_get_is_cached_until_a_reply_is_stored(self, mock_get_thread):
+        parent = archive_converter.generate_email_from_file(test_data_path('thread_patch0.txt'))
+        reply = archive_converter.generate_email_from_file(test_data_path('thread_patch1.txt'))
+        mock_get_thread.return_value = parent
+        self.assertIs(parent, self.dao.get(parent.id))
+        self.assertIs(parent, self.dao.get(parent.id))
+        mock_get_thread.assert_called_once()
+
+        self.dao.store(reply)
+        self.dao.get(parent.id)
+        self.assertEqual(2, mock_get_thread.call_count)
+
+        self.dao.invalidate(reply.id)
+        self.dao.get(parent.id)
+        self.assertEqual(2, mock_get_thread.call_count)
+        self.dao.invalidate(parent.id)
+        self.dao.get(parent.id)
+        self.assertEqual(3, mock_get_thread.call_count)
+
+    def test_contains_many(self):
+        self.mock_commit.side_effect = RuntimeError("Shouldn't be called during contains_many")
+        self.mock_cursor.fetchall.side_effect = [[('<1>',)], [('<3>',)]]
+        with mock.patch.object(message_dao, 'CONTAINS_CHUNK_SIZE', 2):
+            found = self.dao.contains_many(['<1>', '<2>', '<3>'])
+        self.assertEqual({'<1>', '<3>'}, found)
+        self.assertEqual(2, self.mock_execute.call_count)
+        self.mock_execute.assert_any_call(StrContains("WHERE message_id IN (%s, %s)"), mock.ANY)
+
     def test_size(self):
         self.mock_cursor.fetchone.return_value = (1,)
         self.assertEqual(1, self.dao.size())
@@ -82,6 +265,293 @@ class MessageDaoTest(unittest.TestCase):
         self.assertEqual(message_dao.EPOCH_HASH, self.dao.get_last_hash())
         self.mock_execute.assert_called_once()
 
+    def test_get_hash_missing_later_epoch(self):
+        self.mock_cursor.fetchone.return_value = None
+        self.assertIsNone(self.dao.get_last_hash(epoch=1))
+        self.mock_execute.assert_called_once_with(mock.ANY, ('last_hash_1',))
+
+class SqliteMessageDaoTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.backend = storage_backend.SqliteBackend(f'{tmp_dir.name}/messages.db')
+        # Bodies come from the email store so that no archive is needed.
+        self.email_store = email_store.EmailStore(f'{tmp_dir.name}/email_store')
+        self.addCleanup(self.email_store.close)
+        for archive_hash, raw_email in read_test_emails():
+            self.email_store.put(archive_hash, raw_email)
+        self.dao = message_dao.MessageDao('FAKE_GIT_PATH', self.email_store, self.backend)
+        self.emails = [archive_converter.generate_email_from_file(test_data_path(f'thread_patch{i}.txt'))
+                       for i in range(3)]
+        self.emails[1].change_id = 'change1'
+
+    def test_schema_is_migrated(self):
+        self.assertEqual(len(message_dao.MIGRATIONS), self.dao._get_schema_version())
+        with self.backend.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='Messages'")
+            indexes = {row[0] for row in cursor.fetchall()}
+        self.assertTrue({'in_reply_to_index', 'matching_index', 'thread_root_index'} <= indexes)
+        with self.backend.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode")
+            self.assertEqual('wal', cursor.fetchone()[0])
+
+    def test_migrations_can_rerun(self):
+        for migration in message_dao.MIGRATIONS:
+            with self.backend.cursor() as cursor:
+                migration(self.backend, cursor)
+        self.backend.commit()
+        with self.backend.cursor() as cursor:
+            cursor.execute("PRAGMA table_info(Messages)")
+            columns = [row[1] for row in cursor.fetchall()]
+        self.assertEqual(len(set(columns)), len(columns))
+
+    def test_migrate_after_crash(self):
+        # The DDL of later migrations was committed, but not their version.
+        with self.backend.cursor() as cursor:
+            cursor.execute("REPLACE INTO States VALUES (%s, %s)", ('schema_version', '1'))
+        self.backend.commit()
+        dao = message_dao.MessageDao('FAKE_GIT_PATH', self.email_store, self.backend)
+        self.assertEqual(len(message_dao.MIGRATIONS), dao._get_schema_version())
+        dao.store(self.emails[0])
+        dao.commit()
+        self.assertEqual(self.emails[0].id, dao.get_thread(self.emails[0].id).id)
+
+    @mock.patch.object(storage_backend, 'CHECKOUT_TIMEOUT', 5)
+    def test_reader_threads_give_back_connections(self):
+        self.dao.store_many(self.emails)
+        self.dao.commit()
+        errors = []
+        def read():
+            try:
+                self.dao.get_thread(self.emails[0].id)
+                self.dao.contains_many([self.emails[1].id])
+                self.dao.get_last_hash()
+            except Exception as e:
+                errors.append(e)
+        # Each thread exits still owning whatever it did not give back.
+        for _ in range(2 * storage_backend.POOL_SIZE):
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(self.emails[0].id, self.dao.get_thread(self.emails[0].id).id)
+
+    def test_reads_keep_uncommitted_changes(self):
+        self.dao.store(self.emails[0])
+        self.assertEqual({self.emails[0].id}, self.dao.contains_many([self.emails[0].id]))
+        # The row is only written, not committed, so the connection is kept.
+        self.assertIsNotNone(self.backend.pool._local.connection)
+        self.dao.commit()
+        self.assertIsNone(self.backend.pool._local.connection)
+
+    def test_get_thread(self):
+        self.dao.store_many(self.emails)
+        self.dao.commit()
+        thread = self.dao.get_thread(self.emails[0].id)
+        self.assertEqual(self.emails[0].id, thread.id)
+        self.assertEqual(self.emails[0].content, thread.content)
+        self.assertEqual(sorted(child.id for child in thread.children),
+                         sorted(email.id for email in self.emails[1:]))
+        self.assertIsNone(self.dao.get('<not_in_dao>'))
+        self.assertEqual(3, self.dao.size())
+
+    def test_get_thread_reads_each_email_once(self):
+        self.dao.store_many(self.emails)
+        self.dao.commit()
+        with mock.patch.object(self.email_store, 'get', wraps=self.email_store.get) as mock_get:
+            thread = self.dao.get_thread(self.emails[0].id)
+            for message in [thread] + thread.children:
+                self.assertTrue(message.content)
+            self.assertEqual(len(self.emails), mock_get.call_count)
+            # Released content is read again when it is needed.
+            thread.release_content()
+            self.assertEqual(self.emails[0].content, thread.content)
+            self.assertEqual(len(self.emails) + 1, mock_get.call_count)
+
+    def test_find_matching(self):
+        self.dao.store_many(self.emails)
+        matches = self.dao.find_matching(normalized_subject=self.emails[1].normalized_subject)
+        self.assertEqual([self.emails[1].id], [match.id for match in matches])
+
+    def test_thread_roots(self):
+        self.dao.store(self.emails[0])
+        self.dao.commit()
+        self.dao.store_many(self.emails[1:])
+        self.dao.commit()
+        with self.backend.cursor() as cursor:
+            cursor.execute("SELECT DISTINCT thread_root FROM Messages")
+            self.assertEqual([(self.emails[0].id,)], cursor.fetchall())
+
+    def test_backfill_thread_roots(self):
+        self.dao.store_many(self.emails)
+        self.dao.commit()
+        with self.backend.cursor() as cursor:
+            cursor.execute("UPDATE Messages SET thread_root = NULL")
+            message_dao._backfill_thread_roots(self.backend, cursor)
+            cursor.execute("SELECT DISTINCT thread_root FROM Messages")
+            self.assertEqual([(self.emails[0].id,)], cursor.fetchall())
+
+    @mock.patch.object(message_dao, 'MIGRATION_BATCH_SIZE', 1)
+    def test_backfill_thread_roots_in_batches(self):
+        roots = [message.Message(f'<root{i}>', 'Subject', 'From', None, 'Content', 'hash') for i in range(3)]
+        self.dao.store_many(roots + self.emails)
+        self.dao.commit()
+        with self.backend.cursor() as cursor:
+            cursor.execute("UPDATE Messages SET thread_root = NULL")
+        self.backend.commit()
+        with mock.patch.object(self.backend, 'commit', wraps=self.backend.commit) as commit:
+            with self.backend.cursor() as cursor:
+                message_dao._backfill_thread_roots(self.backend, cursor)
+            # One commit per root and per reply
+            self.assertEqual(len(roots) + len(self.emails), commit.call_count)
+        with self.backend.cursor() as cursor:
+            cursor.execute("SELECT message_id FROM Messages WHERE thread_root = message_id")
+            self.assertCountEqual([(message.id,) for message in roots + self.emails[:1]], cursor.fetchall())
+
+    def test_orphans(self):
+        self.dao.store_orphans(self.emails[1:])
+        self.dao.commit()
+        self.assertEqual([], self.dao.take_orphans(['<unknown>']))
+        orphans = {orphan.id: orphan for orphan in self.dao.take_orphans([self.emails[0].id])}
+        self.assertCountEqual([email.id for email in self.emails[1:]], orphans)
+        self.assertEqual(self.emails[1].content, orphans[self.emails[1].id].content)
+        # Taking orphans removes them.
+        self.assertEqual([], self.dao.take_orphans([self.emails[0].id]))
+
+    def test_expire_orphans(self):
+        self.dao.store_orphans(self.emails[1:2])
+        self.dao.commit()
+        with mock.patch.object(message_dao.time, 'time', return_value=message_dao.time.time() + 10):
+            self.dao.store_orphans(self.emails[2:])
+        self.assertEqual(1, self.dao.expire_orphans(max_orphans=1))
+        self.assertEqual([self.emails[2].id], [orphan.id for orphan in self.dao.take_orphans([self.emails[0].id])])
+
+        self.dao.store_orphans(self.emails[1:])
+        self.assertEqual(2, self.dao.expire_orphans(ttl=-60))
+
+    def test_posted_replies(self):
+        self.dao.store(self.emails[0])
+        self.dao.mark_replies_posted('change1', 'revision1', [self.emails[1].id, self.emails[2].id])
+        self.dao.mark_replies_posted('change1', 'revision2', [self.emails[1].id])
+        self.dao.mark_replies_posted('change2', 'revision3', [self.emails[2].id])
+        self.assertEqual({self.emails[1].id, self.emails[2].id}, self.dao.get_posted_replies('change1'))
+        self.assertEqual({self.emails[2].id}, self.dao.get_posted_replies('change2'))
+        self.assertEqual(set(), self.dao.get_posted_replies('change3'))
+        # Posts are committed right away, buffered messages are left to be written later.
+        self.assertEqual([self.emails[0].id], list(self.dao._pending))
+        self.backend.release()
+        self.assertEqual({self.emails[2].id}, self.dao.get_posted_replies('change2'))
+        self.assertEqual(1, self.dao.size())
+
+    def test_threads_write_independently(self):
+        def store(email):
+            self.dao.store(email)
+            self.dao.commit()
+        threads = [threading.Thread(target=store, args=(email,)) for email in self.emails]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(3, self.dao.size())
+
+    def test_contains_many_uses_known_ids(self):
+        known_ids_path = f'{self.backend.path}.known_ids'
+        self.dao.store(self.emails[0])
+        self.dao.store_last_hash('some_hash')
+        dao = message_dao.MessageDao('FAKE_GIT_PATH', self.email_store,
+                                     storage_backend.SqliteBackend(self.backend.path), known_ids_path)
+        dao.store(self.emails[1])
+        dao.store_last_hash('other_hash')
+        self.assertEqual({self.emails[0].id, self.emails[1].id},
+                         dao.contains_many(email.id for email in self.emails))
+        with mock.patch.object(dao.backend, 'cursor') as mock_cursor:
+            self.assertEqual(set(), dao.contains_many(['<never_stored>']))
+            mock_cursor.assert_not_called()
+        # Storing a message again does not count it twice.
+        dao.store(self.emails[0])
+        dao.store_last_hash('other_hash')
+        dao.close()
+
+        # The saved filter is reused as long as nothing was stored without it.
+        with mock.patch.object(message_dao.MessageDao, '_build_known_ids') as mock_build:
+            message_dao.MessageDao('FAKE_GIT_PATH', self.email_store,
+                                   storage_backend.SqliteBackend(self.backend.path), known_ids_path)
+            mock_build.assert_not_called()
+        self.dao.store(self.emails[2])
+        self.dao.commit()
+        dao = message_dao.MessageDao('FAKE_GIT_PATH', self.email_store,
+                                     storage_backend.SqliteBackend(self.backend.path), known_ids_path)
+        self.assertIn(self.emails[2].id, dao.contains_many([self.emails[2].id]))
+
+    def test_known_ids_are_saved_on_an_interval(self):
+        known_ids_path = f'{self.backend.path}.known_ids'
+        dao = message_dao.MessageDao('FAKE_GIT_PATH', self.email_store,
+                                     storage_backend.SqliteBackend(self.backend.path), known_ids_path)
+        with mock.patch.object(dao.known_ids, 'save', wraps=dao.known_ids.save) as mock_save, \
+             mock.patch.object(dao, 'size') as mock_size:
+            dao.store(self.emails[0])
+            dao.store_last_hash('some_hash')
+            mock_save.assert_not_called()
+            with mock.patch.object(message_dao.time, 'monotonic',
+                                   return_value=message_dao.time.monotonic() + message_dao.KNOWN_IDS_SAVE_INTERVAL):
+                dao.store(self.emails[1])
+                dao.store_last_hash('other_hash')
+            mock_save.assert_called_once_with(known_ids_path, checkpoint=2)
+            dao.store(self.emails[2])
+            dao.commit()
+            dao.close()
+            mock_save.assert_called_with(known_ids_path, checkpoint=3)
+            # The count is kept from the rows written, not queried.
+            mock_size.assert_not_called()
+
+    def test_last_hash_survives_reopening(self):
+        self.dao.store(self.emails[0])
+        self.dao.store_last_hash('some_hash', epoch=1)
+        dao = message_dao.MessageDao('FAKE_GIT_PATH', self.email_store,
+                                     storage_backend.SqliteBackend(self.backend.path))
+        self.assertEqual('some_hash', dao.get_last_hash(epoch=1))
+        self.assertEqual(1, dao.size())
+
+class ThreadCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = message_dao.ThreadCache(max_size=2, ttl=10, clock=lambda: self.now)
+
+    def _message(self, message_id, children=()):
+        msg = message.Message(message_id, '[PATCH] foo', 'from', None, '', 'hash')
+        msg.children = list(children)
+        return msg
+
+    def test_evicts_least_recently_used(self):
+        for message_id in ['<a>', '<b>']:
+            self.cache.put(self._message(message_id))
+        self.cache.get('<a>')
+        self.cache.put(self._message('<c>'))
+        self.assertIsNotNone(self.cache.get('<a>'))
+        self.assertIsNone(self.cache.get('<b>'))
+        self.assertEqual(self.cache.stats(), {'size': 2, 'hits': 2, 'misses': 1, 'evictions': 1})
+
+    def test_expires_entries(self):
+        self.cache.put(self._message('<a>'))
+        self.now = 10
+        self.assertIsNone(self.cache.get('<a>'))
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_invalidate_only_drops_threads_containing_message(self):
+        grandchild = self._message('<grandchild>')
+        thread = self._message('<root>', [self._message('<child>', [grandchild])])
+        self.cache.put(thread)
+        self.cache.put(self._message('<other>'))
+
+        self.cache.invalidate('<grandchild>')
+
+        self.assertIsNone(self.cache.get('<root>'))
+        self.assertIsNotNone(self.cache.get('<other>'))
+
+
 if __name__ == '__main__':
     # TODO(lenhard@google.com): Issue with Google's Connector that causes segmentation fault
     # unittest.main()
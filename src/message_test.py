@@ -0,0 +1,86 @@
+import unittest
+from unittest import mock
+
+from message import decode_content, Message, parse_message_from_bytes, parse_subject
+
+
+def _message_with_subject(subject: str) -> Message:
+    return Message('<id>', subject, 'from', None, '', 'archive_hash')
+
+
+class MessageTest(unittest.TestCase):
+
+    def test_parse_subject(self):
+        info = parse_subject('[PATCH RFC v3 2/5] kunit: add a test')
+        self.assertEqual(info.tags, ('PATCH', 'RFC', 'v3', '2/5'))
+        self.assertEqual(info.version, 3)
+        self.assertEqual((info.index, info.total), (2, 5))
+        self.assertTrue(info.is_patch_or_coverletter)
+        self.assertTrue(info.is_rfc)
+        self.assertFalse(info.is_resend)
+        self.assertEqual(info.normalized_subject, 'kunit: add a test')
+
+    def test_parse_subject_without_tags(self):
+        info = parse_subject('Re: kunit: add a test')
+        self.assertEqual(info.tags, ())
+        self.assertEqual(info.version, 1)
+        self.assertEqual((info.index, info.total), (1, 1))
+        self.assertFalse(info.is_patch_or_coverletter)
+        self.assertEqual(info.normalized_subject, '')
+
+    def test_patch_and_coverletter(self):
+        cover_letter = _message_with_subject('[PATCH v2 0/4] kselftests/arm64: add PAuth tests')
+        self.assertTrue(cover_letter.is_coverletter())
+        self.assertFalse(cover_letter.is_patch())
+        self.assertEqual(cover_letter.patch_index(), (0, 4))
+        self.assertEqual(cover_letter.version(), 2)
+
+        patch = _message_with_subject('[RESEND PATCH] Input: i8042 - Prevent intermixing i8042 commands')
+        self.assertTrue(patch.is_patch())
+        self.assertEqual(patch.patch_index(), (1, 1))
+        self.assertTrue(patch.subject_info.is_resend)
+
+        with self.assertRaises(ValueError):
+            _message_with_subject('Hello everyone').patch_index()
+
+    def test_subject_is_parsed_once(self):
+        message = _message_with_subject('[PATCH v2 1/4] foo')
+        self.assertIs(message.subject_info, message.subject_info)
+        with self.assertRaises(AttributeError):
+            message.unknown_attribute = 1
+
+    def test_content_is_decoded_lazily(self):
+        raw_email = (b'Message-Id: <id>\nSubject: [PATCH] foo\nFrom: Someone <someone@example.com>\n'
+                     b'Content-Type: text/plain; charset=utf-8\n'
+                     b'Content-Transfer-Encoding: quoted-printable\n\n'
+                     b'caf=C3=A9 is a very long line which has been =\nsplit in two\n')
+        load_raw_email = mock.Mock(return_value=raw_email)
+        message = parse_message_from_bytes(raw_email, 'archive_hash', load_raw_email=load_raw_email)
+        self.assertEqual(message.from_, 'Someone <someone@example.com>')
+        load_raw_email.assert_not_called()
+
+        # The raw email the message was parsed from is decoded without reading it again.
+        self.assertEqual(message.content, 'caf\u00e9 is a very long line which has been split in two\n')
+        load_raw_email.assert_not_called()
+
+        message.release_content()
+        self.assertEqual(message.content, 'caf\u00e9 is a very long line which has been split in two\n')
+        load_raw_email.assert_called_once_with('archive_hash')
+
+    def test_decode_multipart_base64(self):
+        raw_email = (b'Message-Id: <id>\nSubject: [PATCH] foo\n'
+                     b'Content-Type: multipart/mixed; boundary="XX"\n\n'
+                     b'--XX\nContent-Type: text/plain\n\nfirst part\n'
+                     b'--XX\nContent-Type: text/plain\nContent-Transfer-Encoding: base64\n\n'
+                     b'c2Vjb25kIHBhcnQK\n--XX--\n')
+        self.assertEqual(decode_content(raw_email), ['first part', 'second part\n'])
+
+    def test_release_content_keeps_explicit_content(self):
+        message = _message_with_subject('[PATCH] foo')
+        message.content = 'only copy'
+        message.release_content()
+        self.assertEqual(message.content, 'only copy')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import threading
+
+from absl import logging
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+# Bumped whenever the format of cached values changes, so old entries are ignored
+VERSION = 1
+# Entries are dropped, least recently written first, once there are more than this
+MAX_ENTRIES = 100000
+# Fraction of MAX_ENTRIES kept when dropping entries, so that it happens rarely
+EVICT_TO = 0.9
+
+def _serialize(content: Union[str, List[str]]) -> str:
+    # Multipart messages have one string per part; JSON keeps the part
+    # boundaries, so ['ab'] and ['a', 'b'] get different keys.
+    if isinstance(content, str):
+        return content
+    return json.dumps(content)
+
+class ParseCache(object):
+    """ Remembers the results of parsing messages across runs of the bridge.
+
+    Every time a thread gets a new reply the whole thread is parsed again, but
+    the result for a message only depends on its id and content, and on the
+    content of the messages it is parsed against. Entries are keyed by all of
+    those, so a stale entry can never be returned, and are kept on disk as one
+    JSON file each."""
+
+    def __init__(self, directory: str, max_entries: int = MAX_ENTRIES) -> None:
+        self._directory = directory
+        self._max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._num_entries = sum(1 for name in os.listdir(directory) if name.endswith('.json'))
+
+    def _path(self, kind: str, message_id: str, contents: Sequence[Union[str, List[str]]]) -> str:
+        key = hashlib.sha256()
+        for part in [str(VERSION), kind, message_id] + [
+                hashlib.sha256(_serialize(content).encode('utf-8', errors='surrogateescape')).hexdigest()
+                for content in contents]:
+            key.update(part.encode('utf-8', errors='surrogateescape'))
+            key.update(b'\0')
+        return os.path.join(self._directory, key.hexdigest() + '.json')
+
+    def get(self, kind: str, message_id: str, contents: Sequence[Union[str, List[str]]]) -> Optional[Any]:
+        """Returns the value stored for the message with message_id parsed from
+        contents, or None if there is none."""
+        path = self._path(kind, message_id, contents)
+        value = None
+        try:
+            with open(path, 'r') as f:
+                value = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logging.warning('Ignoring unreadable parse cache entry %s: %s', path, e)
+        # Threads share the counters, so they are updated under the lock like the entry count.
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def put(self, kind: str, message_id: str, contents: Sequence[Union[str, List[str]]], value: Any) -> None:
+        path = self._path(kind, message_id, contents)
+        # Write to a temporary file first so a crash never leaves a torn entry behind.
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(value, f)
+        with self._lock:
+            if not os.path.exists(path):
+                self._num_entries += 1
+            os.replace(tmp_path, path)
+            if self._num_entries > self._max_entries:
+                self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for name in os.listdir(self._directory):
+            if name.endswith('.json'):
+                path = os.path.join(self._directory, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except FileNotFoundError:
+                    pass
+        entries.sort()
+        keep = int(self._max_entries * EVICT_TO)
+        for _, path in entries[:max(0, len(entries) - keep)]:
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+        self._num_entries = min(len(entries), keep)
+        logging.info('Evicted %d entries from the parse cache', max(0, len(entries) - keep))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'entries': self._num_entries, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
@@ -0,0 +1,85 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from parse_cache import ParseCache
+
+class ParseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.directory = tmp_dir.name
+
+    def test_put_and_get(self):
+        cache = ParseCache(self.directory)
+        cache.put('comments', '<reply>', ['parent', 'reply'], [[3, 'Looks good']])
+        self.assertEqual([[3, 'Looks good']], cache.get('comments', '<reply>', ['parent', 'reply']))
+        self.assertIsNone(cache.get('line_map', '<reply>', ['parent', 'reply']))
+        self.assertIsNone(cache.get('comments', '<other>', ['parent', 'reply']))
+        self.assertEqual(cache.stats(), {'entries': 1, 'hits': 1, 'misses': 2, 'evictions': 0})
+
+    def test_changed_content_misses(self):
+        cache = ParseCache(self.directory)
+        cache.put('comments', '<reply>', ['parent', 'reply'], [])
+        self.assertIsNone(cache.get('comments', '<reply>', ['parent v2', 'reply']))
+        self.assertIsNone(cache.get('comments', '<reply>', ['parent', 'reply v2']))
+        self.assertIsNone(cache.get('comments', '<reply>', ['parentreply']))
+
+    def test_multipart_content(self):
+        cache = ParseCache(self.directory)
+        cache.put('comments', '<reply>', [['part 1', 'part 2'], 'reply'], [[3, 'Looks good']])
+        self.assertEqual([[3, 'Looks good']], cache.get('comments', '<reply>', [['part 1', 'part 2'], 'reply']))
+        self.assertIsNone(cache.get('comments', '<reply>', [['part 1part 2'], 'reply']))
+        self.assertIsNone(cache.get('comments', '<reply>', ['part 1part 2', 'reply']))
+
+    def test_persists_across_instances(self):
+        ParseCache(self.directory).put('line_map', '<patch>', ['diff'], [['file', [[1, 2, '', 3]]]])
+        cache = ParseCache(self.directory)
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertEqual([['file', [[1, 2, '', 3]]]], cache.get('line_map', '<patch>', ['diff']))
+
+    def test_unreadable_entry_misses(self):
+        cache = ParseCache(self.directory)
+        cache.put('comments', '<reply>', ['parent', 'reply'], [])
+        for name in os.listdir(self.directory):
+            with open(os.path.join(self.directory, name), 'w') as f:
+                f.write('{"truncated')
+        self.assertIsNone(cache.get('comments', '<reply>', ['parent', 'reply']))
+
+    def test_counts_lookups_from_many_threads(self):
+        cache = ParseCache(self.directory)
+        cache.put('comments', '<reply>', ['parent'], [])
+        def lookup():
+            for _ in range(100):
+                cache.get('comments', '<reply>', ['parent'])
+                cache.get('comments', '<other>', ['parent'])
+        threads = [threading.Thread(target=lookup) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(800, cache.stats()['hits'])
+        self.assertEqual(800, cache.stats()['misses'])
+
+    def test_evicts_oldest_entries(self):
+        cache = ParseCache(self.directory, max_entries=10)
+        for i in range(10):
+            cache.put('comments', f'<reply{i}>', ['parent'], [i])
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory)]
+        # Give every entry a distinct age.
+        for age, path in enumerate(paths, start=1):
+            os.utime(path, (time.time() - age, time.time() - age))
+        oldest = paths[-2:]
+        cache.put('comments', '<reply10>', ['parent'], [10])
+
+        self.assertEqual(cache.stats()['entries'], 9)
+        self.assertEqual(cache.stats()['evictions'], 2)
+        self.assertEqual(len(os.listdir(self.directory)), 9)
+        self.assertFalse(any(os.path.exists(path) for path in oldest))
+        self.assertEqual([10], cache.get('comments', '<reply10>', ['parent']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -34,8 +34,10 @@ class SimplePatchAssociator(PatchAssociator):
         self.git_path = git_path
 
     def _get_time(self, message: Message):
-        return int(subprocess.check_output(
-            ['git', '-C', self.git_path , 'show', '-s', '--format=%ct', message.archive_hash]))
+        if message.commit_time is None:
+            message.commit_time = int(subprocess.check_output(
+                ['git', '-C', self.git_path , 'show', '-s', '--format=%ct', message.archive_hash]))
+        return message.commit_time
 
     def _newest_first(self, candidates: List[Message]):
         candidates_with_time = [(message, self._get_time(message)) for message in candidates]
@@ -0,0 +1,237 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks patch_parser on synthetic patches and threads, and on the
+recorded threads in test_data. Runs offline, from src/:
+
+  python3 patch_parser_benchmark.py
+  python3 patch_parser_benchmark.py --baseline=baseline.json --update_baseline
+  python3 patch_parser_benchmark.py --baseline=baseline.json
+
+The last one exits with status 1 if anything got slower, or used more memory,
+than in the baseline by more than --tolerance. Timings depend on the machine,
+so baselines are only comparable when recorded on the same one."""
+
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from absl import app
+from absl import flags
+from absl import logging
+from typing import Any, Callable, Dict, List, NamedTuple
+
+import patch_parser
+
+from archive_converter import ArchiveMessageIndex
+from message import Message
+from message_dao import FakeMessageDao
+from test_helpers import read_test_emails
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string('baseline', None, 'JSON file of earlier results to compare against.')
+flags.DEFINE_boolean('update_baseline', False, 'Write the results to --baseline instead of comparing.')
+flags.DEFINE_float('tolerance', 1.25, 'Largest allowed ratio of a result to its baseline.')
+flags.DEFINE_integer('repeat', 3, 'Number of timed runs of each benchmark; the fastest is reported.')
+flags.DEFINE_integer('max_diff_lines', 50000, 'Skip synthetic patches with more diff lines than this.')
+flags.DEFINE_string('filter', '', 'Only run benchmarks whose name contains this.')
+
+# (diff lines, files) of the synthetic patches
+SYNTHETIC_SIZES = [(1000, 10), (10000, 100), (50000, 500)]
+# Number of diff lines in each hunk of a synthetic patch
+LINES_PER_HUNK = 20
+# Number of replies to each synthetic patch; reply i quotes at depth 1 + i % QUOTE_DEPTH
+REPLIES = 4
+QUOTE_DEPTH = 3
+# Replies comment on one in this many hunks
+COMMENT_EVERY = 5
+# Timings shorter than this are too noisy to compare against a baseline
+MIN_SECONDS = 0.001
+
+class Result(NamedTuple):
+    seconds: float
+    peak_bytes: int
+
+def generate_patch(diff_lines: int, files: int, seed: int = 0) -> str:
+    """Returns a patch email body with about diff_lines lines of diff spread
+    evenly over files files, each made of hunks of LINES_PER_HUNK lines."""
+    rng = random.Random(seed)
+    hunks_per_file = max(1, diff_lines // files // LINES_PER_HUNK)
+    entries = []
+    for i in range(files):
+        entry = [f'diff --git a/dir/file{i}.c b/dir/file{i}.c',
+                 'index fa2da6e55caa..1fc93eb38351 100644',
+                 f'--- a/dir/file{i}.c',
+                 f'+++ b/dir/file{i}.c']
+        for hunk in range(hunks_per_file):
+            start = 1 + hunk * LINES_PER_HUNK * 3
+            context = LINES_PER_HUNK - 3
+            entry.append(f'@@ -{start},{context + 1} +{start},{context + 2} @@ static int f{hunk}(void)')
+            for line in range(context):
+                if line == context // 2:
+                    entry.append(f'-\tvalue_{i}_{hunk} = compute({rng.randrange(1000)});')
+                    entry.append(f'+\tvalue_{i}_{hunk} = compute({rng.randrange(1000)}) + {hunk};')
+                    entry.append(f'+\tcheck(value_{i}_{hunk});')
+                entry.append(f' \tvar_{i}_{hunk}_{line} = {rng.randrange(1 << 20)};')
+        entries.append('\n'.join(entry))
+    return '\n'.join([
+        'Makes everything faster.',
+        '',
+        'Signed-off-by: Some Developer <dev@example.com>',
+        '---',
+        f' {files} files changed, {2 * files * hunks_per_file} insertions(+), '
+        f'{files * hunks_per_file} deletions(-)',
+        '',
+    ] + entries + ['--', '2.28.0'])
+
+def generate_reply(patch_text: str, depth: int, seed: int = 0) -> str:
+    """Returns a reply quoting all of patch_text depth times over, with a
+    comment after every COMMENT_EVERY hunks."""
+    prefix = '> ' * depth
+    lines = ['On Mon, 31 Aug 2020 at 12:04:46 +0100, Some Developer wrote:']
+    hunk = seed
+    for line in patch_text.split('\n'):
+        lines.append(prefix + line)
+        if line.startswith('+\tcheck('):
+            if hunk % COMMENT_EVERY == 0:
+                lines.extend(['', f'Why check here? ({hunk})', ''])
+            hunk += 1
+    lines.extend(['', 'Thanks,', 'A Reviewer'])
+    return '\n'.join(lines)
+
+def generate_thread(patch_text: str, replies: int = REPLIES) -> Message:
+    thread = Message('<patch@example.com>', '[PATCH] dir: make everything faster',
+                     'Some Developer <dev@example.com>', None, patch_text, 'patch')
+    for i in range(replies):
+        thread.children.append(Message(f'<reply{i}@example.com>', 'Re: [PATCH] dir: make everything faster',
+                                       f'Reviewer {i} <reviewer{i}@example.com>', thread.id,
+                                       generate_reply(patch_text, 1 + i % QUOTE_DEPTH, seed=i), f'reply{i}'))
+    return thread
+
+def synthetic_benchmarks(max_diff_lines: int) -> Dict[str, Callable[[], Any]]:
+    benchmarks : Dict[str, Callable[[], Any]] = {}
+    for diff_lines, files in SYNTHETIC_SIZES:
+        if diff_lines > max_diff_lines:
+            continue
+        patch_text = generate_patch(diff_lines, files)
+        thread = generate_thread(patch_text)
+        parent_lines = patch_parser._to_lines(patch_text)
+        child_lines = patch_parser._to_lines(thread.children[0].content)
+        name = f'synthetic_{diff_lines}_lines_{files}_files'
+        benchmarks[f'{name}/_parse_git_patch'] = lambda text=patch_text: patch_parser._parse_git_patch(text)
+        benchmarks[f'{name}/_get_quote_prefix'] = (
+            lambda parent=parent_lines, child=child_lines: patch_parser._get_quote_prefix(parent, child))
+        benchmarks[f'{name}/_find_comments'] = (
+            lambda parent=parent_lines, child=child_lines:
+                patch_parser._find_comments(patch_parser.ParentQuoteIndex(parent), child))
+        benchmarks[f'{name}/parse_comments'] = lambda thread=thread: patch_parser.parse_comments(thread)
+    return benchmarks
+
+def recorded_benchmarks() -> Dict[str, Callable[[], Any]]:
+    benchmarks : Dict[str, Callable[[], Any]] = {}
+    for directory in ['', 'fake_patch_with_replies/']:
+        archives = ArchiveMessageIndex(FakeMessageDao()).update(read_test_emails(directory))
+        for message in archives.values():
+            if message.in_reply_to or not message._is_patch_or_coverletter():
+                continue
+            name = f'recorded_{message.id}'
+            benchmarks[f'{name}/parse_comments'] = lambda thread=message: patch_parser.parse_comments(thread)
+            for patch in patch_parser._find_patches(message):
+                try:
+                    patch_parser._parse_git_patch(patch.content)
+                except ValueError:
+                    # Not every recorded patch is one the parser handles.
+                    continue
+                benchmarks[f'{name}/_parse_git_patch/{patch.id}'] = (
+                    lambda text=patch.content: patch_parser._parse_git_patch(text))
+    return benchmarks
+
+def _reset_caches() -> None:
+    # Every run has to do the work the benchmark is measuring.
+    patch_parser._parent_index_cache.clear()
+
+def measure(benchmark: Callable[[], Any], repeat: int) -> Result:
+    """Returns the fastest of repeat runs of benchmark, and its peak memory
+    use in a separate run since tracing slows it down."""
+    best = float('inf')
+    for _ in range(repeat):
+        _reset_caches()
+        start = time.perf_counter()
+        benchmark()
+        best = min(best, time.perf_counter() - start)
+    _reset_caches()
+    tracemalloc.start()
+    try:
+        benchmark()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return Result(seconds=best, peak_bytes=peak_bytes)
+
+def run_benchmarks(benchmarks: Dict[str, Callable[[], Any]], repeat: int) -> Dict[str, Result]:
+    results = {}
+    for name, benchmark in benchmarks.items():
+        results[name] = measure(benchmark, repeat)
+        print(f'{name:<90} {results[name].seconds * 1000:>10.2f} ms {results[name].peak_bytes / 1024:>10.0f} KiB')
+    return results
+
+def compare(results: Dict[str, Result], baseline: Dict[str, Result], tolerance: float) -> List[str]:
+    """Returns a description of every result worse than its baseline by more
+    than tolerance. Benchmarks missing from either side are ignored."""
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if result.seconds >= MIN_SECONDS and result.seconds > expected.seconds * tolerance:
+            regressions.append(f'{name}: {result.seconds * 1000:.2f} ms, was {expected.seconds * 1000:.2f} ms')
+        if result.peak_bytes > expected.peak_bytes * tolerance:
+            regressions.append(f'{name}: {result.peak_bytes} bytes, was {expected.peak_bytes} bytes')
+    return regressions
+
+def save_results(path: str, results: Dict[str, Result]) -> None:
+    with open(path, 'w') as f:
+        json.dump({'python': platform.python_version(),
+                   'results': {name: result._asdict() for name, result in results.items()}},
+                  f, indent=2, sort_keys=True)
+
+def load_results(path: str) -> Dict[str, Result]:
+    with open(path) as f:
+        return {name: Result(**result) for name, result in json.load(f)['results'].items()}
+
+def main(argv) -> None:
+    # Time the parsing, not the writing of its info logs.
+    logging.set_verbosity(logging.WARNING)
+    benchmarks = synthetic_benchmarks(FLAGS.max_diff_lines)
+    benchmarks.update(recorded_benchmarks())
+    benchmarks = {name: benchmark for name, benchmark in benchmarks.items() if FLAGS.filter in name}
+    results = run_benchmarks(benchmarks, FLAGS.repeat)
+    if not FLAGS.baseline:
+        return
+    if FLAGS.update_baseline:
+        save_results(FLAGS.baseline, results)
+        print(f'Wrote baseline to {FLAGS.baseline}')
+        return
+    regressions = compare(results, load_results(FLAGS.baseline), FLAGS.tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    app.run(main)
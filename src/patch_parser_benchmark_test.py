@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+import patch_parser
+import patch_parser_benchmark
+from patch_parser_benchmark import Result
+
+class PatchParserBenchmarkTest(unittest.TestCase):
+
+    def test_synthetic_thread_parses(self):
+        patch_text = patch_parser_benchmark.generate_patch(diff_lines=400, files=4)
+        line_map = patch_parser._parse_git_patch(patch_text)
+        self.assertEqual(4, len(line_map.patch_files))
+
+        thread = patch_parser_benchmark.generate_thread(patch_text, replies=3)
+        patchset = patch_parser.parse_comments(thread)
+        patch_parser.map_comments_to_gerrit(patchset)
+        comments = patchset.patches[0].comments
+        self.assertTrue(any('Why check here?' in comment.message and comment.line > 0
+                            for comment in comments))
+        self.assertEqual({'<reply0@example.com>', '<reply1@example.com>', '<reply2@example.com>'},
+                         {comment.reply_id for comment in comments})
+
+    def test_run_benchmarks(self):
+        benchmarks = patch_parser_benchmark.synthetic_benchmarks(max_diff_lines=1000)
+        benchmarks.update(patch_parser_benchmark.recorded_benchmarks())
+        self.assertIn('synthetic_1000_lines_10_files/_find_comments', benchmarks)
+        self.assertIn('recorded_<patch-message-id>/parse_comments', benchmarks)
+        self.assertFalse(any('50000' in name for name in benchmarks))
+        results = patch_parser_benchmark.run_benchmarks(benchmarks, repeat=1)
+        self.assertEqual(benchmarks.keys(), results.keys())
+        self.assertTrue(all(result.seconds > 0 and result.peak_bytes > 0 for result in results.values()))
+
+    def test_compare(self):
+        baseline = {'a': Result(seconds=0.1, peak_bytes=1000), 'b': Result(seconds=0.0001, peak_bytes=1000),
+                    'c': Result(seconds=0.1, peak_bytes=1000)}
+        results = {'a': Result(seconds=0.2, peak_bytes=1000), 'b': Result(seconds=0.0009, peak_bytes=1000),
+                   'c': Result(seconds=0.11, peak_bytes=2000), 'new': Result(seconds=1, peak_bytes=1)}
+        regressions = patch_parser_benchmark.compare(results, baseline, tolerance=1.25)
+        self.assertEqual(2, len(regressions))
+        self.assertTrue(regressions[0].startswith('a: 200.00 ms'))
+        self.assertTrue(regressions[1].startswith('c: 2000 bytes'))
+
+    def test_baseline_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'baseline.json')
+            results = {'a': Result(seconds=0.5, peak_bytes=10)}
+            patch_parser_benchmark.save_results(path, results)
+            self.assertEqual(results, patch_parser_benchmark.load_results(path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,14 @@
+import os
+import tempfile
 import unittest
+from unittest import mock
 import patch_parser
 from patch_parser import parse_comments, map_comments_to_gerrit, Comment
 from archive_converter import ArchiveMessageIndex, generate_email_from_file
 from message_dao import FakeMessageDao
+from parse_cache import ParseCache
 
-from test_helpers import test_data_path
+from test_helpers import read_test_emails, test_data_path
 
 
 class PatchParserTest(unittest.TestCase):
@@ -19,7 +23,7 @@ class PatchParserTest(unittest.TestCase):
 
     def test_parse_comments_for_single_email_thread(self):
         archive_index = ArchiveMessageIndex(FakeMessageDao())
-        archives = archive_index.update(test_data_path())
+        archives = archive_index.update(read_test_emails())
         patchset = parse_comments(
             archives.get(
                 '<20200827144112.v2.1.I6981f9a9f0c12e60f8038f3b574184f8ffc1b9b5@changeid>'))
@@ -33,7 +37,7 @@ class PatchParserTest(unittest.TestCase):
 
     def test_parse_comments_for_multi_email_thread_with_cover_letter(self):
         archive_index = ArchiveMessageIndex(FakeMessageDao())
-        archives = archive_index.update(test_data_path())
+        archives = archive_index.update(read_test_emails())
         patchset = parse_comments(archives.get('<20200831110450.30188-1-boyan.karatotev@arm.com>'))
 
         self.assertEqual(len(patchset.patches), 4)
@@ -53,7 +57,7 @@ class PatchParserTest(unittest.TestCase):
 
     def test_parse_with_replies(self):
         archive_index = ArchiveMessageIndex(FakeMessageDao())
-        archives = archive_index.update(test_data_path('fake_patch_with_replies/'))
+        archives = archive_index.update(read_test_emails('fake_patch_with_replies/'))
 
         self.assertEqual(len(archives), 2)
 
@@ -248,6 +252,167 @@ base-commit: 235360eb7cd778d7264c5e57358a3d144936b862
         # Corresponds to line 8 in the original, but line 9 after the diff.
         # self.assertEqual(line_map.map(19), ('file', 9), msg=repr(line_map))
 
+    def test_get_quote_prefix(self):
+        parent = patch_parser._to_lines('int a;\nint b;\n\treturn a + b;\n}')
+        child = patch_parser._to_lines('> int a;\n> int b;\n> \treturn a + b;\n> }\nLooks good.')
+        self.assertEqual('> ', patch_parser._get_quote_prefix(parent, child))
+
+    def test_longest_common_suffix(self):
+        parent = ['foo bar', 'baz bar', 'quux', '']
+        suffix_index = patch_parser.SuffixIndex(parent)
+        for child in ['> foo bar', 'xbar', 'aquux', 'nothing', '', 'foo barr', '>> baz bar']:
+            expected = max(len(os.path.commonprefix([line[::-1], child[::-1]])) for line in parent)
+            self.assertEqual(expected, suffix_index.longest_common_suffix(child), msg=child)
+
+    def test_get_quote_prefix_for_long_quote(self):
+        parent = patch_parser._to_lines('\n'.join(f'+\tvalue_{i} = compute({i}) * {"x" * 500};'
+                                                  for i in range(5000)))
+        child = patch_parser._to_lines('\n'.join('> ' + line.text for line in parent))
+        self.assertEqual('> ', patch_parser._get_quote_prefix(parent, child))
+
+    def test_parent_quote_index_is_shared_by_replies(self):
+        archive_index = ArchiveMessageIndex(FakeMessageDao())
+        archives = archive_index.update(read_test_emails('fake_patch_with_replies/'))
+        email_thread = archives.get('<patch-message-id>')
+        # A second reviewer replying the same way.
+        email_thread.children.append(email_thread.children[0])
+
+        with mock.patch.object(patch_parser, 'ParentQuoteIndex',
+                               wraps=patch_parser.ParentQuoteIndex) as mock_index:
+            patch_parser._parent_index_cache.clear()
+            patchset = parse_comments(email_thread)
+            self.assertEqual(1, mock_index.call_count)
+            # Parsing the thread again, e.g. after a new reply, reuses the index.
+            parse_comments(email_thread)
+            self.assertEqual(1, mock_index.call_count)
+        patch_parser._parent_index_cache.clear()
+
+        comments = patchset.patches[0].comments
+        self.assertEqual(len(comments) % 2, 0)
+        half = len(comments) // 2
+        self.assertEqual([(c.raw_line, c.message) for c in comments[:half]],
+                         [(c.raw_line, c.message) for c in comments[half:]])
+
+    def test_parse_cache_skips_parsed_messages(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        cache = ParseCache(tmp_dir.name)
+        archive_index = ArchiveMessageIndex(FakeMessageDao())
+        archives = archive_index.update(read_test_emails('fake_patch_with_replies/'))
+        email_thread = archives.get('<patch-message-id>')
+        expected = parse_comments(email_thread)
+        map_comments_to_gerrit(expected)
+
+        patchset = parse_comments(email_thread, cache)
+        map_comments_to_gerrit(patchset, cache)
+        with mock.patch.object(patch_parser, '_find_comments') as mock_find_comments, \
+                mock.patch.object(patch_parser, '_parse_git_patch') as mock_parse_git_patch:
+            cached_patchset = parse_comments(email_thread, ParseCache(tmp_dir.name))
+            map_comments_to_gerrit(cached_patchset, ParseCache(tmp_dir.name))
+            mock_find_comments.assert_not_called()
+            mock_parse_git_patch.assert_not_called()
+
+        for got in [patchset, cached_patchset]:
+            self.assertEqual([(c.raw_line, c.message, c.file, c.line) for c in expected.patches[0].comments],
+                             [(c.raw_line, c.message, c.file, c.line) for c in got.patches[0].comments])
+            self.assertEqual([(c.raw_line, c.message) for c in expected.cover_letter.comments],
+                             [(c.raw_line, c.message) for c in got.cover_letter.comments])
+
+    def test_parent_quote_index_cache_is_bounded(self):
+        patch_parser._parent_index_cache.clear()
+        with mock.patch.object(patch_parser, 'PARENT_INDEX_CACHE_SIZE', 2):
+            parents = [mock.Mock(id=f'<{i}@x>', archive_hash=str(i), content=f'line {i}') for i in range(3)]
+            indexes = [patch_parser._get_parent_quote_index(parent) for parent in parents]
+            self.assertIs(indexes[2], patch_parser._get_parent_quote_index(parents[2]))
+            self.assertIsNot(indexes[0], patch_parser._get_parent_quote_index(parents[0]))
+        patch_parser._parent_index_cache.clear()
+
+    def test_input_source(self):
+        lines = patch_parser.InputSource(' a \nb\nc\nd', base_line_number=5)
+        self.assertEqual((lines[0], lines[-1], len(lines)), ('a', 'd', 4))
+        lines.consume(2)
+        self.assertEqual((lines[0], len(lines), lines.line_number()), ('c', 2, 7))
+        # The previous line is the one after the first consumed line.
+        self.assertEqual(lines.get_previous_line(), 'b')
+        with self.assertRaises(IndexError):
+            lines[2]
+        lines.consume()
+        with self.assertRaises(IndexError):
+            lines.consume()
+        self.assertTrue(lines)
+
+    def test_input_source_reads_lazily(self):
+        text = '\n'.join(['---', 'a', '---', 'b'] + [f'line {i}' for i in range(10000)] + [''])
+        lines = patch_parser.InputSource(text)
+        self.assertEqual(2, lines.find_last('---'))
+        self.assertIsNone(lines.find_last('missing'))
+        self.assertEqual(10005, len(lines))
+        self.assertTrue(lines.has_line(1))
+        lines.consume(2)
+        self.assertEqual(('---', 'b'), (lines[0], lines[1]))
+        lines.consume(5000)
+        # Only the lines looked at are kept.
+        self.assertLessEqual(len(lines._lookahead), 2)
+        self.assertEqual(('line 4998', 5002), (lines[0], lines.line_number()))
+        lines.consume(5002)
+        self.assertEqual(('', 1), (lines[0], len(lines)))
+        self.assertFalse(lines.has_line(1))
+
+    def test_parse_large_git_patch(self):
+        added = '\n'.join(f'+line {i}' for i in range(20000))
+        raw_patch = f'''
+Commit message goes here.
+
+---
+ file | 20000 ++++++++++
+ 1 file changed, 20000 insertions(+)
+
+diff --git a/file b/file
+index fa2da6e55caa..1fc93eb38351 100644
+--- a/file
++++ b/file
+@@ -1,1 +1,20001 @@
+ line 0
+{added}
+--
+        '''.strip()
+        line_map = patch_parser._parse_git_patch(raw_patch)
+        self.assertEqual(line_map.map(11), ('file', 1), msg=repr(line_map))
+        self.assertEqual(line_map.map(20011), ('file', 20001))
+
+    def test_map_many_matches_linear_scan(self):
+        entries = []
+        for i in range(50):
+            entries.append(f'''diff --git a/file{i} b/file{i}
+index fa2da6e55caa..1fc93eb38351 100644
+--- a/file{i}
++++ b/file{i}
+@@ -1,4 +1,4 @@
+ line 1
+-line 2
++line two
+ line 3
+ line 4
+@@ -20,3 +20,4 @@
+ line 20
++line 20.5
+ line 21
+ line 22''')
+        raw_patch = ('Commit message goes here.\n\n---\n 50 files changed, 100 insertions(+), 50 deletions(-)\n\n'
+                     + '\n'.join(entries) + '\n--')
+        line_map = patch_parser._parse_git_patch(raw_patch)
+
+        def linear_map(raw_line):
+            for patch_file in line_map.patch_files:
+                if raw_line in patch_file:
+                    return patch_file.map(raw_line)
+            return '', -1
+
+        raw_lines = list(range(raw_patch.count('\n') + 5))
+        self.assertEqual([linear_map(raw_line) for raw_line in raw_lines], line_map.map_many(raw_lines))
+        self.assertEqual(line_map.map(raw_lines[-1]), ('', -1))
+        self.assertEqual(line_map.map_many([]), [])
+
     # TODO(willliu@google.com): Add tests for Multiple patches, no cover letter
 
 
@@ -0,0 +1,322 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import abc
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+import pymysql
+
+from absl import logging
+from dotenv import load_dotenv
+from google.cloud.sql.connector import Connector
+from typing import Any, Callable, Iterable, Iterator, List, Sequence, Set, Tuple
+
+# (name, columns) of an index
+Index = Tuple[str, Sequence[str]]
+# (name, type) of a column
+Column = Tuple[str, str]
+
+# Maximum number of connections a backend has open at once
+POOL_SIZE = 8
+# Connections idle for longer than this many seconds are checked before reuse
+HEALTH_CHECK_AFTER = 60
+# Number of seconds to wait for a connection when all of them are in use
+CHECKOUT_TIMEOUT = 60
+# pymysql error codes for a connection which went away
+MYSQL_DISCONNECT_ERRORS = {
+    2006,  # MySQL server has gone away
+    2013,  # Lost connection to MySQL server during query
+    2055,  # Lost connection to MySQL server at '...', system error
+}
+
+load_dotenv()
+
+def _close(connection) -> None:
+    try:
+        connection.close()
+    except Exception as e:
+        logging.info('Failed to close database connection: %s', e)
+
+class ConnectionPool(object):
+    """ Hands each thread its own database connection.
+
+    A thread keeps its connection until it releases it, so everything it does
+    between commits happens in one transaction on one connection. Released
+    connections are reused by other threads, after checking them with 'ping'
+    if they have been idle long enough for the server to have dropped them."""
+
+    def __init__(self, connect: Callable[[], Any], ping: Callable[[Any], None],
+                 size: int = POOL_SIZE, health_check_after: float = HEALTH_CHECK_AFTER,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self._connect = connect
+        self._ping = ping
+        self._health_check_after = health_check_after
+        self._clock = clock
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        # (time released, connection), most recently released last
+        self._idle : List[Tuple[float, Any]] = []
+        self._local = threading.local()
+
+    def connection(self):
+        """Returns the calling thread's connection, checking one out if needed."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._checkout()
+            self._local.connection = connection
+        return connection
+
+    def _checkout(self):
+        if not self._slots.acquire(timeout=CHECKOUT_TIMEOUT):
+            raise RuntimeError('Timed out waiting for a database connection')
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    released_at, connection = self._idle.pop()
+                if self._clock() - released_at < self._health_check_after:
+                    return connection
+                try:
+                    self._ping(connection)
+                    return connection
+                except Exception as e:
+                    logging.info('Dropping dead database connection: %s', e)
+                    _close(connection)
+            return self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self) -> None:
+        """Returns the calling thread's connection to the pool. Anything not
+        committed is rolled back first, which also ends the snapshot a read
+        may have opened, so the next thread starts a fresh transaction."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            return
+        self._local.connection = None
+        try:
+            connection.rollback()
+        except Exception as e:
+            logging.info('Dropping dead database connection: %s', e)
+            _close(connection)
+            self._slots.release()
+            return
+        with self._lock:
+            self._idle.append((self._clock(), connection))
+        self._slots.release()
+
+    def discard(self) -> None:
+        """Closes the calling thread's connection, e.g. once it has been lost."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            return
+        self._local.connection = None
+        _close(connection)
+        self._slots.release()
+
+    def close(self) -> None:
+        """Closes the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _, connection in idle:
+            _close(connection)
+
+class StorageBackend(object, metaclass = abc.ABCMeta):
+    """ The database MessageDao keeps its tables in.
+
+    Queries are written for pymysql, with %s placeholders, in SQL that MySQL
+    and SQLite both understand. Backends translate placeholders as needed and
+    provide the few DDL statements where the two differ.
+
+    Connections come from a ConnectionPool, so every thread works on its own
+    connection and transaction."""
+
+    pool : ConnectionPool
+
+    @abc.abstractmethod
+    def initialize(self) -> None:
+        """Connects to the database, creating it if needed."""
+        pass
+
+    @abc.abstractmethod
+    def cursor(self):
+        """Returns a context manager which yields a cursor on the calling
+        thread's connection."""
+        pass
+
+    def commit(self) -> None:
+        self.pool.connection().commit()
+
+    def release(self) -> None:
+        """Gives the calling thread's connection back once it has nothing
+        left to commit."""
+        self.pool.release()
+
+    def reconnect(self) -> None:
+        """Drops the calling thread's connection; the next cursor uses a new one.
+        Anything uncommitted on the old connection is lost."""
+        self.pool.discard()
+
+    def is_disconnect(self, error: Exception) -> bool:
+        """Whether error means the connection was lost, so retrying on a new
+        connection may succeed."""
+        return False
+
+    # Schema changes may be rerun after a crash, e.g. once MySQL has committed
+    # the DDL but not the new schema version, so both skip anything that
+    # already exists.
+
+    @abc.abstractmethod
+    def add_indexes(self, cursor, table: str, indexes: Sequence[Index]) -> None:
+        pass
+
+    @abc.abstractmethod
+    def add_columns(self, cursor, table: str, columns: Sequence[Column]) -> None:
+        pass
+
+class CloudSqlBackend(StorageBackend):
+    """A MySQL database on Cloud SQL, configured through the environment."""
+
+    def initialize(self) -> None:
+        self.db_name = os.environ.get("DB")
+        if not self.db_name:
+            raise Exception("Missing environment variable for name of database.")
+        self.connector = Connector()
+        self.pool = ConnectionPool(self._connect, self._ping)
+        # Connect right away so that bad settings fail at startup.
+        self.pool.connection()
+
+    def _connect(self):
+        connection = self.connector.connect(
+            os.environ.get("HOST"),
+            "pymysql",
+            user = os.environ.get("USER"),
+            password = os.environ.get("PASSWORD")
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE DATABASE IF NOT EXISTS " + self.db_name)
+        connection.select_db(self.db_name)
+        return connection
+
+    @staticmethod
+    def _ping(connection) -> None:
+        connection.ping(reconnect=False)
+
+    def cursor(self):
+        return self.pool.connection().cursor()
+
+    def is_disconnect(self, error: Exception) -> bool:
+        if isinstance(error, pymysql.err.InterfaceError):
+            return True
+        return (isinstance(error, pymysql.err.OperationalError)
+                and bool(error.args) and error.args[0] in MYSQL_DISCONNECT_ERRORS)
+
+    # Schema changes are made to live tables, so they are done in place
+    # without blocking reads or writes, with one ALTER TABLE per change.
+
+    @staticmethod
+    def _existing(cursor, query: str, table: str) -> Set[str]:
+        cursor.execute(query, (table,))
+        return {name.lower() for name, in cursor.fetchall()}
+
+    def add_indexes(self, cursor, table: str, indexes: Sequence[Index]) -> None:
+        existing = self._existing(cursor, "SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS "
+                                  "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", table)
+        clauses = [f"ADD INDEX {name} ({', '.join(columns)})" for name, columns in indexes
+                   if name.lower() not in existing]
+        if clauses:
+            cursor.execute(f"ALTER TABLE {table} {', '.join(clauses)}, ALGORITHM=INPLACE, LOCK=NONE")
+
+    def add_columns(self, cursor, table: str, columns: Sequence[Column]) -> None:
+        existing = self._existing(cursor, "SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+                                  "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", table)
+        clauses = [f"ADD COLUMN {name} {column_type}" for name, column_type in columns
+                   if name.lower() not in existing]
+        if clauses:
+            cursor.execute(f"ALTER TABLE {table} {', '.join(clauses)}, ALGORITHM=INPLACE, LOCK=NONE")
+
+class _SqliteCursor(object):
+    """Gives a sqlite3 cursor the parts of the pymysql cursor interface we use."""
+
+    def __init__(self, cursor: sqlite3.Cursor) -> None:
+        self._cursor = cursor
+
+    def execute(self, query: str, args: Sequence = ()) -> int:
+        self._cursor.execute(query.replace('%s', '?'), args)
+        return self._cursor.rowcount
+
+    def executemany(self, query: str, args: Iterable[Sequence]) -> int:
+        self._cursor.executemany(query.replace('%s', '?'), args)
+        return self._cursor.rowcount
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+class SqliteBackend(StorageBackend):
+    """ A SQLite database file, for running the bridge on a single machine
+    without Cloud SQL. The database is kept in WAL mode so that reads never
+    wait on the writer."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def initialize(self) -> None:
+        self.pool = ConnectionPool(self._connect, self._ping)
+
+    def _connect(self) -> sqlite3.Connection:
+        # The pool only ever hands a connection to one thread at a time.
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode this only risks the last transactions on power loss, never corruption.
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    @staticmethod
+    def _ping(connection: sqlite3.Connection) -> None:
+        connection.execute("SELECT 1")
+
+    @contextlib.contextmanager
+    def cursor(self) -> Iterator[_SqliteCursor]:
+        cursor = self.pool.connection().cursor()
+        try:
+            yield _SqliteCursor(cursor)
+        finally:
+            cursor.close()
+
+    def add_indexes(self, cursor, table: str, indexes: Sequence[Index]) -> None:
+        for name, columns in indexes:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+
+    def add_columns(self, cursor, table: str, columns: Sequence[Column]) -> None:
+        cursor.execute(f"PRAGMA table_info({table})")
+        existing = {row[1].lower() for row in cursor.fetchall()}
+        for name, column_type in columns:
+            if name.lower() not in existing:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+def backend_from_environment() -> StorageBackend:
+    """Uses SQLite when SQLITE_PATH is set and Cloud SQL otherwise."""
+    sqlite_path = os.environ.get("SQLITE_PATH")
+    if sqlite_path:
+        return SqliteBackend(sqlite_path)
+    return CloudSqlBackend()
@@ -0,0 +1,106 @@
+import threading
+import unittest
+
+from unittest import mock
+
+import pymysql
+
+import storage_backend
+from storage_backend import CloudSqlBackend, ConnectionPool
+
+class StrContains(str):
+   def __eq__(self, other):
+      return self in other
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.connect = mock.MagicMock(side_effect=lambda: mock.MagicMock())
+        self.ping = mock.MagicMock()
+        self.pool = ConnectionPool(self.connect, self.ping, size=2, health_check_after=10,
+                                   clock=lambda: self.now)
+
+    def _connection_in_thread(self):
+        connections = []
+        thread = threading.Thread(target=lambda: connections.append(self.pool.connection()))
+        thread.start()
+        thread.join()
+        return connections[0]
+
+    def test_each_thread_gets_its_own_connection(self):
+        connection = self.pool.connection()
+        self.assertIs(connection, self.pool.connection())
+        self.assertIsNot(connection, self._connection_in_thread())
+        self.assertEqual(2, self.connect.call_count)
+
+    def test_released_connection_is_reused(self):
+        connection = self.pool.connection()
+        self.pool.release()
+        self.assertIs(connection, self._connection_in_thread())
+        self.connect.assert_called_once()
+        # Recently used connections are not checked.
+        self.ping.assert_not_called()
+
+    def test_release_rolls_back(self):
+        connection = self.pool.connection()
+        self.pool.release()
+        connection.rollback.assert_called_once()
+
+    def test_release_drops_dead_connection(self):
+        connection = self.pool.connection()
+        connection.rollback.side_effect = pymysql.err.OperationalError(2006, 'MySQL server has gone away')
+        self.pool.release()
+        connection.close.assert_called_once()
+        self.assertIsNot(connection, self.pool.connection())
+
+    def test_dead_idle_connection_is_replaced(self):
+        connection = self.pool.connection()
+        self.pool.release()
+        self.now = 10
+        self.ping.side_effect = pymysql.err.OperationalError(2006, 'MySQL server has gone away')
+        self.assertIsNot(connection, self.pool.connection())
+        connection.close.assert_called_once()
+        self.assertEqual(2, self.connect.call_count)
+
+    def test_discard_closes_connection(self):
+        connection = self.pool.connection()
+        self.pool.discard()
+        connection.close.assert_called_once()
+        self.assertIsNot(connection, self.pool.connection())
+
+    @mock.patch.object(storage_backend, 'CHECKOUT_TIMEOUT', 0)
+    def test_checkout_is_bounded(self):
+        # Both threads exit without releasing their connections.
+        self._connection_in_thread()
+        self._connection_in_thread()
+        with self.assertRaises(RuntimeError):
+            self.pool.connection()
+
+class CloudSqlBackendTest(unittest.TestCase):
+
+    def test_is_disconnect(self):
+        backend = CloudSqlBackend()
+        self.assertTrue(backend.is_disconnect(pymysql.err.OperationalError(2013, 'Lost connection')))
+        self.assertTrue(backend.is_disconnect(pymysql.err.InterfaceError(0, '')))
+        self.assertFalse(backend.is_disconnect(pymysql.err.OperationalError(1205, 'Lock wait timeout')))
+        self.assertFalse(backend.is_disconnect(ValueError()))
+
+    def test_schema_changes_skip_existing(self):
+        backend = CloudSqlBackend()
+        cursor = mock.Mock()
+        cursor.fetchall.return_value = [('in_reply_to_index',), ('PRIMARY',)]
+        backend.add_indexes(cursor, 'Messages', [('in_reply_to_index', ['in_reply_to']),
+                                                 ('matching_index', ['from_'])])
+        cursor.execute.assert_called_with(
+            "ALTER TABLE Messages ADD INDEX matching_index (from_), ALGORITHM=INPLACE, LOCK=NONE")
+
+        cursor.reset_mock()
+        cursor.fetchall.return_value = [('message_id',), ('commit_time',)]
+        backend.add_columns(cursor, 'Messages', [('commit_time', 'BIGINT')])
+        # Only the lookup of the existing columns.
+        cursor.execute.assert_called_once_with(StrContains('information_schema.COLUMNS'), ('Messages',))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,7 @@
 """Collection of test helper functions."""
 
 import os
-from typing import List
+from typing import Iterator, List, Tuple
 
 from message import Message
 
@@ -14,5 +14,17 @@ def test_data_path(path='') -> str:
     return base
 
 
+def read_test_emails(path='') -> Iterator[Tuple[str, bytes]]:
+    """Yields (archive hash, raw email) for each email in a src/test_data/ directory.
+
+    Emails are stored as <hash>.txt, so the file name stands in for the archive hash."""
+    directory = test_data_path(path)
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.txt'):
+            continue
+        with open(os.path.join(directory, filename), 'rb') as f:
+            yield os.path.splitext(filename)[0], f.read()
+
+
 def compare_message_subjects(test, messages: List[Message], subjects: List[str]):
     test.assertCountEqual([m.subject for m in messages], subjects)